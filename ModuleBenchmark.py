@@ -0,0 +1,393 @@
+import configs
+import pymupdf
+import openpyxl
+import concurrent.futures
+import contextlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import ModulePDF2b64s
+import ModuleReadExcel
+import ModuleResultsStore
+import ModuleCreateExcelOfTestingHistory
+import ModuleSaveMarkingResultToExcel
+import ModuleLLMQuery
+import ModuleMarkPaper
+import ModulePipeline
+import ModulePageStore
+import ModuleMockLLMServer
+import ModuleTracing
+
+def make_synthetic_pdf(source_pdf_path, page_count, save_path):
+    # Build a pdf of page_count pages by repeating the pages of source_pdf_path
+    with pymupdf.open(source_pdf_path) as source, pymupdf.open() as doc:
+        while len(doc) < page_count:
+            doc.insert_pdf(source, to_page=min(len(source), page_count-len(doc))-1)
+        doc.save(save_path)
+    return save_path
+
+def BenchmarkPDF2b64s(page_counts=(5, 10, 20, 40), worker_counts=(1, 2, 4, 8), source_pdf_path="test_folder/data/9709_12_2024_MayJune_Mathematics_qp_first_try.pdf", repeats=3):
+    """
+    Args:
+        1. page_counts (<class 'tuple'>): the page counts of the synthetic pdfs to render
+        2. worker_counts (<class 'tuple'>): the numbers of rendering processes to try
+        3. source_pdf_path (<class 'str'>): the pdf whose pages are repeated to build the synthetic pdfs
+        4. repeats (<class 'int'>): how many times each case is run, the fastest run is reported
+    Return:
+        of <class 'list'> rows of [page count, worker count, seconds, speedup over 1 worker]
+    Process:
+        Render synthetic pdfs with ModulePDF2b64s.PDF2b64s, bypassing the page cache, and print a table of the timings
+    """
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        for page_count in page_counts:
+            pdf_path = make_synthetic_pdf(source_pdf_path, page_count, os.path.join(tmp_folder, f"{page_count}.pdf"))
+            baseline = None
+            for workers in worker_counts:
+                seconds = float("inf")
+                for _ in range(repeats):
+                    before = time.perf_counter()
+                    ModulePDF2b64s.PDF2b64s(pdf_path, use_cache=False, workers=workers)
+                    seconds = min(seconds, time.perf_counter()-before)
+                if baseline is None:
+                    baseline = seconds
+                rows.append([page_count, workers, seconds, baseline/seconds])
+    print(f"Rendering on {os.cpu_count()} cores, profile={configs.img_profiles['default']}")
+    print("pages\tworkers\tseconds\tspeedup")
+    for page_count, workers, seconds, speedup in rows:
+        print(f"{page_count}\t{workers}\t{seconds:.3f}\t{speedup:.2f}x")
+    return rows
+
+def BenchmarkEncodingProfiles(pdf_paths=("test_folder/data/9709_12_2024_MayJune_Mathematics_qp_first_try.pdf", "test_folder/data/9709_12_2024_MayJune_Mathematics_ms.pdf", "test_folder/data/9709_12_2024_MayJune_Mathematics_tt.pdf"), profiles=None):
+    """
+    Args:
+        1. pdf_paths (<class 'tuple'>): the pdfs to render
+        2. profiles (<class 'dict'>): the encoding profiles to try, named like configs.img_profiles, which is used if this is None
+    Return:
+        of <class 'list'> rows of [pdf name, profile name, base 64 bytes per page, milliseconds per page]
+    Process:
+        Render every page of every pdf with every profile, bypassing the page cache, and print a table of the upload size and encode time per page
+    """
+    profiles = configs.img_profiles if profiles is None else profiles
+    rows = []
+    for pdf_path in pdf_paths:
+        with pymupdf.open(pdf_path) as doc:
+            for name, profile in profiles.items():
+                before = time.perf_counter()
+                total_bytes = sum(len(ModulePDF2b64s.render_page(doc, page_num, profile)) for page_num in range(len(doc)))
+                seconds = time.perf_counter()-before
+                rows.append([os.path.basename(pdf_path), name, total_bytes/len(doc), seconds/len(doc)*1000])
+    print("pdf\tprofile\tKB/page\tms/page")
+    for pdf_name, name, bytes_per_page, ms_per_page in rows:
+        print(f"{pdf_name}\t{name}\t{bytes_per_page/1024:.0f}\t{ms_per_page:.1f}")
+    return rows
+
+def determine_rows_to_add_by_cell(path_to_excel, start_col=9, end_col=15):
+    # How the summary row of a marking result used to be read from its excel file, kept as the baseline
+    sheet_obj = openpyxl.load_workbook(str(path_to_excel)).active
+    new_row = [os.path.basename(path_to_excel)]
+    override_row = ["Exam Paper Name"]
+    for col in range(start_col, end_col+1):
+        new_row.append(sheet_obj.cell(row=2, column=col).value)
+        override_row.append(sheet_obj.cell(row=1, column=col).value)
+    return new_row, override_row
+
+def BenchmarkHistoryAggregation(file_count=10000, worker_counts=(1, 2, 4, 8)):
+    """
+    Args:
+        1. file_count (<class 'int'>): the number of synthetic marking results
+        2. worker_counts (<class 'tuple'>): the numbers of reading processes to try
+    Return:
+        of <class 'list'> rows of [method, seconds, files per second]
+    Process:
+        Export one marking result with ModuleSaveMarkingResultToExcel, copy it file_count times, and time reading all of them: first the old way (full workbook, one cell at a time), then with ModuleReadExcel in read-only mode with each number of workers
+        Then time the database of ModuleResultsStore: importing the copies, saving file_count papers one at a time like the jobs do, querying the history like ModuleProduceFeedbackForStudent does, and exporting the excel of testing history
+    """
+    rows = []
+    def timed(method, function):
+        before = time.perf_counter()
+        # Importing prints every file, which would drown the table
+        with contextlib.redirect_stdout(io.StringIO()):
+            function()
+        seconds = time.perf_counter()-before
+        rows.append([method, seconds, file_count/seconds])
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        history_folder = os.path.join(tmp_folder, "history")
+        os.mkdir(history_folder)
+        database_path = os.path.join(tmp_folder, "results.sqlite3")
+        marking_report = [[str(question), 5, 3] for question in range(1, 12)]
+        template = os.path.join(tmp_folder, "template.xlsx")
+        ModuleSaveMarkingResultToExcel.SaveMarkingResultToExcel(template, "9709", "12", marking_report, "Good at algebra", "Not good at geometry", 33, 55, "C", update_summary=False, database_path=database_path)
+        ModuleSaveMarkingResultToExcel.ExportMarkingResultToExcel("template.xlsx", template, database_path)
+        paths = []
+        for idx in range(file_count):
+            paths.append(os.path.join(history_folder, f"marking_result_{idx}.xlsx"))
+            shutil.copyfile(template, paths[-1])
+
+        timed("excel, load_workbook + cell", lambda: [determine_rows_to_add_by_cell(path) for path in paths])
+        for workers in worker_counts:
+            timed(f"excel, read_only, {workers} workers", lambda: ModuleReadExcel.MapInParallel(ModuleResultsStore.ReadMarkingResult, paths, workers=workers))
+        timed("database, import the excel files", lambda: ModuleResultsStore.ImportMarkingResults(history_folder, database_path))
+        timed("database, save one paper at a time", lambda: [
+            ModuleResultsStore.SavePaper(f"saved_{idx}.xlsx", "9709", "12", marking_report, "Good at algebra", "Not good at geometry", 33, 55, "C", database_path=database_path)
+            for idx in range(file_count)
+        ])
+        timed("database, query the history", lambda: ModuleResultsStore.ListPapers(database_path=database_path))
+        output = os.path.join(tmp_folder, "testing_history.xlsx")
+        timed("database, export the excel of testing history", lambda: ModuleCreateExcelOfTestingHistory.CreateExcelOfTestingHistory(output_override=output, database_override=database_path))
+    print(f"Reading {file_count} marking results on {os.cpu_count()} cores, configs.excel_read_workers={configs.excel_read_workers}")
+    print("method\tseconds\tfiles/s")
+    for method, seconds, files_per_second in rows:
+        print(f"{method}\t{seconds:.2f}\t{files_per_second:.0f}")
+    return rows
+
+def make_distinct_copies(source_pdf_path, count, folder):
+    # Copies of a pdf that differ in their metadata only, so that each misses the page cache like a real script would
+    paths = []
+    for idx in range(count):
+        paths.append(os.path.join(folder, f"student_{idx}.pdf"))
+        with pymupdf.open(source_pdf_path) as doc:
+            doc.set_metadata({**doc.metadata, "title": f"Student {idx}"})
+            doc.save(paths[-1])
+    return paths
+
+def connect_to(base_url):
+    # Point the clients of ModuleLLMQuery at base_url, returning the url they were using
+    previous = configs.base_url
+    configs.base_url = base_url
+    ModuleLLMQuery.client = None # rebuilt with the new url when next used
+    ModuleLLMQuery.async_states.clear() # rebuilt with the new url when next awaited
+    return previous
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[round(fraction*(len(values)-1))] if values else float("nan")
+
+def BenchmarkMarkPaper(worker_counts=(1, 2, 4, 8), paper_count=8, latency=2.0, jitter=0.5, student_work_path="test_folder/data/9709_12_2024_MayJune_Mathematics_qp_first_try.pdf", mark_scheme_path="test_folder/data/9709_12_2024_MayJune_Mathematics_ms.pdf", threshold_table_path="test_folder/data/9709_12_2024_MayJune_Mathematics_tt.pdf"):
+    """
+    Args:
+        1. worker_counts (<class 'tuple'>): the numbers of papers marked at the same time to try
+        2. paper_count (<class 'int'>): the number of papers marked at each level
+        3. latency (<class 'float'>): the mean seconds the stand-in server takes per request
+        4. jitter (<class 'float'>): how far the latency of a request may stray from the mean, see ModuleMockLLMServer.StartMockLLMServer
+        5. student_work_path, mark_scheme_path, threshold_table_path (<class 'str'>): the pdfs to mark, the student work is copied paper_count times
+    Return:
+        of <class 'list'> rows of [workers, papers per minute, median seconds per paper, 95th percentile seconds per paper, failed papers, fraction of the prompt tokens served from the prompt cache, <class 'dict'> of the seconds per paper spent in each stage]
+    Process:
+        Start ModuleMockLLMServer, point configs.base_url at it, and mark the papers with ModuleMarkPaper.MarkPapers at each level of concurrency, without spending real API calls
+        Every level starts with an empty page cache, no pages held by ModulePageStore and a fresh prompt cache on the server, and saves into its own temporary folders, so the levels do not help each other. The time of each stage and the cached tokens are taken from the spans of ModuleTracing
+    """
+    rows = []
+    server = ModuleMockLLMServer.StartMockLLMServer(latency=latency, jitter=jitter)
+    saved_configs = {key: getattr(configs, key) for key in ("marking_result_folder", "path_to_excel_of_testing_history", "results_database_path", "page_cache_folder", "llm_cache_enabled", "trace_path")}
+    previous_base_url = connect_to(server.base_url)
+    try:
+        with tempfile.TemporaryDirectory() as tmp_folder:
+            paths = make_distinct_copies(student_work_path, paper_count, tmp_folder)
+            configs.llm_cache_enabled = False
+            configs.trace_path = None # only the totals are needed
+            for workers in worker_counts:
+                level_folder = os.path.join(tmp_folder, str(workers))
+                os.mkdir(level_folder)
+                os.mkdir(os.path.join(level_folder, "history"))
+                configs.marking_result_folder = os.path.join(level_folder, "history")+os.sep
+                configs.path_to_excel_of_testing_history = os.path.join(level_folder, "testing_history.xlsx")
+                configs.results_database_path = os.path.join(level_folder, "results.sqlite3")
+                configs.page_cache_folder = os.path.join(level_folder, "pages")
+                ModulePageStore.documents.clear()
+                server.seen_prefixes.clear()
+                stage_seconds_before = {name: totals["wall_seconds"] for name, totals in ModuleTracing.metrics.items()}
+                tokens_before = dict(ModuleTracing.metrics.get("llm_query", {}))
+                with contextlib.redirect_stdout(io.StringIO()):
+                    results, stats = ModuleMarkPaper.MarkPapers(paths, mark_scheme_path, threshold_table_path, workers=workers)
+                stage_seconds = {
+                    name: (totals["wall_seconds"]-stage_seconds_before.get(name, 0))/paper_count
+                    for name, totals in ModuleTracing.metrics.items()
+                }
+                tokens = {key: ModuleTracing.metrics.get("llm_query", {}).get(key, 0)-tokens_before.get(key, 0) for key in ("prompt_tokens", "cached_tokens")}
+                cached_ratio = tokens["cached_tokens"]/tokens["prompt_tokens"] if tokens["prompt_tokens"] else 0
+                seconds = [result["seconds"] for result in results if not result["error"]]
+                rows.append([workers, stats["papers_per_minute"], percentile(seconds, 0.5), percentile(seconds, 0.95), stats["failed"], cached_ratio, stage_seconds])
+    finally:
+        connect_to(previous_base_url)
+        for key, value in saved_configs.items():
+            setattr(configs, key, value)
+        server.shutdown()
+    print(f"Marking {paper_count} papers against a stand-in server answering in {latency}s +/- {jitter}s, on {os.cpu_count()} cores")
+    print("workers\tpapers/min\tp50 s\tp95 s\tfailed\tcached prompt")
+    for workers, papers_per_minute, p50, p95, failed, cached_ratio, stage_seconds in rows:
+        print(f"{workers}\t{papers_per_minute:.1f}\t\t{p50:.2f}\t{p95:.2f}\t{failed}\t{cached_ratio:.0%}")
+    print("Seconds per paper spent in each stage, stages nest so they do not add up")
+    stages = ["mark_paper", "produce_marking_report", "render_page", "llm_query", "find_grade", "save_marking_result", "create_excel_of_testing_history"]
+    print("workers\t"+"\t".join(stages))
+    for workers, papers_per_minute, p50, p95, failed, cached_ratio, stage_seconds in rows:
+        print(f"{workers}\t"+"\t".join(f"{stage_seconds.get(stage, 0):.2f}" for stage in stages))
+    return rows
+
+def BenchmarkPipeline(paper_count=8, workers=4, latency=2.0, jitter=0.5, student_work_path="test_folder/data/9709_12_2024_MayJune_Mathematics_qp_first_try.pdf", mark_scheme_path="test_folder/data/9709_12_2024_MayJune_Mathematics_ms.pdf", threshold_table_path="test_folder/data/9709_12_2024_MayJune_Mathematics_tt.pdf"):
+    """
+    Args:
+        1. paper_count (<class 'int'>): the number of papers marked by each engine
+        2. workers (<class 'int'>): the papers ModuleMarkPaper.MarkPapers marks at the same time, and the workers of the mark stage of ModulePipeline.MarkPapers, the other stages keep configs.pipeline_workers
+        3. latency, jitter, student_work_path, mark_scheme_path, threshold_table_path: the same as BenchmarkMarkPaper
+    Return:
+        of <class 'list'> rows of [engine, papers per minute, median seconds per paper, failed papers, <class 'dict'> of the ModulePipeline.Stats of each stage, empty for ModuleMarkPaper.MarkPapers]
+    Process:
+        Mark the same papers against ModuleMockLLMServer with ModuleMarkPaper.MarkPapers, where each worker renders, marks, grades and saves one paper after another, and with ModulePipeline.MarkPapers, where the stages overlap across papers
+        Each engine starts with an empty page cache, so the papers are really rendered, and saves into its own temporary folders
+    """
+    rows = []
+    server = ModuleMockLLMServer.StartMockLLMServer(latency=latency, jitter=jitter)
+    saved_configs = {key: getattr(configs, key) for key in ("marking_result_folder", "path_to_excel_of_testing_history", "results_database_path", "page_cache_folder", "llm_cache_enabled", "trace_path")}
+    previous_base_url = connect_to(server.base_url)
+    engines = {
+        "MarkPapers": lambda paths: ModuleMarkPaper.MarkPapers(paths, mark_scheme_path, threshold_table_path, workers=workers),
+        "pipeline": lambda paths: ModulePipeline.MarkPapers(paths, mark_scheme_path, threshold_table_path, workers={"mark": workers}),
+    }
+    try:
+        with tempfile.TemporaryDirectory() as tmp_folder:
+            paths = make_distinct_copies(student_work_path, paper_count, tmp_folder)
+            configs.llm_cache_enabled = False
+            configs.trace_path = None
+            for engine, mark_papers in engines.items():
+                engine_folder = os.path.join(tmp_folder, engine)
+                os.makedirs(os.path.join(engine_folder, "history"))
+                configs.marking_result_folder = os.path.join(engine_folder, "history")+os.sep
+                configs.path_to_excel_of_testing_history = os.path.join(engine_folder, "testing_history.xlsx")
+                configs.results_database_path = os.path.join(engine_folder, "results.sqlite3")
+                configs.page_cache_folder = os.path.join(engine_folder, "pages")
+                ModulePageStore.documents.clear()
+                server.seen_prefixes.clear()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    results, stats = mark_papers(paths)
+                seconds = [result["seconds"] for result in results if not result["error"]]
+                rows.append([engine, stats["papers_per_minute"], percentile(seconds, 0.5), stats["failed"], stats.get("stages", {})])
+    finally:
+        connect_to(previous_base_url)
+        for key, value in saved_configs.items():
+            setattr(configs, key, value)
+        server.shutdown()
+    print(f"Marking {paper_count} papers with {workers} marking workers against a stand-in server answering in {latency}s +/- {jitter}s, on {os.cpu_count()} cores")
+    print("engine		papers/min	p50 s	failed")
+    for engine, papers_per_minute, p50, failed, stages in rows:
+        print(f"{engine}	{papers_per_minute:.1f}		{p50:.2f}	{failed}")
+    for engine, papers_per_minute, p50, failed, stages in rows:
+        if stages:
+            print(f"Stages of {engine}")
+            print("stage	workers	busy	blocked s")
+            for name, stage in stages.items():
+                print(f"{name}	{stage['workers']}	{stage['utilization']:.0%}	{stage['blocked_seconds']:.1f}")
+    return rows
+
+def BenchmarkMemory(session_counts=(1, 2, 4, 8), latency=1.0, student_work_path="test_folder/data/9709_12_2024_MayJune_Mathematics_qp_first_try.pdf", mark_scheme_path="test_folder/data/9709_12_2024_MayJune_Mathematics_ms.pdf", threshold_table_path="test_folder/data/9709_12_2024_MayJune_Mathematics_tt.pdf"):
+    """
+    Args:
+        1. session_counts (<class 'tuple'>): the numbers of papers marked at the same time to try, like as many teachers submitting at once
+        2. latency (<class 'float'>): the mean seconds the stand-in server takes per request, long enough for the sessions to overlap
+        3. student_work_path, mark_scheme_path, threshold_table_path (<class 'str'>): the pdfs to mark
+    Return:
+        of <class 'list'> rows of [sessions, mark scheme ("shared" or "distinct"), peak RSS in bytes, RSS before marking in bytes, bytes held by ModulePageStore at the end]
+    Process:
+        Each level runs in a fresh process (see measure_peak_rss), since the peak RSS of a process never goes down. The sessions either all mark against the same mark scheme, whose pages ModulePageStore then holds once, or each against its own copy of it, which is what every session costs without sharing
+        Needs the resource module, so only runs on Unix
+    """
+    rows = []
+    for sessions in session_counts:
+        for mark_scheme in ("shared", "distinct"):
+            code = f"import ModuleBenchmark; ModuleBenchmark.measure_peak_rss({sessions}, {mark_scheme == 'shared'}, {latency}, {student_work_path!r}, {mark_scheme_path!r}, {threshold_table_path!r})"
+            completed = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+            if completed.returncode:
+                raise RuntimeError(f"Measuring {sessions} sessions failed:\n{completed.stderr}")
+            measured = json.loads(completed.stdout.strip().splitlines()[-1])
+            rows.append([sessions, mark_scheme, measured["peak_rss"], measured["baseline_rss"], measured["page_store_bytes"]])
+    print(f"Peak RSS of marking papers at the same time, against a stand-in server answering in {latency}s")
+    print("sessions\tmark scheme\tpeak MB\tover baseline MB\tpage store MB")
+    for sessions, mark_scheme, peak_rss, baseline_rss, page_store_bytes in rows:
+        print(f"{sessions}\t{mark_scheme}\t{peak_rss/2**20:.0f}\t{(peak_rss-baseline_rss)/2**20:.0f}\t\t{page_store_bytes/2**20:.1f}")
+    return rows
+
+def measure_peak_rss(sessions, shared, latency, student_work_path, mark_scheme_path, threshold_table_path):
+    # Run by BenchmarkMemory in a process of its own, printing the measurements as the last line of JSON
+    import resource
+    def rss():
+        # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*(1 if sys.platform == "darwin" else 1024)
+    server = ModuleMockLLMServer.StartMockLLMServer(latency=latency, jitter=0)
+    connect_to(server.base_url)
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        configs.marking_result_folder = tmp_folder+os.sep
+        configs.results_database_path = os.path.join(tmp_folder, "results.sqlite3")
+        configs.page_cache_folder = os.path.join(tmp_folder, "pages")
+        configs.llm_cache_enabled = False
+        configs.trace_path = None
+        papers = make_distinct_copies(student_work_path, sessions, tmp_folder)
+        if shared:
+            mark_schemes = [mark_scheme_path]*sessions
+        else:
+            os.mkdir(os.path.join(tmp_folder, "mark_schemes"))
+            mark_schemes = make_distinct_copies(mark_scheme_path, sessions, os.path.join(tmp_folder, "mark_schemes"))
+        baseline_rss = rss()
+        with contextlib.redirect_stdout(io.StringIO()), concurrent.futures.ThreadPoolExecutor(max_workers=sessions) as executor:
+            futures = [executor.submit(ModuleMarkPaper.MarkPaper, paper, mark_scheme, threshold_table_path, update_summary=False) for paper, mark_scheme in zip(papers, mark_schemes)]
+            for future in futures:
+                future.result()
+    server.shutdown()
+    print(json.dumps({"peak_rss": rss(), "baseline_rss": baseline_rss, "page_store_bytes": ModulePageStore.Stats()["bytes"]}))
+
+def BenchmarkStartup(runs=5, targets=("ModuleFindGrade", "ModuleMarkPaper", "ModuleCLI", "ModuleMainLoop")):
+    """
+    Args:
+        1. runs (<class 'int'>): the number of fresh processes timed per module, the median is shown
+        2. targets (<class 'tuple'>): the modules to time the import of
+    Return:
+        of <class 'list'> rows of [module, seconds to import lazily, seconds to import with the heavy libraries, <class 'list'> of the heavy libraries imported]
+    Process:
+        Time 'import module' in a fresh interpreter, as the modules import openai, pymupdf, PIL and openpyxl only once they are used. Then time it again with those libraries imported first, which is what importing cost when they were imported at the top of every module
+        Also time 'python ModuleCLI.py --help', the cost of starting the headless CLI
+    """
+    heavy = ["gradio", "openai", "httpx", "pymupdf", "PIL.Image", "openpyxl"]
+    folder = os.path.dirname(os.path.abspath(__file__))
+    def seconds_to_run(code):
+        times = []
+        for run in range(runs):
+            before = time.perf_counter()
+            completed = subprocess.run([sys.executable, "-c", code], cwd=folder, capture_output=True, text=True)
+            times.append(time.perf_counter()-before)
+            if completed.returncode:
+                raise RuntimeError(f"Running {code} failed:\n{completed.stderr}")
+        return percentile(times, 0.5), completed.stdout
+    rows = []
+    for target in targets:
+        lazy_seconds, stdout = seconds_to_run(f"import sys, {target}; print(' '.join(name for name in {heavy!r} if name in sys.modules))")
+        eager_seconds, _ = seconds_to_run(f"import {', '.join(heavy)}, {target}")
+        rows.append([target, lazy_seconds, eager_seconds, stdout.split()])
+    cli_seconds, _ = seconds_to_run("import sys, contextlib, io, ModuleCLI\nwith contextlib.redirect_stdout(io.StringIO()), contextlib.suppress(SystemExit): ModuleCLI.Main(['--help'])")
+    print(f"Seconds to import in a fresh process, median of {runs} runs")
+    print("module\tlazy\twith the heavy libraries\theavy libraries still imported")
+    for target, lazy_seconds, eager_seconds, imported in rows:
+        print(f"{target}\t{lazy_seconds:.2f}\t{eager_seconds:.2f}\t\t\t{' '.join(imported) or '-'}")
+    print(f"ModuleCLI --help\t{cli_seconds:.2f}")
+    return rows
+
+benchmarks = {
+    "pdf2b64s": BenchmarkPDF2b64s,
+    "history": BenchmarkHistoryAggregation,
+    "profiles": BenchmarkEncodingProfiles,
+    "markpaper": BenchmarkMarkPaper,
+    "pipeline": BenchmarkPipeline,
+    "memory": BenchmarkMemory,
+    "startup": BenchmarkStartup,
+}
+
+# Run with e.g. python ModuleBenchmark.py pdf2b64s, or with no argument to run all the benchmarks
+if __name__ == "__main__":
+    for name in sys.argv[1:] or benchmarks:
+        print(f"Running benchmark: {name}")
+        benchmarks[name]()
+        print()
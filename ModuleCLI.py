@@ -0,0 +1,122 @@
+import configs
+import argparse
+import sys
+import time
+
+# The modules doing the work are imported by each command, so that e.g. 'history' never pays for importing openai or pymupdf, and nothing here ever imports gradio
+
+def Mark(args):
+    import ModuleMarkPaper
+    import ModuleProduceFeedbackForStudent
+    from pathlib import Path
+    if len(args.student_work) == 1 and not Path(args.student_work[0]).is_dir():
+        def on_question(question_row, question_count):
+            print(f"Marked question {question_row[0]}: {question_row[2]}/{question_row[1]}", file=sys.stderr)
+        score, max_score, grade, strengths, weaknesses = ModuleMarkPaper.MarkPaper(args.student_work[0], args.mark_scheme, args.threshold_table, on_question=on_question)
+        print(
+            f"Score: \t{score}/{max_score}\n"
+            f"Grade: \t{grade}\n"
+            f"Strengths: \t{strengths}\n"
+            f"Weaknesses: \t{weaknesses}"
+        )
+    else:
+        # A folder, or several papers, are marked as a batch sharing the mark scheme and threshold table
+        student_work = args.student_work[0] if len(args.student_work) == 1 else args.student_work
+        if args.pipelined:
+            import ModulePipeline
+            results, stats = ModulePipeline.MarkPapers(student_work, args.mark_scheme, args.threshold_table, workers=None if args.workers is None else {"mark": args.workers})
+        else:
+            results, stats = ModuleMarkPaper.MarkPapers(student_work, args.mark_scheme, args.threshold_table, workers=args.workers)
+        for result in results:
+            print(f"{result['student_work_path']}: \t{result.get('marks_earned')}/{result.get('marks_there')} {result.get('grade')} {result['error']}")
+        print(f"Marked {stats['succeeded']}/{stats['papers']} papers in {stats['seconds']:.0f}s")
+    if args.feedback:
+        print(f"Feedback based on History: \t{ModuleProduceFeedbackForStudent.ProduceFeedbackForStudent()}")
+
+def Grade(args):
+    import ModuleFindGrade
+    # FindGrade only needs the total, so the score is passed as a single question
+    marks_earned, marks_there, grade = ModuleFindGrade.FindGrade(args.component_number, [["total", args.out_of or args.score, args.score]], threshold_table_path=args.threshold_table)
+    print(grade)
+
+def History(args):
+    import ModuleResultsStore
+    ModuleResultsStore.ImportMarkingResults()
+    papers = ModuleResultsStore.ListPapers(limit=args.limit, student=args.student)
+    print("Marked at\tExam Paper Name\tComponent\tScore\tGrade")
+    for paper in papers:
+        print(f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(paper['marked_at']))}\t{paper['name']}\t{paper['syllabus_code']}/{paper['component_number']}\t{paper['marks_earned']}/{paper['marks_there']}\t{paper['grade']}")
+    if args.export:
+        import ModuleCreateExcelOfTestingHistory
+        print(f"Exported to {ModuleCreateExcelOfTestingHistory.CreateExcelOfTestingHistory(output_override=args.export if args.export is not True else None)}")
+
+def Feedback(args):
+    import ModuleProduceFeedbackForStudent
+    print(ModuleProduceFeedbackForStudent.ProduceFeedbackForStudent(student=args.student, rebuild=args.rebuild))
+
+def Watch(args):
+    import ModuleWatchFolder
+    stats = ModuleWatchFolder.Watch(args.inbox, args.mark_scheme, args.threshold_table, workers=args.workers, poll_seconds=args.poll_seconds, until_idle=args.until_idle)
+    if stats["failed"]:
+        raise RuntimeError(f"{stats['failed']} papers failed to be marked, see the failed folder of the inbox")
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python ModuleCLI.py", description="Mark exam papers without the GUI")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    mark = subparsers.add_parser("mark", help="mark completed question papers and save the results")
+    mark.add_argument("student_work", nargs="+", help="a completed question paper pdf, several of them, or a folder of them")
+    mark.add_argument("--mark-scheme", required=True, help="the mark scheme pdf")
+    mark.add_argument("--threshold-table", required=True, help="the grading threshold table pdf")
+    mark.add_argument("--workers", type=int, default=None, help="papers marked at the same time when marking several, configs.batch_workers by default")
+    mark.add_argument("--pipelined", action="store_true", help="when marking several, render, mark, grade and save them in overlapping stages with ModulePipeline, --workers then being the workers of the mark stage")
+    mark.add_argument("--feedback", action="store_true", help="also produce the feedback based on the history afterwards")
+    mark.set_defaults(function=Mark)
+
+    grade = subparsers.add_parser("grade", help="look the grade of a score up in a threshold table")
+    grade.add_argument("threshold_table", help="the grading threshold table pdf")
+    grade.add_argument("component_number", help="e.g. 12")
+    grade.add_argument("score", type=int, help="the total marks earned")
+    grade.add_argument("--out-of", type=int, default=None, help="the total marks available")
+    grade.set_defaults(function=Grade)
+
+    history = subparsers.add_parser("history", help="list the papers marked so far")
+    history.add_argument("--limit", type=int, default=None, help="only list the most recent papers")
+    history.add_argument("--student", default=None, help="only list the papers of this student")
+    history.add_argument("--export", nargs="?", const=True, default=None, metavar="PATH", help="also export the history to an excel file, configs.path_to_excel_of_testing_history by default")
+    history.set_defaults(function=History)
+
+    feedback = subparsers.add_parser("feedback", help="comment on the performance of the student so far")
+    feedback.add_argument("--student", default=None, help="configs.student_name by default")
+    feedback.add_argument("--rebuild", action="store_true", help="go through the whole history again instead of only the papers since the last feedback")
+    feedback.set_defaults(function=Feedback)
+
+    watch = subparsers.add_parser("watch", help="keep marking the papers dropped into an inbox folder, e.g. by a scanner")
+    watch.add_argument("inbox", nargs="?", default=None, help="configs.watch_inbox_folder by default")
+    watch.add_argument("--mark-scheme", default=None, help="the mark scheme pdf, configs.watch_mark_scheme_path by default")
+    watch.add_argument("--threshold-table", default=None, help="the grading threshold table pdf, configs.watch_threshold_table_path by default")
+    watch.add_argument("--workers", type=int, default=None, help="papers marked at the same time, configs.watch_workers by default")
+    watch.add_argument("--poll-seconds", type=float, default=None, help="how often the inbox is listed, configs.watch_poll_seconds by default")
+    watch.add_argument("--until-idle", action="store_true", help="stop once the inbox is empty instead of watching until Ctrl+C")
+    watch.set_defaults(function=Watch)
+    return parser
+
+def Main(argv=None):
+    """
+    Args:
+        1. argv (<class 'list'>): the command line arguments, sys.argv[1:] if this is None
+    Return:
+        of <class 'int'> the exit status, 0 if the command succeeded
+    Process:
+        Run one of the commands mark, grade, history, feedback or watch, see 'python ModuleCLI.py --help'. Errors are printed instead of raised, like the GUI shows them
+    """
+    args = build_parser().parse_args(argv)
+    try:
+        args.function(args)
+    except Exception as e:
+        print(f"{args.command} failed: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(Main())
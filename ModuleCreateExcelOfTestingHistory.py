@@ -1,62 +1,80 @@
 import configs
-import openpyxl
+import os
+import tempfile
+import threading
+import time
 from pathlib import Path
+import ModuleResultsStore
+import ModuleTracing
 
-def CreateExcelOfTestingHistory(marking_result_folder_override=None, output_override=None):
+# Jobs marking papers at the same time may all export the same excel, so only one export runs at a time
+lock = threading.Lock()
+
+def CreateExcelOfTestingHistory(marking_result_folder_override=None, output_override=None, database_override=None):
     """
     Args:
-        1. marking_result_folder_override: optional argument of type string, pretty much explains itself
+        1. marking_result_folder_override: optional argument of type string, a folder of marking results saved as excel files to import into the database first, see ModuleResultsStore.ImportMarkingResults. Unless database_override is given too, they are imported into a temporary database that is dropped after the export, so that the folder never ends up in the real history
         2. output_override: optional argument of type string, pretty much explains itself
+        3. database_override: optional argument of type string, the database to export from instead of configs.results_database_path
     Return:
-        No return
+        of <class 'str'> the path of the excel file saved
     Process:
-        Create an excel file about the student's testing history, showing the score and grade achieved in each paper, and the AI's comment on the performance of the student, and save to configs.path_to_excel_of_testing_history. Notice that the path of the folder containing all the student's practice paper history is stored in configs.marking_result_folder. Every single file ending with 'xlsx' under that folder should be a marking result save.
+        Create an excel file about the student's testing history, showing the score and grade achieved in each paper, and the AI's comment on the performance of the student, and save to configs.path_to_excel_of_testing_history. The papers are queried from the database of ModuleResultsStore in one go, so no marking result has to be opened, and the excel is only an export made when it is asked for
+        Safe to call from several threads at once, the calls are run one after another
+        Recorded as a "create_excel_of_testing_history" span of ModuleTracing, including the time spent waiting for another call to finish
     """
+    with ModuleTracing.Span("create_excel_of_testing_history") as span:
+        before = time.perf_counter()
+        with lock:
+            span["lock_wait_seconds"] = time.perf_counter()-before
+            if marking_result_folder_override and not database_override:
+                with tempfile.TemporaryDirectory() as tmp_folder:
+                    return create_excel_of_testing_history(marking_result_folder_override, output_override, os.path.join(tmp_folder, "results.sqlite3"), span)
+            return create_excel_of_testing_history(marking_result_folder_override, output_override, database_override, span)
+
+def create_excel_of_testing_history(marking_result_folder_override, output_override, database_override, span):
+    import openpyxl
     # Create a workbook
     wb = openpyxl.Workbook()
     ws = wb.active
-
-    # Find all the marking results
-    marking_result_folder = marking_result_folder_override or configs.marking_result_folder
-    xlsx_files = Path(marking_result_folder).glob('*.xlsx')
+    output = output_override or configs.path_to_excel_of_testing_history
+    if marking_result_folder_override:
+        span["files_read"] = ModuleResultsStore.ImportMarkingResults(marking_result_folder_override, database_override)
 
     # Add all the information needed into the excel of testing history
-    rows = [[]]
-    # first = [] it is not declared outside because this way when the variable is not created by the iteration, a fatal error occurs in our favor
-    for file_path in xlsx_files:
-        print(f"Reading: {file_path}")
-        new, first = DetermineRowsToAdd(file_path)
-        rows.append(new)
-    rows[0] = first
-    print(rows)
-    for row in rows:
-        ws.append(row)
-    print(f"Added a total of {len(rows)} rows")
+    papers = ModuleResultsStore.ListPapers(database_path=database_override)
+    if not papers:
+        raise RuntimeError("No marking result is found in the database")
+    span["papers"] = len(papers)
+    ws.append(list(ModuleResultsStore.summary_columns.values()))
+    for paper in papers:
+        ws.append([paper[key] for key in ModuleResultsStore.summary_columns])
+    print(f"Added a total of {len(papers)+1} rows")
 
-    # Save the excel
-    wb.save(output_override or configs.path_to_excel_of_testing_history)
-    print(f"Excel of testing history saved to {output_override or configs.path_to_excel_of_testing_history}")
-
-def DetermineRowsToAdd(path_to_excel, start_col=9, end_col=15):
-    # Load the marking result
-    wb_obj = openpyxl.load_workbook(str(path_to_excel))
-    sheet_obj = wb_obj.active
-    new_row = [path_to_excel.name]
-    override_row = ["Exam Paper Name"] # This is the first row of the final excel file saved by this module
-    for col in range(start_col, end_col+1):
-        new_row.append(sheet_obj.cell(row=2, column=col).value)
-        override_row.append(sheet_obj.cell(row=1, column=col).value)
-    print(new_row, override_row)
-    return new_row, override_row
+    # Save
+    before = time.perf_counter()
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    wb.save(output)
+    span["save_seconds"] = time.perf_counter()-before
+    print(f"Excel of testing history saved to {output}")
+    return output
 
 # For testing
 if __name__ == "__main__":
-    CreateExcelOfTestingHistory(
-        marking_result_folder_override="test_folder/ModuleCreateExcelOfTestingHistory/history1/",
-        output_override="test_folder/ModuleCreateExcelOfTestingHistory/excel_of_testing_history1.xlsx"
-    )
+    # The marking results of each folder are imported into a database of their own, then exported
+    for idx in (1, 2):
+        database_path = f"test_folder/ModuleCreateExcelOfTestingHistory/history{idx}.sqlite3"
+        for path in Path(database_path).parent.glob(f"history{idx}.sqlite3*"):
+            path.unlink()
+        CreateExcelOfTestingHistory(
+            marking_result_folder_override=f"test_folder/ModuleCreateExcelOfTestingHistory/history{idx}/",
+            output_override=f"test_folder/ModuleCreateExcelOfTestingHistory/excel_of_testing_history{idx}.xlsx",
+            database_override=database_path,
+        )
+    # Running again should not import any marking result, since all of them are in the database already
     CreateExcelOfTestingHistory(
         marking_result_folder_override="test_folder/ModuleCreateExcelOfTestingHistory/history2/",
-        output_override="test_folder/ModuleCreateExcelOfTestingHistory/excel_of_testing_history2.xlsx"
+        output_override="test_folder/ModuleCreateExcelOfTestingHistory/excel_of_testing_history2.xlsx",
+        database_override=database_path,
     )
     print("Check test_folder/ModuleCreateExcelOfTestingHistory/excel_of_testing_history.xlsx for the output")
@@ -0,0 +1,60 @@
+import configs
+import base64
+import io
+
+def DropRedundantPages(b64_imgs, stats=None):
+    """
+    Args:
+        1. b64_imgs: a list or a generator (like ModulePDF2b64s.IterPDF2b64s) of strings, each string being a base 64 image of a page of the student work
+        2. stats (<class 'dict'>): optional, filled in as the pages go by with the keys "pages", "blank_pages", "duplicate_pages", "bytes" and "bytes_saved"
+    Return:
+        a generator of (page_number, b64_img) tuples of the pages kept, page_number being the 1-based number of the page in the original pdf, so that the AI is still told the real page numbers
+    Process:
+        Drop the pages whose pixel variance is below configs.blank_page_max_variance, e.g. the 'BLANK PAGE' sheets of Cambridge papers
+        Drop the pages whose perceptual hash is within configs.duplicate_page_max_distance bits of a page already kept, e.g. identical unanswered answer spaces
+    """
+    stats = {} if stats is None else stats
+    from PIL import Image, ImageStat
+    stats.update({"pages": 0, "blank_pages": 0, "duplicate_pages": 0, "bytes": 0, "bytes_saved": 0})
+    kept_hashes = []
+    page_number = 0
+    for b64_img in b64_imgs:
+        page_number += 1
+        stats["pages"] += 1
+        stats["bytes"] += len(b64_img)
+        img = Image.open(io.BytesIO(base64.b64decode(b64_img))).convert("L")
+        if ImageStat.Stat(img).var[0] < configs.blank_page_max_variance:
+            print(f"Dropping page {page_number}, which is blank")
+            stats["blank_pages"] += 1
+            stats["bytes_saved"] += len(b64_img)
+            continue
+        img_hash = difference_hash(img)
+        if any(bin(img_hash ^ kept_hash).count("1") <= configs.duplicate_page_max_distance for kept_hash in kept_hashes):
+            print(f"Dropping page {page_number}, which duplicates an earlier page")
+            stats["duplicate_pages"] += 1
+            stats["bytes_saved"] += len(b64_img)
+            continue
+        kept_hashes.append(img_hash)
+        yield page_number, b64_img
+
+def difference_hash(img, size=16):
+    # A size*size bit perceptual hash: each bit tells whether a pixel of the shrunk page is brighter than its right neighbour
+    # It survives re-encoding and tiny rendering differences, but not a change in what is written on the page
+    from PIL import Image
+    pixels = img.convert("L").resize((size+1, size), Image.Resampling.LANCZOS).tobytes()
+    img_hash = 0
+    for row in range(size):
+        for col in range(size):
+            if pixels[row*(size+1)+col] > pixels[row*(size+1)+col+1]:
+                img_hash |= 1 << (row*size+col)
+    return img_hash
+
+# For testing
+if __name__ == "__main__":
+    import ModulePDF2b64s
+    stats = {}
+    pdf_path = "test_folder/data/9709_12_2024_MayJune_Mathematics_qp_first_try.pdf"
+    b64_imgs = ModulePDF2b64s.PDF2b64s(pdf_path, profile="student_work")
+    kept = list(DropRedundantPages(b64_imgs+b64_imgs[4:6], stats))
+    print(f"Kept pages: \t{[page_number for page_number, b64_img in kept]}")
+    print(f"Stats: \t{stats}")
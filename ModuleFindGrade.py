@@ -1,72 +1,136 @@
 import configs
 import pydantic
+import bisect
+import contextlib
+import re
 import ModuleLLMQuery
+import ModuleMessages
+import ModuleModelRouter
+import ModulePDF2b64s
+import ModuleTracing
 import time
 
 class Grade(pydantic.BaseModel):
     grade_received: str = pydantic.Field(..., min_length=1, max_length=1)
     custom_error: str = pydantic.Field(..., description="leave empty unless there is a fatal error, the details of which you shall specify here")
 
-def FindGrade(component_number, marking_report, grading_threshold_table_b64imgs):
+def FindGrade(component_number, marking_report, grading_threshold_table_b64imgs=None, threshold_table_page_count=None, threshold_table_path=None):
     """
     Args:
         1. component_number (<class 'num'>)
         2. marking_report (<class 'list'>): a marking report, which is a 3xn (3 rows, n cols) 2D list, where the first column includes quesion numbers, the second column includes Maximum mark possible to be awarded to the question, and the third column includes the marks the student received, e.g. [["3(a)", 10, 9], ["3(b)", 7, 6], ["4", 7, 7]]
-        3. grading_threshold_table_b64imgs (<class 'list'>): A list of strings(each string being a base 64 image)
+        3. grading_threshold_table_b64imgs (<class 'list'>): A list of strings(each string being a base 64 image), or a generator of them like ModulePDF2b64s.IterPDF2b64s. May be None if threshold_table_path is given, in which case the pages are only rendered if the AI is needed
+        4. threshold_table_page_count (<class 'int'>): the number of pages of the threshold table, only needed if grading_threshold_table_b64imgs is a generator
+        5. threshold_table_path (<class 'str'>): path to the threshold table pdf, which allows the grade to be looked up locally from the text layer of the pdf
     Return:
         1. of <class 'int'> the total marks earned
         2. of <class 'int'> the total marks available
         3. of <class 'str'> the grade like 'A', 'B', or 'C'
     Process:
-        Ask the AI to read the grading threshold table for us, and use the marking report and the parsed grading threshold table to determine the grade
+        If the path of the threshold table is given and its text layer contains the row of the component, parse the table locally and look the grade up
+        Otherwise (e.g. for a scanned table without text), ask the AI to read the grading threshold table for us, and use the marking report and the parsed grading threshold table to determine the grade
+        Recorded as a "find_grade" span of ModuleTracing, telling which of the two was used
     """
+    with ModuleTracing.Span("find_grade", method="local") as span:
+        return find_grade(component_number, marking_report, grading_threshold_table_b64imgs, threshold_table_page_count, threshold_table_path, span)
+
+def find_grade(component_number, marking_report, grading_threshold_table_b64imgs, threshold_table_page_count, threshold_table_path, span):
     # Calculate Scores
     total_raw_marks = calculate_total_score(marking_report)
     total_marks_there = calculate_total_score(marking_report, cal_total_avail=True)
+    if threshold_table_path is not None:
+        thresholds = ParseThresholdTable(threshold_table_path).get(normalize_component_number(component_number))
+        if thresholds:
+            print("Found the grade from the text layer of the threshold table")
+            return total_raw_marks, total_marks_there, look_up_grade(thresholds, total_raw_marks)
+        print(f"Component {component_number} is not found in the text layer of the threshold table, falling back to the AI")
     print("Sending request to AI for finding grade")
+    span["method"] = "llm"
     before = time.time()
-    grade = ModuleLLMQuery.LLMQuery(
-        [
-            {"role": "system", "content": "Your job is to look up a table in order to match the score an exam candidate score to their grade. The user will give you a grading threshold table containing information required to do this, as well as the component number of the paper the candidate took and their score received. If the grade the student received passes none of the thresholds in the table, simply award an 'U'"},
-            *generate_image_conversation(grading_threshold_table_b64imgs, "the grading threshold table"),
-            {"role": "user", "content": f"The score the candidate received for component {component_number} is {total_raw_marks}. Now, please use the table to find the grade of the student"}
-        ],
-        response_format=Grade,
-        model="gpt-5-mini",
-    )
+    with contextlib.ExitStack() as stack:
+        # The same threshold table serves every paper of the session, so its pages are held once by ModulePageStore and sent first, right after the system prompt
+        if grading_threshold_table_b64imgs is None:
+            threshold_table_conversation = stack.enter_context(ModuleMessages.DocumentConversation(threshold_table_path, "the grading threshold table", profile="threshold_table"))
+        else:
+            threshold_table_conversation = ModuleMessages.IterImageConversation(grading_threshold_table_b64imgs, "the grading threshold table", threshold_table_page_count)
+        grade = ModuleLLMQuery.LLMQuery(
+            [
+                {"role": "system", "content": "Your job is to look up a table in order to match the score an exam candidate score to their grade. The user will give you a grading threshold table containing information required to do this, as well as the component number of the paper the candidate took and their score received. If the grade the student received passes none of the thresholds in the table, simply award an 'U'"},
+                *threshold_table_conversation,
+                {"role": "user", "content": f"The score the candidate received for component {component_number} is {total_raw_marks}. Now, please use the table to find the grade of the student"}
+            ],
+            response_format=Grade,
+            model=ModuleModelRouter.Models("grading")[0],
+            hedge=True,
+        )
     print(f"The AI responded in {time.time()-before}s")
     # Let the AI raise error for edge cases
     if grade.custom_error:
         raise RuntimeError("The AI raised a fatal error!\n", grade.custom_error)
     return total_raw_marks, total_marks_there, grade.grade_received
 
-# This is copied from ModuleProduceMarkingReport.py, and it is defined twice instead of imported from one module because they might be modified seperately in futural development
-def generate_image_conversation(b64_imgs, name_of_pdf):
-    conversation = []
-    idx = 0
-    for b64_img in b64_imgs:
-        idx += 1
-        conversation.extend([
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": f"This is page {idx}/{len(b64_imgs)} of {name_of_pdf}."},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/{configs.img_extension};base64,{b64_img}"
-                        }
-                    }
-                ]
-            },
-            {
-                "role": "assistant",
-                "content": [
-                    {"type": "text", "text": f"I see, this is page {idx} of {name_of_pdf}."}
-                ]
-            }
-        ])
-    return conversation
+# Parsed threshold tables, keyed by the hash of the pdf so the same table is only parsed once
+threshold_tables = {}
+
+def ParseThresholdTable(threshold_table_path):
+    """
+    Args:
+        1. threshold_table_path (<class 'str'>): path to a threshold table pdf
+    Return:
+        of <class 'dict'>, mapping each component number (<class 'str'>, e.g. "12") to a list of (threshold, grade) tuples sorted by increasing threshold, e.g. {"12": [(12, 'E'), (24, 'D'), (36, 'C'), (49, 'B'), (60, 'A')]}
+        The dict is empty if the pdf has no text layer, e.g. a scanned table
+    Process:
+        Read the text layer of the pdf with pymupdf, and parse the rows starting with 'Component' under the header of grades
+    """
+    key = ModulePDF2b64s.file_hash(threshold_table_path)
+    if key not in threshold_tables:
+        import pymupdf
+        with pymupdf.open(threshold_table_path) as doc:
+            text = "\n".join(page.get_text() for page in doc)
+        threshold_tables[key] = parse_threshold_table_text(text)
+    return threshold_tables[key]
+
+def parse_threshold_table_text(text):
+    # The text comes either as one cell per line or as one row per line depending on how the pdf was made, so it is parsed as a flat list of words
+    # e.g. "Maximum raw mark available A B C D E Component 11 75 50 44 34 23 12 Component 12 75 60 ..."
+    words = text.split()
+    if "Component" not in words:
+        return {}
+    first_row = words.index("Component")
+    # The grades are the run of grade letters right before the first row
+    grades = []
+    idx = first_row-1
+    while idx >= 0 and re.fullmatch(r"A\*|[A-EU]", words[idx]):
+        grades.insert(0, words[idx])
+        idx -= 1
+    if not grades:
+        return {}
+    # Cambridge tables have a column of maximum raw marks before the thresholds
+    has_max_mark_column = "Maximum" in words[:idx+1]
+    width = len(grades)+int(has_max_mark_column)
+    thresholds = {}
+    for idx in range(first_row, len(words)-1):
+        if words[idx] != "Component" or not words[idx+1].isdigit():
+            continue
+        cells = words[idx+2 : idx+2+width][int(has_max_mark_column):]
+        if len(cells) != len(grades):
+            continue
+        # Cells like '–' mean the grade is not awarded for the component
+        row = sorted((int(cell), grade) for cell, grade in zip(cells, grades) if cell.isdigit())
+        if row:
+            thresholds[normalize_component_number(words[idx+1])] = row
+    return thresholds
+
+def normalize_component_number(component_number):
+    # "12", 12 and "9709/12" all refer to component 12
+    return str(component_number).strip().split("/")[-1].lstrip("0") or "0"
+
+def look_up_grade(thresholds, score):
+    # thresholds is sorted by increasing threshold, so the grade is that of the highest threshold not above the score
+    idx = bisect.bisect_right([threshold for threshold, grade in thresholds], score)
+    if idx == 0:
+        return 'U'
+    return thresholds[idx-1][1]
 
 def calculate_total_score(marking_report, cal_total_avail=False):
     total_scores = 0
@@ -117,6 +181,12 @@ if __name__ == "__main__":
 
 
     ]
+    # The local parser first, which should agree with every test without asking the AI
+    for component_number, marking_report, threshold_table, b64_threshold_table in tests_to_run:
+        total_score = calculate_total_score(marking_report)
+        attempt = FindGrade(component_number, marking_report, threshold_table_path="test_folder/data/9709_12_2024_MayJune_Mathematics_tt.pdf")[2]
+        print(f"Local lookup for component {component_number}:\t{'PASSED' if attempt == calculate_correct_grade(total_score, threshold_table) else 'FAILED'}")
+    print()
     idx = 0
     success_count = 0
     total_seconds = 0
@@ -0,0 +1,157 @@
+import configs
+import json
+import re
+from collections import Counter
+from pathlib import Path
+
+import ModulePDF2b64s
+
+# Bump this whenever the indexing changes, so that the indexes saved by an older version are not used
+index_version = 1
+
+part_pattern = re.compile(r"^\(([a-h])\)$")
+subpart_pattern = re.compile(r"^\((i|ii|iii|iv|v|vi|vii|viii|ix|x)\)$")
+question_label_pattern = re.compile(r"^\d{1,2}(\([a-h]\))?(\((i|ii|iii|iv|v|vi|vii|viii|ix|x)\))?$")
+syllabus_pattern = re.compile(r"\b(\d{4})/(\d{2})\b")
+
+def IndexQuestions(question_paper_path, mark_scheme_path):
+    """
+    Args:
+        1. question_paper_path (<class 'str'>): path to a question paper pdf, either blank or completed by the student as long as it has a text layer
+        2. mark_scheme_path (<class 'str'>): path to the mark scheme pdf
+    Return:
+        None if either pdf has no usable text layer or the question labels of the two do not agree, otherwise a <class 'dict'> shaped like the BasicInformation of [EXPERIMENTAL]ModuleProduceMarkingReport, e.g.
+        {"syllabus_code": "9709", "component_number": "12", "questions": [{"question_number": "3(a)", "page_nums_of_statement_of_the_problem_in_qp": [5], "page_nums_of_answer_space_in_qp": [5], "page_nums_in_ms": [9]}, ...], "custom_error": ""}
+    Process:
+        Scan the text layers for question labels such as 3(a)(ii) and work out the pages of each question, so the AI does not have to be asked for them
+        The index of each pdf is saved under configs.question_index_folder by the hash of the pdf, so each document is only scanned once
+    """
+    question_paper_index = load_or_build(question_paper_path, index_question_paper)
+    mark_scheme_index = load_or_build(mark_scheme_path, index_mark_scheme)
+    if not question_paper_index["questions"] or not mark_scheme_index["questions"] or not mark_scheme_index["syllabus_code"]:
+        print("The question index cannot be built from the text layers")
+        return None
+    # A label missed in either pdf would send the wrong pages for a question, so the two have to agree exactly
+    if [question[0] for question in question_paper_index["questions"]] != [question[0] for question in mark_scheme_index["questions"]]:
+        print("The questions found in the question paper and in the mark scheme do not agree")
+        return None
+    questions = []
+    for (question_number, statement_first, answer_first, answer_last), (_, ms_first, ms_last) in zip(question_paper_index["questions"], mark_scheme_index["questions"]):
+        questions.append({
+            "question_number": question_number,
+            "page_nums_of_statement_of_the_problem_in_qp": list(range(statement_first, answer_first+1)),
+            "page_nums_of_answer_space_in_qp": list(range(answer_first, answer_last+1)),
+            "page_nums_in_ms": list(range(ms_first, ms_last+1)),
+        })
+    return {
+        "syllabus_code": mark_scheme_index["syllabus_code"],
+        "component_number": mark_scheme_index["component_number"],
+        "questions": questions,
+        "custom_error": "",
+    }
+
+def CountQuestions(mark_scheme_path):
+    """
+    Args:
+        1. mark_scheme_path (<class 'str'>): path to the mark scheme pdf
+    Return:
+        of <class 'int'> the number of questions marked separately, e.g. 3(a) and 3(b) count as two, or None if the mark scheme has no usable text layer
+    Process:
+        Used to show the progress of the marking, the index is shared with IndexQuestions
+    """
+    return len(load_or_build(mark_scheme_path, index_mark_scheme)["questions"]) or None
+
+def load_or_build(pdf_path, indexer):
+    path = Path(configs.question_index_folder) / f"{indexer.__name__}_{index_version}_{ModulePDF2b64s.file_hash(pdf_path)}.json"
+    if path.exists():
+        with open(path, "r") as f:
+            return json.load(f)
+    import pymupdf
+    with pymupdf.open(pdf_path) as doc:
+        index = indexer(doc)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(index, f)
+    return index
+
+def index_question_paper(doc):
+    # Returns {"questions": [[question_number, page of the start of the question, first page of the answer space, last page of the answer space], ...]}
+    # The question numbers hang in the left margin, while the parts like (a) and (i) start the lines of the body text
+    events = [] # [label, page_number], one per label found, in reading order
+    question = part = None
+    for page_number, page in enumerate(doc, 1):
+        lines = {}
+        for x0, y0, x1, y1, text, block_no, line_no, word_no in page.get_text("words"):
+            lines.setdefault((block_no, line_no), []).append((word_no, x0, y0, text))
+        if not lines:
+            continue
+        body_x = Counter(round(min(words)[1]) for words in lines.values()).most_common(1)[0][0]
+        for words in sorted(lines.values(), key=lambda words: (min(words)[2], min(words)[1])):
+            words.sort()
+            idx = 0
+            word_no, x0, y0, text = words[0]
+            # Questions are numbered 1, 2, 3, ..., which rules out the stray numbers of the formulas
+            if text == str(int(question or 0)+1) and x0 < body_x-10 and 0.05*page.rect.height < y0 < 0.93*page.rect.height:
+                question, part = text, None
+                events.append([question, page_number])
+                idx = 1
+            if question is None:
+                continue
+            if idx < len(words) and part_pattern.match(words[idx][3]):
+                part = words[idx][3]
+                events.append([question+part, page_number])
+                idx += 1
+            if idx < len(words) and subpart_pattern.match(words[idx][3]):
+                events.append([question+(part or "")+words[idx][3], page_number])
+    # Only the leaves are marked, e.g. 3 is dropped when 3(a) follows it
+    questions = []
+    starts = {}
+    for idx, (label, page_number) in enumerate(events):
+        starts.setdefault(re.match(r"\d+", label).group(), page_number)
+        if idx+1 < len(events) and events[idx+1][0].startswith(label+"("):
+            continue
+        # The answer space runs until the next label, including its page, since the label may be halfway down the page
+        answer_last = events[idx+1][1] if idx+1 < len(events) else len(doc)
+        questions.append([label, starts[re.match(r"\d+", label).group()], page_number, answer_last])
+    return {"questions": questions}
+
+def index_mark_scheme(doc):
+    # Returns {"syllabus_code": ..., "component_number": ..., "questions": [[question_number, first page, last page], ...]}
+    # Each page of the table starts with the header 'Question Answer Marks Guidance', right after which comes the question the first row belongs to
+    # Labels with brackets like 3(b) are also recognized further down the page, bare numbers are not, since they are too easily confused with the working
+    syllabus_code = component_number = ""
+    events = [] # [label, page_number, whether the label is the first row of the page]
+    for page_number, page in enumerate(doc, 1):
+        lines = [line.strip() for line in page.get_text().split("\n") if line.strip()]
+        if not syllabus_code:
+            match = syllabus_pattern.search(" ".join(lines))
+            if match:
+                syllabus_code, component_number = match.groups()
+        first_row = None
+        for idx in range(len(lines)-1):
+            if lines[idx] == "Guidance" and question_label_pattern.match(lines[idx+1]):
+                first_row = idx+1
+                break
+        if first_row is None:
+            continue
+        for idx in range(first_row, len(lines)):
+            if idx == first_row or ("(" in lines[idx] and question_label_pattern.match(lines[idx])):
+                if not events or events[-1][0] != lines[idx]:
+                    events.append([lines[idx], page_number, idx == first_row])
+    questions = []
+    for idx, (label, page_number, is_first_row) in enumerate(events):
+        if idx+1 < len(events):
+            next_label, next_page_number, next_is_first_row = events[idx+1]
+            last = next_page_number-1 if next_is_first_row else next_page_number
+        else:
+            last = len(doc)
+        questions.append([label, page_number, max(page_number, last)])
+    return {"syllabus_code": syllabus_code, "component_number": component_number, "questions": questions}
+
+# For testing
+if __name__ == "__main__":
+    basic_information = IndexQuestions("test_folder/data/9709_12_2024_MayJune_Mathematics_qp_first_try.pdf", "test_folder/data/9709_12_2024_MayJune_Mathematics_ms.pdf")
+    print(f"Syllabus code: \t{basic_information['syllabus_code']}")
+    print(f"Component number: \t{basic_information['component_number']}")
+    for question in basic_information["questions"]:
+        print(question)
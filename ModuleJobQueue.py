@@ -0,0 +1,184 @@
+import configs
+import concurrent.futures
+import json
+import os
+import shutil
+import threading
+import time
+import traceback
+import uuid
+from pathlib import Path
+
+import ModuleMarkPaper
+import ModuleProduceFeedbackForStudent
+
+# Statuses a job goes through: queued -> running -> done / failed
+executor = None
+state_lock = threading.Lock()
+
+def SubmitJob(paper_file, answer_file, threshold_file):
+    """
+    Args:
+        1. paper_file (<class 'str'>): path to the completed question paper pdf
+        2. answer_file (<class 'str'>): path to the mark scheme pdf
+        3. threshold_file (<class 'str'>): path to the threshold table pdf
+    Return:
+        of <class 'str'> the id of the job, to be passed to GetJob
+    Process:
+        Copy the pdfs into the folder of the job under configs.job_folder (the uploads of gradio are temporary), save the state of the job and queue it on the worker pool, which runs at most configs.job_workers jobs at a time
+    """
+    job_id = time.strftime("%Y%m%d-%H%M%S-")+uuid.uuid4().hex[:6]
+    job_folder = Path(configs.job_folder) / job_id
+    job_folder.mkdir(parents=True)
+    # The names of the files are kept, since the marking result is saved under the name of the paper
+    paths = {}
+    for key, path in [("paper_file", paper_file), ("answer_file", answer_file), ("threshold_file", threshold_file)]:
+        (job_folder / key).mkdir()
+        paths[key] = str(job_folder / key / os.path.basename(path))
+        shutil.copyfile(path, paths[key])
+    job = {
+        "job_id": job_id,
+        "status": "queued",
+        "paper_name": os.path.basename(paper_file),
+        **paths,
+        "submitted": time.time(),
+        "started": None,
+        "finished": None,
+        "marked_questions": [],
+        "question_count": None,
+        "result": "",
+        "error": "",
+    }
+    save_job(job)
+    get_executor().submit(run_job, job_id)
+    print(f"Job {job_id} queued")
+    return job_id
+
+def GetJob(job_id):
+    """
+    Args:
+        1. job_id (<class 'str'>)
+    Return:
+        of <class 'dict'> the state of the job, with the keys "job_id", "status" ("queued", "running", "done" or "failed"), "paper_name", "submitted", "started", "finished" (seconds since the epoch, or None), "marked_questions" (the rows of the marking report so far, e.g. [["3(a)", 10, 9]], filled in while the job runs), "question_count" (the number of questions expected, or None if unknown), "result" and "error", or None if there is no such job
+    """
+    path = Path(configs.job_folder) / job_id / "job.json"
+    if not path.exists():
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+def ListJobs():
+    # All the jobs, the most recently submitted first
+    jobs = [GetJob(path.parent.name) for path in Path(configs.job_folder).glob("*/job.json")]
+    return sorted((job for job in jobs if job), key=lambda job: job["submitted"], reverse=True)
+
+def ResumeJobs():
+    """
+    Args: No args
+    Return:
+        of <class 'int'> the number of jobs queued again
+    Process:
+        Queue again the jobs that were queued or running when the server stopped, so that no submission is lost over a restart
+    """
+    resumed = 0
+    for job in reversed(ListJobs()): # oldest first
+        if job["status"] in ("queued", "running"):
+            job["status"] = "queued"
+            save_job(job)
+            get_executor().submit(run_job, job["job_id"])
+            resumed += 1
+    if resumed:
+        print(f"Resumed {resumed} unfinished jobs")
+    return resumed
+
+def Progress(job):
+    """
+    Args:
+        1. job (<class 'dict'>): a job as returned by GetJob
+    Return:
+        of <class 'float'> the fraction of the job done, from 0 to 1, counting the questions marked so far
+    """
+    if job["status"] in ("done", "failed"):
+        return 1.0
+    if job["status"] == "queued" or not job["marked_questions"]:
+        return 0.0
+    # Marking takes most of the time, grading, saving and writing the feedback take the rest
+    return 0.9*min(1.0, len(job["marked_questions"])/(job["question_count"] or len(job["marked_questions"])+1))
+
+def get_executor():
+    global executor
+    with state_lock:
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=configs.job_workers, thread_name_prefix="job")
+    return executor
+
+def save_job(job):
+    path = Path(configs.job_folder) / job["job_id"] / "job.json"
+    # Write to a temporary file first so that a restart never finds half a state
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(job, f, indent=4)
+    os.replace(tmp_path, path)
+
+def run_job(job_id):
+    job = GetJob(job_id)
+    job["status"] = "running"
+    job["started"] = time.time()
+    # A resumed job is marked from the start again
+    job["marked_questions"] = []
+    save_job(job)
+    def on_question(question_row, question_count):
+        # Saved as each question finishes, so that the front end can show the marks so far
+        job["marked_questions"].append(question_row)
+        job["question_count"] = question_count
+        save_job(job)
+    try:
+        # Call marking module
+        score, max_score, grade, pros, cons = ModuleMarkPaper.MarkPaper(job["paper_file"], job["answer_file"], job["threshold_file"], on_question=on_question)
+        # Call feedback generation module
+        comment_based_on_history = ModuleProduceFeedbackForStudent.ProduceFeedbackForStudent()
+        job["result"] = format_result(job["paper_file"], job["answer_file"], score, max_score, grade, pros, cons, comment_based_on_history)
+        job["status"] = "done"
+    except Exception as e:
+        traceback.print_exc()
+        job["error"] = f"Processing failed: {str(e)}"
+        job["status"] = "failed"
+    job["finished"] = time.time()
+    save_job(job)
+
+def format_result(paper_file, answer_file, score, max_score, grade, pros, cons, comment_based_on_history):
+    # Format grading result
+    return (
+            f"Grading completed!\n"
+            f"The marking results for completed question papers that you've submitted are kept in {configs.results_database_path}, and a summary of all testing records can be exported to {configs.path_to_excel_of_testing_history} with the Export History button\n"
+            f"Exam Paper: {os.path.basename(paper_file)}\n"
+            f"Reference Answer: {os.path.basename(answer_file)}\n"
+            f"Score: {score}/{max_score}\n"
+            f"Grade: {grade}\n"
+            f"Strengths: {pros}\n"
+            f"Weaknesses: {cons}\n"
+            f"Feedback based on History: {comment_based_on_history}\n"
+    )
+
+# For testing
+if __name__ == "__main__":
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        configs.job_folder = tmp_folder
+        job_id = SubmitJob("test_folder/data/9709_12_2024_MayJune_Mathematics_qp_first_try.pdf", "test_folder/data/9709_12_2024_MayJune_Mathematics_ms.pdf", "test_folder/data/9709_12_2024_MayJune_Mathematics_tt.pdf")
+        def wait_for(job_id):
+            while GetJob(job_id)["status"] not in ("done", "failed"):
+                job = GetJob(job_id)
+                print(f"{job['status']}: \t{Progress(job):.0%}")
+                time.sleep(5)
+            return GetJob(job_id)
+        job = wait_for(job_id)
+        print(f"Finished as {job['status']}: \t{Progress(job):.0%}\n{job['result']}{job['error']}")
+        print(f"Listed: \t{[job['job_id'] for job in ListJobs()] == [job_id]}")
+        # A job left running by a server that stopped is queued again
+        job["status"] = "running"
+        save_job(job)
+        print(f"Resumed: \t{ResumeJobs()} jobs")
+        print(f"Finished again as {wait_for(job_id)['status']}")
+        executor.shutdown()
+    print(f"No such job: \t{GetJob('missing') is None}")
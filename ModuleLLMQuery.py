@@ -1,36 +1,292 @@
 import configs
-import openai
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import json
+import random
+import sqlite3
+import threading
+import time
+import weakref
+from contextlib import closing
+from pathlib import Path
 
-client = openai.OpenAI(
-        base_url = configs.base_url,
-        api_key = configs.api_key, 
-)
+import ModuleTracing
 
-def LLMQuery(messages, response_format=None, model=configs.llm_model):
+# Built by get_client on first use, so that importing this module (e.g. for FindGrade, which mostly needs no AI) does not import openai
+client = None
+client_lock = threading.Lock()
+
+def get_client():
+    global client
+    with client_lock:
+        if client is None:
+            import openai
+            client = openai.OpenAI(
+                    base_url = configs.base_url,
+                    api_key = configs.api_key,
+                    max_retries = 0, # retried by call_with_retries instead, which knows about the deadline
+            )
+    return client
+
+def LLMQuery(messages, response_format=None, model=configs.llm_model, use_cache=None, on_partial=None, timeout=None, hedge=False):
     """
     Args:
         1. messages (<class 'list'>): Message history feeded to the LLM, refer to platform.openai.com for details
         2. response_format (None / Pydantic.BaseModel): Set this to None if you are not using structured output, otherwise set this to the pydantic BaseModel class you're using
         3. model (<class 'str'>): LLM model used
+        4. use_cache (<class 'bool'>): whether to look up/store the response in the response cache at configs.llm_cache_path, configs.llm_cache_enabled is used if this is None
+        5. on_partial: optional function, if given the response is streamed and on_partial is called with the response received so far every time more of it arrives: the text so far if you are NOT using structured output, otherwise a <class 'dict'> of the JSON parsed so far, whose last list element or string may still be incomplete
+        6. timeout (<class 'float'>): the seconds the call may take in total, retries included, configs.llm_timeout_seconds is used if this is None
+        7. hedge (<class 'bool'>): whether to send a duplicate request when the first one is slower than usual and take whichever answers first. Meant for short calls, since the slower request keeps running and is paid for. Ignored when streaming
     Return:
         If you are NOT using strucutred output:
             Return the text response of the AI
         If you are using strucutred output:
             Return the returned pydantic BaseModel instance from the AI
+    Process:
+        Timeouts, dropped connections, 429s and 5xx errors are retried up to configs.llm_max_retries times, after a jittered exponential backoff (or the Retry-After of the server), as long as the deadline allows. A streamed request is only retried if nothing has been received yet
+        The duplicate request of hedging is sent once the first has taken longer than configs.llm_hedge_percentile of the recent requests to the same model for the same response format
+        Recorded as an "llm_query" span of ModuleTracing, with the size of the request, the token counts of the response, the retries and whether it was hedged
     """
+    use_cache = configs.llm_cache_enabled if use_cache is None else use_cache
+    with ModuleTracing.Span("llm_query", model=model, response_format=getattr(response_format, "__name__", None), cache_hit=False, streamed=on_partial is not None, hedged=False) as span:
+        span["request_bytes"] = request_size(messages)
+        if use_cache:
+            key = cache_key(messages, response_format, model)
+            cached = read_from_cache(key, response_format)
+            if cached is not None:
+                span["cache_hit"] = True
+                if on_partial is not None:
+                    # The whole response arrives at once
+                    on_partial(cached if response_format == None else cached.model_dump())
+                return cached
+        deadline = time.monotonic()+(configs.llm_timeout_seconds if timeout is None else timeout)
+        if on_partial is not None:
+            received = []
+            def on_partial_received(partial):
+                received.append(True)
+                on_partial(partial)
+            result = call_with_retries(
+                lambda: stream_llm_query(messages, response_format, model, on_partial_received, span, deadline),
+                deadline, span, can_retry=lambda: not received,
+            )
+        else:
+            query = lambda: query_llm(messages, response_format, model, deadline)
+            completion = call_with_retries((lambda: hedged(query, response_format, model, span)) if hedge else query, deadline, span)
+            result = read_completion(completion, response_format, span)
+        if use_cache:
+            write_to_cache(key, result, response_format)
+    return result
+
+def query_llm(messages, response_format, model, deadline):
+    # One attempt, returning the completion
+    before = time.monotonic()
+    timed_client = get_client().with_options(timeout=seconds_left(deadline))
     if response_format == None:
         # Regular Response
-        completion = client.chat.completions.parse(
+        completion = timed_client.chat.completions.parse(
             model = model,
             messages = messages,
         )
     else:
         # Structured Output
-        completion = client.chat.completions.parse(
+        completion = timed_client.chat.completions.parse(
             model = model,
             messages = messages,
             response_format = response_format,
         )
+    record_latency(model, response_format, time.monotonic()-before)
+    return completion
+
+def stream_llm_query(messages, response_format, model, on_partial, span, deadline):
+    kwargs = {} if response_format == None else {"response_format": response_format}
+    before = time.perf_counter()
+    # The timeout of the client applies to each read, the deadline to the whole stream
+    with get_client().with_options(timeout=seconds_left(deadline)).chat.completions.stream(model=model, messages=messages, stream_options={"include_usage": True}, **kwargs) as stream:
+        for event in stream:
+            if event.type == "content.delta":
+                if "first_token_seconds" not in span:
+                    span["first_token_seconds"] = time.perf_counter()-before
+                on_partial(event.snapshot if response_format == None else (event.parsed or {}))
+            seconds_left(deadline)
+        completion = stream.get_final_completion()
+    return read_completion(completion, response_format, span)
+
+def seconds_left(deadline):
+    seconds = deadline-time.monotonic()
+    if seconds <= 0:
+        raise TimeoutError("The LLM request ran past its deadline")
+    return seconds
+
+def retry_delay(error, attempt):
+    # The seconds to wait before retrying after error, or None if it is not worth retrying
+    import openai
+    if isinstance(error, openai.APIStatusError):
+        if error.status_code not in (408, 409, 429) and error.status_code < 500:
+            return None
+        try:
+            # The server knows best when it will take requests again
+            return min(float(error.response.headers["retry-after"]), configs.llm_retry_max_seconds)
+        except (KeyError, ValueError):
+            pass
+    elif not isinstance(error, openai.APIConnectionError): # timeouts are connection errors too
+        return None
+    # Full jitter, so that the jobs that failed together do not retry together
+    return random.uniform(0, min(configs.llm_retry_max_seconds, configs.llm_retry_base_seconds*2**attempt))
+
+def call_with_retries(function, deadline, span, can_retry=None):
+    attempt = 0
+    while True:
+        try:
+            return function()
+        except Exception as e:
+            delay = retry_delay(e, attempt)
+            if delay is None or attempt >= configs.llm_max_retries or (can_retry and not can_retry()) or time.monotonic()+delay >= deadline:
+                raise
+            attempt += 1
+            span["retries"] = attempt
+            print(f"The LLM request failed ({type(e).__name__}: {e}), retrying in {delay:.1f}s, attempt {attempt}/{configs.llm_max_retries}")
+            time.sleep(delay)
+
+# The seconds recent requests took, by model and response format, to decide when to hedge
+latencies = {}
+latencies_lock = threading.Lock()
+hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix="hedge")
+
+def record_latency(model, response_format, seconds):
+    with latencies_lock:
+        latencies.setdefault((model, getattr(response_format, "__name__", None)), collections.deque(maxlen=configs.llm_hedge_window)).append(seconds)
+
+def hedge_delay(model, response_format):
+    with latencies_lock:
+        samples = sorted(latencies.get((model, getattr(response_format, "__name__", None)), ()))
+    if len(samples) < configs.llm_hedge_min_samples:
+        return configs.llm_hedge_default_seconds
+    return samples[round(configs.llm_hedge_percentile*(len(samples)-1))]
+
+def hedged(query, response_format, model, span):
+    # Run query, and run it again if it has not answered within the hedge delay, returning whichever answers first
+    first = hedge_executor.submit(query)
+    try:
+        return first.result(timeout=hedge_delay(model, response_format))
+    except concurrent.futures.TimeoutError:
+        pass
+    span["hedged"] = True
+    pending = {first, hedge_executor.submit(query)}
+    while pending:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                # The other request cannot be stopped, it finishes in the background and is ignored
+                return future.result()
+    # Both failed, the error of the first is as good as any
+    return first.result()
+
+# The async client and the semaphore belong to the event loop they were created in, so each loop awaiting AsyncLLMQuery (e.g. each asyncio.run of a job thread) gets its own, kept here by the loop
+# A loop that is gone drops its entry, and CloseAsyncClient closes the connections of a loop before it ends
+async_states = weakref.WeakKeyDictionary()
+async_states_lock = threading.Lock()
+
+def get_async_state():
+    loop = asyncio.get_running_loop()
+    with async_states_lock:
+        state = async_states.get(loop)
+        if state is None:
+            import httpx
+            import openai
+            state = async_states[loop] = {
+                "client": openai.AsyncOpenAI(
+                    base_url = configs.base_url,
+                    api_key = configs.api_key,
+                    max_retries = 0, # retried by AsyncLLMQuery itself
+                    # One pooled connection shared by every concurrent request of the loop
+                    http_client = openai.DefaultAsyncHttpxClient(
+                        limits = httpx.Limits(max_connections=configs.llm_max_connections, max_keepalive_connections=configs.llm_max_connections),
+                    ),
+                ),
+                "semaphore": asyncio.Semaphore(configs.llm_max_concurrency),
+            }
+    return state["client"], state["semaphore"]
+
+async def CloseAsyncClient():
+    """
+    Args: No args
+    Return: No return
+    Process:
+        Close the async client of the running loop and forget it, so that its connections are not left open once the loop ends. Await it last in the coroutine given to asyncio.run, e.g. in a finally block
+    """
+    with async_states_lock:
+        state = async_states.pop(asyncio.get_running_loop(), None)
+    if state is not None:
+        await state["client"].close()
+
+async def AsyncLLMQuery(messages, response_format=None, model=configs.llm_model, use_cache=None, timeout=None):
+    """
+    Args:
+        Same as LLMQuery, except that there is no streaming or hedging
+    Return:
+        Same as LLMQuery
+    Process:
+        The asynchronous version of LLMQuery, so that many requests can be awaited at the same time with asyncio.gather
+        At most configs.llm_max_concurrency requests of the same event loop are in flight at once, the rest wait for their turn. Jobs each running their own loop have a cap each. The retries are the same as those of LLMQuery, and the deadline includes the wait for a turn
+    """
+    use_cache = configs.llm_cache_enabled if use_cache is None else use_cache
+    with ModuleTracing.Span("llm_query", model=model, response_format=getattr(response_format, "__name__", None), cache_hit=False, streamed=False, hedged=False) as span:
+        span["request_bytes"] = request_size(messages)
+        if use_cache:
+            key = cache_key(messages, response_format, model)
+            cached = read_from_cache(key, response_format)
+            if cached is not None:
+                span["cache_hit"] = True
+                return cached
+        deadline = time.monotonic()+(configs.llm_timeout_seconds if timeout is None else timeout)
+        async_client, semaphore = get_async_state()
+        before = time.perf_counter()
+        async with semaphore:
+            # The time spent waiting for a turn, which is not the model being slow
+            span["queue_seconds"] = time.perf_counter()-before
+            attempt = 0
+            while True:
+                try:
+                    timed_client = async_client.with_options(timeout=seconds_left(deadline))
+                    if response_format == None:
+                        # Regular Response
+                        completion = await timed_client.chat.completions.parse(
+                            model = model,
+                            messages = messages,
+                        )
+                    else:
+                        # Structured Output
+                        completion = await timed_client.chat.completions.parse(
+                            model = model,
+                            messages = messages,
+                            response_format = response_format,
+                        )
+                    break
+                except Exception as e:
+                    delay = retry_delay(e, attempt)
+                    if delay is None or attempt >= configs.llm_max_retries or time.monotonic()+delay >= deadline:
+                        raise
+                    attempt += 1
+                    span["retries"] = attempt
+                    print(f"The LLM request failed ({type(e).__name__}: {e}), retrying in {delay:.1f}s, attempt {attempt}/{configs.llm_max_retries}")
+                    await asyncio.sleep(delay)
+        result = read_completion(completion, response_format, span)
+        if use_cache:
+            write_to_cache(key, result, response_format)
+    return result
+
+def read_completion(completion, response_format, span=None):
+    # Shared by LLMQuery and AsyncLLMQuery, the token counts are added to the span of the request if given
+    if span is not None and completion.usage is not None:
+        span["prompt_tokens"] = completion.usage.prompt_tokens
+        span["completion_tokens"] = completion.usage.completion_tokens
+        if completion.usage.prompt_tokens_details is not None:
+            span["cached_tokens"] = completion.usage.prompt_tokens_details.cached_tokens or 0
+        if completion.usage.completion_tokens_details is not None:
+            span["reasoning_tokens"] = completion.usage.completion_tokens_details.reasoning_tokens or 0
     message = completion.choices[0].message
     if message.refusal: # Handle Edge Cases
         print(message)
@@ -40,6 +296,52 @@ def LLMQuery(messages, response_format=None, model=configs.llm_model):
     else:
         return message.parsed
 
+def request_size(messages):
+    # The bytes of the messages as sent, which the pages of the pdfs make up nearly all of
+    return len(json.dumps(messages))
+
+def cache_key(messages, response_format, model):
+    # A stable hash of everything that decides the response, the schema is included so that editing a pydantic model never returns stale results
+    schema = None if response_format == None else response_format.model_json_schema()
+    request = json.dumps({"messages": messages, "model": model, "response_format": schema}, sort_keys=True)
+    return hashlib.sha256(request.encode()).hexdigest()
+
+def connect_to_cache():
+    Path(configs.llm_cache_path).parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(configs.llm_cache_path, timeout=30)
+    connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)")
+    connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+    return connection
+
+def read_from_cache(key, response_format):
+    with closing(connect_to_cache()) as connection, connection:
+        row = connection.execute("SELECT value FROM responses WHERE key = ? AND created >= ?", (key, time.time()-configs.llm_cache_ttl_seconds)).fetchone()
+        if row is None:
+            return None
+        # Touch the entry so that it counts as recently used for the eviction
+        connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+    if response_format == None:
+        return row[0]
+    else:
+        return response_format.model_validate_json(row[0])
+
+def write_to_cache(key, result, response_format):
+    value = result if response_format == None else result.model_dump_json()
+    now = time.time()
+    with closing(connect_to_cache()) as connection, connection:
+        connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)", (key, value, len(value), now, now))
+        evict_from_cache(connection)
+
+def evict_from_cache(connection):
+    # Drop the expired entries, then the least recently used ones until the cache is no larger than configs.llm_cache_max_bytes
+    connection.execute("DELETE FROM responses WHERE created < ?", (time.time()-configs.llm_cache_ttl_seconds,))
+    total_bytes = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+    for key, size in connection.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall():
+        if total_bytes <= configs.llm_cache_max_bytes:
+            break
+        connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+        total_bytes -= size
+
 if __name__ == "__main__":
     import pydantic
     result = LLMQuery(
@@ -65,3 +367,20 @@ if __name__ == "__main__":
             f"Solution: \t{result.solution}"
             f"Answer: \t{result.answer}"
     )
+    async def ask_together():
+        try:
+            return await asyncio.gather(*[
+                AsyncLLMQuery(
+                    [
+                        {"role": "system", "content": "You are a helpful math tutor. Guide the user through the solution step by step."},
+                        {"role": "user", "content": f"how can I solve 8x + {constant} = -23"},
+                    ],
+                    response_format=Response,
+                    model="gpt-5-mini",
+                )
+                for constant in range(1, 4)
+            ])
+        finally:
+            await CloseAsyncClient()
+    for result in asyncio.run(ask_together()):
+        print(f"Answer: \t{result.answer}")
@@ -1,11 +1,13 @@
 import configs
 import gradio as gr
-import os
+import time
 from pathlib import Path
 from typing import Tuple, Dict, List
 # Import required modules
-import ModuleMarkPaper
-import ModuleProduceFeedbackForStudent
+import ModuleJobQueue
+import ModuleCreateExcelOfTestingHistory
+import ModuleResultsStore
+import ModuleTracing
 
 
 # Validate uploaded file format
@@ -18,55 +20,96 @@ def validate_file_format(file_path: str) -> Tuple[bool, str]:
     return True, ""
 
 
-# Main processing function (integrated new module calls)
-def process_submission(paper_file: str, answer_file: str, threshold_file: str, progress=gr.Progress()) -> Tuple[str, str, str]:
+# Main processing function (the marking itself runs as a job in the background)
+def process_submission(paper_file: str, answer_file: str, threshold_file: str) -> Tuple[str, str, str]:
     error_msg = ""
 
     # Check if files are fully uploaded
     if not paper_file or not answer_file or not threshold_file:
         error_msg = "Please upload the exam paper, marking scheme and grading threshold table"
-        return "", error_msg
+        return "", error_msg, ""
 
     # Validate file formats
     for file_path in [paper_file, answer_file, threshold_file]:
         valid, msg = validate_file_format(file_path)
         if not valid:
             error_msg = f"File format validation failed: {msg}"
-            return "", error_msg
-
-    progress(0.05, desc="Starting file processing...")
-
-    progress(0.1, desc="Grading in progress...")
+            return "", error_msg, ""
 
     try:
-        # Call marking module
-        score, max_score, grade, pros, cons = ModuleMarkPaper.MarkPaper(paper_file, answer_file, threshold_file)
-        progress(0.8, desc="Generating feedback...")
-
-        # Call feedback generation module
-        comment_based_on_history = ModuleProduceFeedbackForStudent.ProduceFeedbackForStudent()
-
+        job_id = ModuleJobQueue.SubmitJob(paper_file, answer_file, threshold_file)
     except Exception as e:
-        error_msg = f"Processing failed: {str(e)}"
-        return "", error_msg
-
-    progress(0.95, desc="Organizing results...")
-
-    # Format grading result
-    result_str = (
-            f"Grading completed!\n"
-	    f"The marking results for completed question papers that you've submitted may be found at {configs.marking_result_folder}\n6. A summary of all testing records may be found at {configs.path_to_excel_of_testing_history}\n"
-            f"Exam Paper: {os.path.basename(paper_file)}\n"
-            f"Reference Answer: {os.path.basename(answer_file)}\n"
-            f"Score: {score}/{max_score}\n"
-            f"Grade: {grade}\n"
-            f"Strengths: {pros}\n"
-            f"Weaknesses: {cons}\n"
-            f"Feedback based on History: {comment_based_on_history}\n"
-    )
-
-    progress(1.0, desc="Processing completed")
-    return result_str, error_msg
+        error_msg = f"Submission failed: {str(e)}"
+        return "", error_msg, ""
+
+    result_str = f"Submitted as job {job_id}. The results will appear in the job list below, and can be shown with the Show Job button.\n"
+    return result_str, error_msg, job_id
+
+
+# Follow a job, streaming the questions as they are marked until it finishes
+def watch_job(job_id: str, progress=gr.Progress()):
+    if not job_id or not job_id.strip():
+        # Nothing was submitted, keep the error message shown
+        yield gr.skip(), gr.skip(), gr.skip()
+        return
+    job = ModuleJobQueue.GetJob(job_id.strip())
+    if job is None:
+        yield "", f"No job with the id '{job_id}'", []
+        return
+    shown = None
+    # A job whose worker was lost never finishes, so stop following it after a while instead of holding on to the event forever
+    deadline = time.time()+configs.job_watch_max_seconds
+    while True:
+        try:
+            job = ModuleJobQueue.GetJob(job["job_id"])
+        except ValueError as e:
+            yield gr.skip(), f"The state of the job cannot be read: {e}", gr.skip()
+            return
+        if job is None:
+            yield gr.skip(), "The job was removed", gr.skip()
+            return
+        if time.time() > deadline:
+            yield gr.skip(), f"Job {job['job_id']} is still {job['status']} after {configs.job_watch_max_seconds//60} minutes, press Show Job to keep following it", gr.skip()
+            return
+        marked_questions = job["marked_questions"]
+        progress(ModuleJobQueue.Progress(job), desc=f"Job {job['job_id']} is {job['status']}")
+        # Only send an update when something changed
+        if (job["status"], len(marked_questions)) != shown:
+            shown = (job["status"], len(marked_questions))
+            if job["status"] in ("done", "failed"):
+                yield job["result"], job["error"], marked_questions
+                return
+            result_str = f"Job {job['job_id']} is {job['status']}. This should take fewer than 10 minutes.\n"
+            if marked_questions:
+                result_str += (
+                    f"Marked {len(marked_questions)}/{job['question_count'] or '?'} questions so far, "
+                    f"score so far: {sum(row[2] for row in marked_questions)}/{sum(row[1] for row in marked_questions)}\n"
+                )
+            yield result_str, "", marked_questions
+        time.sleep(1)
+
+
+# List the jobs for the job table
+def list_jobs() -> List[List[str]]:
+    def format_time(seconds):
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(seconds)) if seconds else ""
+    return [
+        [job["job_id"], job["paper_name"], job["status"], f"{ModuleJobQueue.Progress(job):.0%}", format_time(job["submitted"]), format_time(job["finished"])]
+        for job in ModuleJobQueue.ListJobs()
+    ]
+
+
+# Fill in the job id when a row of the job table is clicked
+def select_job(evt: gr.SelectData) -> str:
+    return evt.row_value[0]
+
+
+# Export the testing history kept in the database to an excel file for download
+def export_history() -> Tuple[str, str]:
+    try:
+        return ModuleCreateExcelOfTestingHistory.CreateExcelOfTestingHistory(), ""
+    except Exception as e:
+        return None, f"Export failed: {str(e)}"
 
 
 # Create Gradio interface
@@ -87,24 +130,63 @@ def create_gui():
             # Right output area
             with gr.Column(scale=2):
                 result_output = gr.Textbox(label="Grading Result", lines=8)
+                questions_output = gr.Dataframe(label="Marked Questions", headers=["Question", "Max Marks", "Awarded Marks"], interactive=False)
                 error_output = gr.Textbox(label="Error Message", lines=2, interactive=False)
 
+        # Job area
+        gr.Markdown("### Jobs")
+        jobs_table = gr.Dataframe(
+            headers=["Job ID", "Exam Paper", "Status", "Progress", "Submitted", "Finished"],
+            value=list_jobs,
+            interactive=False
+        )
+        with gr.Row():
+            job_id_input = gr.Textbox(label="Job ID", scale=3)
+            check_btn = gr.Button("Show Job", scale=1)
+        # Keep the job table up to date while the jobs run
+        refresh_timer = gr.Timer(5)
+
+        # History area
+        gr.Markdown("### Testing History")
+        with gr.Row():
+            export_btn = gr.Button("Export History to Excel", scale=1)
+            history_file = gr.File(label="Excel of Testing History", interactive=False, scale=3)
+
         # Bind button event
         process_btn.click(
             fn=process_submission,
             inputs=[paper_input, answer_input, threshold_input],
-            outputs=[result_output, error_output]
+            outputs=[result_output, error_output, job_id_input]
+        ).then(fn=list_jobs, outputs=jobs_table).then(
+            fn=watch_job,
+            inputs=job_id_input,
+            outputs=[result_output, error_output, questions_output],
+            # Every teacher follows their own job, which takes minutes, so they must not wait for each other
+            concurrency_limit=None
+        )
+        check_btn.click(
+            fn=watch_job,
+            inputs=job_id_input,
+            outputs=[result_output, error_output, questions_output],
+            # Every teacher follows their own job, which takes minutes, so they must not wait for each other
+            concurrency_limit=None
+        )
+        jobs_table.select(
+            fn=select_job,
+            outputs=job_id_input
         )
+        refresh_timer.tick(fn=list_jobs, outputs=jobs_table)
+        export_btn.click(fn=export_history, outputs=[history_file, error_output])
 
         # Instructions
         gr.Markdown("""
         ### Instructions
         1. Upload the student's completed question paper, marking scheme and grading threshold table
-        2. Click the "Start Processing" button. This should take fewer than 10 minutes.
+        2. Click the "Start Processing" button. The submission is queued as a job at once, and several jobs are marked at the same time. Each job should take fewer than 10 minutes.
         3. The system will validate file formats, and call the grading and feedback generation modules
-        4. Results will be displayed in the right area
-	5. The marking results for completed question papers that you've submitted may be found at """+configs.marking_result_folder+"""
-	6. A summary of all testing records may be found at """+configs.path_to_excel_of_testing_history+"""
+        4. The jobs are listed below the upload area. Click a job, or enter its ID, and click "Show Job" to display its result in the right area. While a job runs, the marks of each question are shown as soon as the question is marked. Jobs are kept across restarts of the system
+	5. The marking results for completed question papers that you've submitted are kept in """+configs.results_database_path+"""
+	6. Click "Export History to Excel" to download a summary of all testing records, which is also saved to """+configs.path_to_excel_of_testing_history+"""
 
         Note: Grading logic is provided by ModuleMarkPaper, and feedback content is generated by ModuleProduceFeedbackForStudent
         """)
@@ -113,5 +195,16 @@ def create_gui():
 
 
 if __name__ == "__main__":
+    # Bring the marking results saved as excel files by older versions into the database, only new files are read
+    ModuleResultsStore.ImportMarkingResults()
+    # Pick up the jobs left unfinished by the last run
+    ModuleJobQueue.ResumeJobs()
+    # Serve the time, tokens and bytes of each stage for Prometheus to scrape
+    if configs.metrics_port:
+        try:
+            ModuleTracing.StartMetricsServer()
+        except OSError as e:
+            # e.g. the port is taken by another copy of the app, which is no reason not to mark
+            print(f"Not serving the metrics on port {configs.metrics_port}: {e}")
     gui = create_gui()
     gui.launch(debug=True)
@@ -3,14 +3,28 @@ import ModulePDF2b64s
 import ModuleProduceMarkingReport
 import ModuleFindGrade
 import ModuleSaveMarkingResultToExcel
+import ModuleCreateExcelOfTestingHistory
+import ModuleDropRedundantPages
+import ModuleIndexQuestions
+import ModuleMessages
+import ModulePageStore
+import ModuleTracing
+import concurrent.futures
 import os
+import time
+from pathlib import Path
 
-def MarkPaper(student_work_path, mark_scheme_path, threshold_table_path):
+def MarkPaper(student_work_path, mark_scheme_path, threshold_table_path, update_summary=True, mark_scheme_b64s=None, threshold_table_b64s=None, page_stats=None, on_question=None):
     """
     Args:
         1. student_work_path (<class 'str'>): path to a completed question paper pdf
         2. mark_scheme_path (<class 'str'>): path to a mark scheme pdf
         3. threshold_table_path (<class 'str'>): path to a threshold table pdf
+        4. update_summary (<class 'bool'>): whether to update the excel of testing history after saving
+        5. mark_scheme_b64s (<class 'list'>): optional, the already rendered pages of the mark scheme. If None, the pages are taken from ModuleMessages.DocumentConversation, which holds them once in ModulePageStore for every paper marked against the mark scheme at the same time
+        6. threshold_table_b64s (<class 'list'>): the already rendered pages of the threshold table, only used if it cannot be read locally
+        7. page_stats (<class 'dict'>): optional, filled in with how many pages and bytes of the student work were dropped, see ModuleDropRedundantPages.DropRedundantPages
+        8. on_question: optional function, called as each question is marked with the row of the question in the marking report (e.g. ["3(a)", 10, 9]) and the number of questions found in the mark scheme (None if it has no text layer), see ModuleProduceMarkingReport.ProduceMarkingReport
     Return:
         1. of <class 'int'> the total marks the student earned
         2. of <class 'int'> the total marks available on the question paper
@@ -19,30 +33,111 @@ def MarkPaper(student_work_path, mark_scheme_path, threshold_table_path):
         5. of <class 'str'> the negative comment
     Process:
         Follow the procedures below:
-            1. Use ModulePDF2b64s.PDF2b64s to convert the pdf files containing student work, mark scheme, and threshold table each to a list of images. Each of the images should be in <class 'str'>, because they are in the form of base 64.
-            2. Call ModuleProduceMarkingReport.ProduceMarkingReport
-            3. Call ModuleFindGrade.FindGrade
-            4. Call ModuleSaveMarkingResultToExcel.SaveMarkingResultToExcel
+            1. Use ModulePDF2b64s.IterPDF2b64s to lazily convert the pdf file containing student work to a stream of images. Each of the images should be in <class 'str'>, because they are in the form of base 64, and each type of document is encoded with its own profile in configs.img_profiles. The pages are only rendered while the messages sent to the AI are built, so the pages are never held twice. The mark scheme and threshold table are shared by many papers, so their pages are held once by ModulePageStore and referenced by the messages of every paper
+            2. Unless configs.drop_redundant_pages is False, drop the blank and duplicate pages of the student work with ModuleDropRedundantPages.DropRedundantPages
+            3. Call ModuleProduceMarkingReport.ProduceMarkingReport, streaming the marked questions to on_question if it is given
+            4. Call ModuleFindGrade.FindGrade, which reads the threshold table locally when it can
+            5. Call ModuleSaveMarkingResultToExcel.SaveMarkingResultToExcel, which keeps the result in the database of ModuleResultsStore
+        Recorded as a "mark_paper" span of ModuleTracing, under which the spans of every stage are nested
     """
-    # Convert to base 64 images
-    print("Converting to base 64.")
-    completed_question_paper_b64s = ModulePDF2b64s.PDF2b64s(student_work_path)
-    mark_scheme_b64s = ModulePDF2b64s.PDF2b64s(mark_scheme_path)
-    threshold_table_b64s = ModulePDF2b64s.PDF2b64s(threshold_table_path)
-    print("Converting done, marking now.")
+    with ModuleTracing.Span("mark_paper", paper=os.path.basename(student_work_path)):
+        return mark_paper(student_work_path, mark_scheme_path, threshold_table_path, update_summary, mark_scheme_b64s, threshold_table_b64s, page_stats, on_question)
+
+def mark_paper(student_work_path, mark_scheme_path, threshold_table_path, update_summary, mark_scheme_b64s, threshold_table_b64s, page_stats, on_question):
+    # Convert to base 64 images, lazily
+    print("Converting to base 64 while marking.")
+    completed_question_paper_b64s = ModulePDF2b64s.IterPDF2b64s(student_work_path, profile="student_work")
+    page_stats = {} if page_stats is None else page_stats
+    if configs.drop_redundant_pages:
+        completed_question_paper_b64s = ModuleDropRedundantPages.DropRedundantPages(completed_question_paper_b64s, page_stats)
 
     # Mark the Paper
-    syllabus_code, component_num, marking_report, strengths, weaknesses = ModuleProduceMarkingReport.ProduceMarkingReport(completed_question_paper_b64s, mark_scheme_b64s)
+    # The pages are rendered while the request is built, so the render_page spans end up under this one
+    with ModuleTracing.Span("produce_marking_report") as span:
+        syllabus_code, component_num, marking_report, strengths, weaknesses = ModuleProduceMarkingReport.ProduceMarkingReport(
+            completed_question_paper_b64s, mark_scheme_b64s,
+            student_work_page_count=ModulePDF2b64s.PageCount(student_work_path),
+            marking_scheme_page_count=ModulePDF2b64s.PageCount(mark_scheme_path),
+            marking_scheme_path=mark_scheme_path if mark_scheme_b64s is None else None,
+            on_question=on_question,
+            question_count=None if on_question is None else ModuleIndexQuestions.CountQuestions(mark_scheme_path),
+        )
+        span["questions"] = len(marking_report)
+    if page_stats:
+        print(f"Dropped {page_stats['blank_pages']} blank and {page_stats['duplicate_pages']} duplicate pages out of {page_stats['pages']}, saving {page_stats['bytes_saved']}/{page_stats['bytes']} bytes.")
     print("Marking done, grading now.")
     # Grade the Paper
-    marks_earned, marks_there, grade = ModuleFindGrade.FindGrade(component_num, marking_report, threshold_table_b64s)
+    # The threshold table is looked up locally, and only rendered if it has no text layer to read from
+    marks_earned, marks_there, grade = ModuleFindGrade.FindGrade(component_num, marking_report, threshold_table_b64s, threshold_table_path=threshold_table_path)
     print("Grading done, saving now.")
     # Save the Result
-    ModuleSaveMarkingResultToExcel.SaveMarkingResultToExcel(os.path.splitext(configs.marking_result_folder+os.path.basename(student_work_path))[0]+".xlsx", syllabus_code, component_num, marking_report, strengths, weaknesses, marks_earned, marks_there, grade)
+    ModuleSaveMarkingResultToExcel.SaveMarkingResultToExcel(os.path.splitext(configs.marking_result_folder+os.path.basename(student_work_path))[0]+".xlsx", syllabus_code, component_num, marking_report, strengths, weaknesses, marks_earned, marks_there, grade, update_summary=update_summary)
     print("Saving done!")
 
     return marks_earned, marks_there, grade, strengths, weaknesses
 
+def MarkPapers(student_work_paths, mark_scheme_path, threshold_table_path, workers=None):
+    """
+    Args:
+        1. student_work_paths (<class 'str'> / <class 'list'>): path to a folder of completed question paper pdfs, or a list of paths to them
+        2. mark_scheme_path (<class 'str'>): path to the mark scheme pdf shared by all the papers
+        3. threshold_table_path (<class 'str'>): path to the threshold table pdf shared by all the papers
+        4. workers (<class 'int'>): the maximum number of papers marked at the same time, configs.batch_workers is used if this is None
+    Return:
+        1. of <class 'list'> one <class 'dict'> per paper, in the order of student_work_paths, with the keys "student_work_path", "seconds", "page_stats" (see MarkPaper), "error" (<class 'str'>, empty unless marking failed) and, if it succeeded, "marks_earned", "marks_there", "grade", "strengths" and "weaknesses"
+        2. of <class 'dict'> the throughput stats with the keys "papers", "succeeded", "failed", "seconds" and "papers_per_minute"
+    Process:
+        Hold the pages of the mark scheme (and of the threshold table, if it cannot be read locally) in ModulePageStore for the whole batch, mark the papers concurrently with MarkPaper without updating the summary, then update the excel of testing history once at the end if configs.excel_exports_enabled
+        A paper failing to be marked does not stop the others
+    """
+    if isinstance(student_work_paths, (str, Path)):
+        student_work_paths = sorted(str(path) for path in Path(student_work_paths).glob("*.pdf"))
+    workers = configs.batch_workers if workers is None else workers
+    before = time.time()
+
+    # Shared documents
+    # Rendered before the workers start and referenced until they are done, so that every paper sends the very same pages, and shares the cached prompt of the provider, without them being evicted in between
+    print("Converting the shared documents to base 64.")
+    with ModulePageStore.SharedDocuments(mark_scheme_path, threshold_table_path):
+
+        def mark(student_work_path):
+            result = {"student_work_path": student_work_path, "error": "", "page_stats": {}}
+            paper_before = time.time()
+            try:
+                result["marks_earned"], result["marks_there"], result["grade"], result["strengths"], result["weaknesses"] = MarkPaper(
+                    student_work_path, mark_scheme_path, threshold_table_path,
+                    update_summary=False, page_stats=result["page_stats"],
+                )
+            except Exception as e:
+                print(f"Marking {student_work_path} failed: {e}")
+                result["error"] = str(e)
+            result["seconds"] = time.time()-paper_before
+            return result
+
+        print(f"Marking {len(student_work_paths)} papers with {workers} workers.")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            results = list(executor.map(mark, student_work_paths))
+
+    # The results are in the database already, the excel is only an export
+    if configs.excel_exports_enabled:
+        print("Marking done, updating the excel file of testing history.")
+        ModuleCreateExcelOfTestingHistory.CreateExcelOfTestingHistory()
+
+    seconds = time.time()-before
+    succeeded = sum(1 for result in results if not result["error"])
+    stats = {
+        "papers": len(results),
+        "succeeded": succeeded,
+        "failed": len(results)-succeeded,
+        "seconds": seconds,
+        "papers_per_minute": len(results)/seconds*60 if seconds else 0,
+    }
+    print(f"Marked {succeeded}/{len(results)} papers in {seconds}s.")
+    cached_token_ratio = ModuleMessages.CachedTokenRatio()
+    if cached_token_ratio is not None:
+        print(f"{cached_token_ratio:.0%} of the prompt tokens sent so far were served from the prompt cache of the provider.")
+    return results, stats
+
 if __name__ == "__main__":
     score, score_there, grade, positive, negative = MarkPaper("test_folder/data/9709_12_2024_MayJune_Mathematics_qp_with_less_answers.pdf", "test_folder/data/9709_12_2024_MayJune_Mathematics_ms.pdf", "test_folder/data/9709_12_2024_MayJune_Mathematics_tt.pdf")
     score, score_there, grade, positive, negative = MarkPaper("test_folder/data/9709_12_2024_MayJune_Mathematics_qp.pdf", "test_folder/data/9709_12_2024_MayJune_Mathematics_ms.pdf", "test_folder/data/9709_12_2024_MayJune_Mathematics_tt.pdf")
@@ -54,3 +149,13 @@ if __name__ == "__main__":
         f"Weaknesses: \t{negative}\n"
     )
     print("No fatal error occured. Please go and check the excel file outputted by ModuleSaveMarkingResultToExcel, which should be under {configs.student_work_path}")
+
+    # Batch marking, the mark scheme and threshold table are shared by all the papers
+    results, stats = MarkPapers(
+        ["test_folder/data/9709_12_2024_MayJune_Mathematics_qp_first_try.pdf", "test_folder/data/9709_12_2024_MayJune_Mathematics_qp_second_try.pdf"],
+        "test_folder/data/9709_12_2024_MayJune_Mathematics_ms.pdf",
+        "test_folder/data/9709_12_2024_MayJune_Mathematics_tt.pdf",
+    )
+    for result in results:
+        print(f"{result['student_work_path']}: \t{result.get('marks_earned')}/{result.get('marks_there')} {result.get('grade')} {result['error']}")
+    print(f"Throughput: \t{stats['papers_per_minute']} papers per minute")
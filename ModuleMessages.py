@@ -0,0 +1,89 @@
+import configs
+import contextlib
+
+import ModulePageStore
+import ModulePDF2b64s
+import ModuleTracing
+
+def ImageConversation(b64_imgs, name_of_pdf, page_count=None):
+    """
+    Args:
+        1. b64_imgs: a list of base 64 images, or a generator of them like ModulePDF2b64s.IterPDF2b64s, in which case page_count must be given. The elements may also be (page_number, b64_img) tuples like those yielded by ModuleDropRedundantPages.DropRedundantPages, so that the AI is told the original page numbers, and the images may be data urls already, like those of ModulePageStore.Document, which are then put in the messages as they are instead of copied
+        2. name_of_pdf (<class 'str'>): what the pages are, e.g. "the marking scheme"
+        3. page_count (<class 'int'>): the number of pages of the pdf
+    Return:
+        of <class 'list'> the 'messages' that show the AI all the pages in the right ORDER, a user message with the image of each page followed by an assistant message acknowledging it
+    """
+    return list(IterImageConversation(b64_imgs, name_of_pdf, page_count))
+
+def IterImageConversation(b64_imgs, name_of_pdf, page_count=None):
+    # Lazy version of ImageConversation, the pages of a generator are only rendered as the messages are taken
+    if page_count is None:
+        page_count = len(b64_imgs)
+    idx = 0
+    for b64_img in b64_imgs:
+        idx += 1
+        if isinstance(b64_img, tuple):
+            idx, b64_img = b64_img
+        url = b64_img if b64_img.startswith("data:") else ModulePDF2b64s.DataUrl(b64_img)
+        yield {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": f"This is page {idx}/{page_count} of {name_of_pdf}."},
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": url
+                    }
+                }
+            ]
+        }
+        yield {
+            "role": "assistant",
+            "content": [
+                {"type": "text", "text": f"I see, this is page {idx} of {name_of_pdf}."}
+            ]
+        }
+
+@contextlib.contextmanager
+def DocumentConversation(pdf_path, name_of_pdf, profile="default"):
+    """
+    Args:
+        1. pdf_path (<class 'str'>): path to a pdf shared by many requests, like a mark scheme or a threshold table
+        2. name_of_pdf (<class 'str'>): what the pages are, e.g. "the marking scheme"
+        3. profile (<class 'str'>): the name of the encoding profile in configs.img_profiles
+    Return:
+        of <class 'list'> the same as ImageConversation for all the pages of the pdf
+    Process:
+        Use as 'with ModuleMessages.DocumentConversation(path, "the marking scheme", profile="mark_scheme") as conversation:', and send the requests inside the with block
+        The pages are taken from ModulePageStore.Document, which holds them once for every job and keeps them from being evicted until the with block ends. Only the small dicts of the messages are built per request, referencing the same strings
+        Every request showing the document thus sends exactly the same bytes, which lets the provider reuse its cached prompt
+    """
+    with ModulePageStore.Document(pdf_path, profile) as urls:
+        yield ImageConversation(urls, name_of_pdf)
+
+def CachedTokenRatio():
+    """
+    Args: No args
+    Return:
+        of <class 'float'> the fraction of the prompt tokens the provider served from its prompt cache, over every LLMQuery and AsyncLLMQuery of this process so far, or None if no usage has been reported yet
+    Process:
+        Read from the totals of the "llm_query" spans of ModuleTracing, which add up the usage of each completion
+    """
+    totals = ModuleTracing.metrics.get("llm_query", {})
+    if not totals.get("prompt_tokens"):
+        return None
+    return totals.get("cached_tokens", 0)/totals["prompt_tokens"]
+
+# For testing
+if __name__ == "__main__":
+    import time
+    mark_scheme_path = "test_folder/data/9709_12_2024_MayJune_Mathematics_ms.pdf"
+    before = time.time()
+    with DocumentConversation(mark_scheme_path, "the marking scheme", profile="mark_scheme") as conversation:
+        print(f"Built {len(conversation)} messages in {time.time()-before}s")
+        before = time.time()
+        with DocumentConversation(mark_scheme_path, "the marking scheme", profile="mark_scheme") as again:
+            print(f"Built again: \t{again == conversation} in {time.time()-before}s, sharing the pages: {again[0]['content'][1]['image_url']['url'] is conversation[0]['content'][1]['image_url']['url']}")
+    print(f"Page store: \t{ModulePageStore.Stats()}")
+    print(f"Cached token ratio: \t{CachedTokenRatio()}")
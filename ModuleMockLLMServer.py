@@ -0,0 +1,194 @@
+import configs
+import hashlib
+import http.server
+import json
+import random
+import threading
+import time
+
+# The responses of the stand-in server, by the name of the pydantic model asked for
+# Any other structured output gets a response filled in from its JSON schema, and a request without one gets canned_text
+canned_payloads = {
+    "MarkingReport": {
+        "syllabus_code": "9709",
+        "component_number": "12",
+        "questions": [
+            {
+                "question_number": question_number,
+                "marking_note": "The candidate followed the method of the marking scheme, with a slip in the final answer.",
+                "grading_points": [
+                    {"grading_point_type": "M", "marks_worth": 1, "marks_earned": 1},
+                    {"grading_point_type": "A", "marks_worth": 1, "marks_earned": 0},
+                    {"grading_point_type": "B", "marks_worth": 2, "marks_earned": 2},
+                ],
+                "max_marks": 4,
+                "awarded_marks": 3,
+            }
+            for question_number in ["1", "2(a)", "2(b)", "3", "4(a)", "4(b)", "5", "6(a)", "6(b)", "7", "8", "9(a)", "9(b)", "10"]
+        ],
+        "strengths": "Confident with algebraic manipulation and differentiation.",
+        "weaknesses": "Loses accuracy marks through arithmetic slips in the final steps.",
+        "custom_error": "",
+    },
+    "Grade": {"grade_received": "B", "custom_error": ""},
+    "Comment": {
+        "detailed_comment_on_student_performance": "The student scores steadily, with most marks lost to accuracy rather than method. Checking the final answers would raise the grade.",
+        "rolling_summary": "Scores steadily around grade B, losing accuracy marks rather than method marks.",
+        "custom_error": "",
+    },
+}
+canned_text = "This is a canned response of the stand-in server."
+
+def StartMockLLMServer(latency=2.0, jitter=0.5, port=0):
+    """
+    Args:
+        1. latency (<class 'float'>): the mean seconds the server takes to answer a request
+        2. jitter (<class 'float'>): the latency of each request is drawn uniformly from latency-jitter to latency+jitter
+        3. port (<class 'int'>): the port to listen on, 0 picks a free one
+    Return:
+        of <class 'http.server.ThreadingHTTPServer'> the server, already serving from a background thread, with the attribute base_url to set configs.base_url to. Call its shutdown() to stop it
+    Process:
+        A stand-in for an OpenAI-compatible /chat/completions endpoint, answering every request with canned_payloads after the latency, so that the throughput of the pipeline can be measured without spending real API calls
+        Streamed requests get the response in chunks, the first one after a fifth of the latency and the rest spread over the remainder
+        The usage reported is estimated at 4 bytes per token
+        Prompt caching is simulated like the OpenAI API does it: the longest run of leading messages already seen in an earlier request counts as cached, in blocks of 128 tokens and only from 1024 tokens up
+    """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), MockLLMHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.jitter = jitter
+    server.request_count = 0
+    server.seen_prefixes = set()
+    server.base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    threading.Thread(target=server.serve_forever, name="mock-llm", daemon=True).start()
+    return server
+
+class MockLLMHandler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive, so that the connection pools of the clients behave like they would against the real API
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        request_body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self.path.endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        request = json.loads(request_body)
+        self.server.request_count += 1
+        payload = payload_for(request.get("response_format"))
+        content = payload if isinstance(payload, str) else json.dumps(payload)
+        usage = {
+            "prompt_tokens": len(request_body)//4,
+            "completion_tokens": len(content)//4,
+            "total_tokens": len(request_body)//4+len(content)//4,
+            "prompt_tokens_details": {"cached_tokens": self.cached_tokens(request.get("messages", []))},
+        }
+        delay = max(0.0, self.server.latency+random.uniform(-self.server.jitter, self.server.jitter))
+        if request.get("stream"):
+            self.stream_response(request["model"], content, usage, delay)
+        else:
+            time.sleep(delay)
+            self.send_json({
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request["model"],
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content, "refusal": None}}],
+                "usage": usage,
+            })
+
+    def cached_tokens(self, messages):
+        # The hash of every run of leading messages is remembered, the hash of each run extending the one before it
+        prefix_hash = hashlib.sha256()
+        prefix_bytes = 0
+        cached_bytes = 0
+        for message in messages:
+            message = json.dumps(message, sort_keys=True).encode()
+            prefix_hash.update(message)
+            prefix_bytes += len(message)
+            digest = prefix_hash.hexdigest()
+            if digest in self.server.seen_prefixes:
+                cached_bytes = prefix_bytes
+            self.server.seen_prefixes.add(digest)
+        cached_tokens = cached_bytes//4//128*128
+        return cached_tokens if cached_tokens >= 1024 else 0
+
+    def stream_response(self, model, content, usage, delay):
+        chunks = [content[idx:idx+64] for idx in range(0, len(content), 64)]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        time.sleep(delay*0.2)
+        for chunk in chunks:
+            self.send_event({"choices": [{"index": 0, "delta": {"content": chunk}, "finish_reason": None}]}, model)
+            time.sleep(delay*0.8/len(chunks))
+        self.send_event({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}, model)
+        self.send_event({"choices": [], "usage": usage}, model)
+        self.send_chunk(b"data: [DONE]\n\n")
+        self.send_chunk(b"")
+
+    def send_event(self, event, model):
+        event = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": model, **event}
+        self.send_chunk(f"data: {json.dumps(event)}\n\n".encode())
+
+    def send_chunk(self, data):
+        # One chunk of the chunked transfer encoding, an empty one ends the response
+        self.wfile.write(f"{len(data):x}\r\n".encode()+data+b"\r\n")
+        self.wfile.flush()
+
+    def send_json(self, body):
+        body = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # One line per request would drown the output of the benchmarks
+        pass
+
+def payload_for(response_format):
+    if not response_format or response_format.get("type") != "json_schema":
+        return canned_text
+    json_schema = response_format["json_schema"]
+    if json_schema["name"] in canned_payloads:
+        return canned_payloads[json_schema["name"]]
+    return fill_schema(json_schema["schema"], json_schema["schema"].get("$defs", {}))
+
+def fill_schema(schema, definitions):
+    # A value of the shape the schema asks for, e.g. for the models of [EXPERIMENTAL]ModuleProduceMarkingReport
+    if "$ref" in schema:
+        return fill_schema(definitions[schema["$ref"].split("/")[-1]], definitions)
+    if "anyOf" in schema:
+        return fill_schema(schema["anyOf"][0], definitions)
+    schema_type = schema.get("type")
+    if schema_type == "object":
+        return {key: fill_schema(value, definitions) for key, value in schema.get("properties", {}).items()}
+    if schema_type == "array":
+        return [fill_schema(schema.get("items", {}), definitions)]
+    if schema_type == "integer":
+        return 1
+    if schema_type == "number":
+        return 1.0
+    if schema_type == "boolean":
+        return False
+    if schema_type == "null":
+        return None
+    # Strings are left empty, since custom_error has to be
+    return ""
+
+# For testing
+if __name__ == "__main__":
+    import openai
+    import pydantic
+    server = StartMockLLMServer(latency=0.5, jitter=0.1)
+    client = openai.OpenAI(base_url=server.base_url, api_key=configs.api_key)
+    class Answer(pydantic.BaseModel):
+        solution: str
+        answer: int
+    before = time.time()
+    completion = client.chat.completions.parse(model="gpt-5-mini", messages=[{"role": "user", "content": "how can I solve 8x + 7 = -23"}], response_format=Answer)
+    print(f"Structured: \t{completion.choices[0].message.parsed} in {time.time()-before}s, usage {completion.usage}")
+    print(f"Text: \t{client.chat.completions.create(model='gpt-5-mini', messages=[{'role': 'user', 'content': 'hi'}]).choices[0].message.content}")
+    server.shutdown()
@@ -0,0 +1,103 @@
+import configs
+
+import ModuleTracing
+
+def Models(task):
+    """
+    Args:
+        1. task (<class 'str'>): the kind of call, one of the keys of configs.llm_models, e.g. "marking" or "grading"
+    Return:
+        of <class 'list'> the models to use for the task, cheapest first. Only the first is used unless the result fails the local checks
+    """
+    return configs.llm_models[task]
+
+def CheckMarkedQuestion(question):
+    """
+    Args:
+        1. question: a marked question, like a ModuleProduceMarkingReport.Question or an [EXPERIMENTAL]ModuleProduceMarkingReport.MarkedQuestion, with the attributes max_marks, awarded_marks and grading_points
+    Return:
+        of <class 'list'> the problems found, each a <class 'str'>, empty if the marking is consistent
+    Process:
+        Checks that cost nothing and catch a careless model: the marks awarded must be within the marks available, and must add up to the marks earned on the grading points. Questions without grading points only get the first check
+    """
+    problems = []
+    if not 0 <= question.awarded_marks <= question.max_marks:
+        problems.append(f"{question.awarded_marks} marks were awarded out of {question.max_marks}")
+    if question.grading_points:
+        earned = sum(grading_point.marks_earned for grading_point in question.grading_points)
+        if earned != question.awarded_marks:
+            problems.append(f"the grading points earn {earned} marks but {question.awarded_marks} were awarded")
+        for grading_point in question.grading_points:
+            if not 0 <= grading_point.marks_earned <= grading_point.marks_worth:
+                problems.append(f"{grading_point.marks_earned} marks were earned on a {grading_point.grading_point_type}{grading_point.marks_worth}")
+    return problems
+
+def Cascade(task, query, check, first_tier=0):
+    """
+    Args:
+        1. task (<class 'str'>): the key of the models to try in configs.llm_models
+        2. query: a function taking a model name and returning the result of asking it
+        3. check: a function taking a result and returning the list of problems found, like CheckMarkedQuestion
+        4. first_tier (<class 'int'>): the index of the first model to try, e.g. 1 when the cheapest model has already been asked
+    Return:
+        the result of the first model whose result passes check, or the result of the strongest model if none does
+    Process:
+        Recorded as a "cascade" span of ModuleTracing, with the number of models tried
+    """
+    models = Models(task)[first_tier:]
+    with ModuleTracing.Span("cascade", task=task) as span:
+        for tier, model in enumerate(models, 1):
+            span["models_tried"] = tier
+            result = query(model)
+            problems = check(result)
+            if not problems:
+                return result
+            if tier < len(models):
+                print(f"Escalating from {model} to {models[tier]}: {'; '.join(problems)}")
+        print(f"The strongest model for {task} still gave an inconsistent result: {'; '.join(problems)}")
+        return result
+
+async def AsyncCascade(task, query, check, first_tier=0):
+    """
+    Args:
+        Same as Cascade, except that query returns an awaitable
+    Return:
+        Same as Cascade
+    """
+    models = Models(task)[first_tier:]
+    with ModuleTracing.Span("cascade", task=task) as span:
+        for tier, model in enumerate(models, 1):
+            span["models_tried"] = tier
+            result = await query(model)
+            problems = check(result)
+            if not problems:
+                return result
+            if tier < len(models):
+                print(f"Escalating from {model} to {models[tier]}: {'; '.join(problems)}")
+        print(f"The strongest model for {task} still gave an inconsistent result: {'; '.join(problems)}")
+        return result
+
+# For testing
+if __name__ == "__main__":
+    import asyncio
+    from ModuleProduceMarkingReport import GradingPoint, Question
+    def question(awarded_marks, marks_earned, max_marks=3):
+        grading_points = [GradingPoint(grading_point_type="M", marks_worth=1, marks_earned=min(1, marks_earned)), GradingPoint(grading_point_type="A", marks_worth=2, marks_earned=max(0, marks_earned-1))]
+        return Question(question_number="1(a)", marking_note="", grading_points=grading_points, max_marks=max_marks, awarded_marks=awarded_marks)
+    print(f"Consistent: \t{CheckMarkedQuestion(question(2, 2))}")
+    print(f"More than the maximum: \t{CheckMarkedQuestion(question(4, 3))}")
+    print(f"Not the sum of the grading points: \t{CheckMarkedQuestion(question(3, 2))}")
+    # The first model gives an inconsistent result, the second a consistent one, and the third is never asked
+    configs.llm_models = {**configs.llm_models, "test": ["cheap", "middle", "strong"]}
+    results = {"cheap": question(3, 2), "middle": question(2, 2), "strong": question(1, 1)}
+    asked = []
+    def query(model):
+        asked.append(model)
+        return results[model]
+    print(f"Cascade: \t{Cascade('test', query, CheckMarkedQuestion) is results['middle']}, asked {asked}")
+    asked.clear()
+    async def async_query(model):
+        return query(model)
+    print(f"AsyncCascade: \t{asyncio.run(AsyncCascade('test', async_query, CheckMarkedQuestion)) is results['middle']}, asked {asked}")
+    asked.clear()
+    print(f"Cascade from the second tier: \t{Cascade('test', query, CheckMarkedQuestion, first_tier=1) is results['middle']}, asked {asked}")
@@ -1,30 +1,264 @@
 import configs
-import pymupdf
 import base64
+import concurrent.futures
+import hashlib
+import io
+import json
+import os
+import time
+from pathlib import Path
 
-def PDF2b64s(pdf_path):
+import ModuleTracing
+
+# Counters of the page cache, only kept for the lifetime of the process
+cache_stats = {"hits": 0, "misses": 0}
+
+def PDF2b64s(pdf_path, use_cache=True, workers=None, profile="default"):
     """
     Args:
         1. pdf_path (<class 'str'>)
+        2. use_cache (<class 'bool'>): whether to look up/store the rendered pages in the page cache under configs.page_cache_folder
+        3. workers (<class 'int'>): number of processes rendering the pages, configs.render_workers is used if this is None, and 1 means rendering in this process
+        4. profile (<class 'str'>): the name of the encoding profile in configs.img_profiles, e.g. "mark_scheme" or "student_work"
     Return:
         an instance of <class 'list'>, each element being a <class 'str'>, which is a base 64 image converted from a page in the pdf
     Process:
         Convert the pdf into base 64 images, and the base 64 images should be stored in a bunch of <class 'str'>
+        The cache is keyed by the content of the pdf plus the render parameters, so the same mark scheme or threshold table is only rasterized once no matter how many scripts are marked against it
+        With more than one worker, the pages are split into contiguous ranges, each rendered by a process opening its own copy of the pdf, and the ranges are joined back in page order
+        Recorded as a "pdf2b64s" span of ModuleTracing, with a "render_page" span per page rendered
     """
-    doc = pymupdf.open(pdf_path)
+    with ModuleTracing.Span("pdf2b64s", profile=profile, cache_hit=False) as span:
+        b64_imgs = pdf_to_b64s(pdf_path, use_cache, workers, profile, span)
+        span["pages"] = len(b64_imgs)
+        span["bytes"] = sum(len(b64_img) for b64_img in b64_imgs)
+    return b64_imgs
+
+def pdf_to_b64s(pdf_path, use_cache, workers, profile, span):
+    profile = configs.img_profiles[profile]
+    if use_cache:
+        key = cache_key(pdf_path, profile)
+        b64_imgs = read_from_cache(key)
+        if b64_imgs is not None:
+            cache_stats["hits"] += 1
+            span["cache_hit"] = True
+            return b64_imgs
+        cache_stats["misses"] += 1
+
+    workers = configs.render_workers if workers is None else workers
+    page_count = PageCount(pdf_path)
+    workers = max(1, min(workers, page_count))
+    if workers == 1:
+        b64_imgs = render_page_range(pdf_path, 0, page_count, profile)
+    else:
+        # Split the pages into one contiguous range per worker, the first few ranges taking one extra page if it does not divide evenly
+        bounds = [page_count*i//workers for i in range(workers+1)]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(render_page_range, pdf_path, bounds[i], bounds[i+1], profile) for i in range(workers)]
+            b64_imgs = []
+            for future in futures: # in submission order, which is page order
+                b64_imgs.extend(future.result())
+
+    if use_cache:
+        write_to_cache(key, b64_imgs)
+    return b64_imgs
+
+def IterPDF2b64s(pdf_path, use_cache=True, profile="default"):
+    """
+    Args:
+        1. pdf_path (<class 'str'>)
+        2. use_cache (<class 'bool'>): whether to look up/store the rendered pages in the page cache under configs.page_cache_folder
+        3. profile (<class 'str'>): the name of the encoding profile in configs.img_profiles
+    Return:
+        a generator of <class 'str'>, each being a base 64 image converted from a page in the pdf, in page order
+    Process:
+        The lazy version of PDF2b64s, each page is yielded as soon as it is encoded (or read from the page cache), so a consumer that does not keep the pages around only ever holds one of them
+        Use PageCount to know the number of pages beforehand
+    """
+    profile = configs.img_profiles[profile]
+    if use_cache:
+        key = cache_key(pdf_path, profile)
+        f = open_cache_entry(key)
+        if f is not None:
+            cache_stats["hits"] += 1
+            with f:
+                for line in f:
+                    yield line.rstrip("\n")
+            return
+        cache_stats["misses"] += 1
+
+    def render_pages():
+        import pymupdf
+        with pymupdf.open(pdf_path) as doc:
+            for page_num in range(len(doc)):
+                yield render_page(doc, page_num, profile)
+
+    if use_cache:
+        yield from tee_to_cache(key, render_pages())
+    else:
+        yield from render_pages()
+
+def PageCount(pdf_path):
+    import pymupdf
+    with pymupdf.open(pdf_path) as doc:
+        return len(doc)
+
+def render_page_range(pdf_path, start, stop, profile):
+    # Render the pages [start, stop) of a pdf, this runs inside the worker processes so it opens the pdf by itself
+    import pymupdf
     b64_imgs = []
-    
-    for page_num in range(len(doc)):
-        page = doc.load_page(page_num)
-        # set to better resolution for better OCR by AI
-        mat = pymupdf.Matrix(1.5, 1.5)  # scaling to make it clearer
-        pix = page.get_pixmap(matrix=mat)
-        img_data = pix.tobytes(configs.img_extension)
-        b64_imgs.append(base64.b64encode(img_data).decode('utf-8'))
-    
-    doc.close()
+    with pymupdf.open(pdf_path) as doc:
+        for page_num in range(start, stop):
+            b64_imgs.append(render_page(doc, page_num, profile))
     return b64_imgs
 
+def render_page(doc, page_num, profile):
+    # Render a page according to an encoding profile, see configs.img_profiles
+    # The rasterizing and the encoding are timed apart, since the profiles mostly change the cost of the latter
+    import pymupdf
+    with ModuleTracing.Span("render_page", format=profile["format"]) as span:
+        before = time.perf_counter()
+        page = doc.load_page(page_num)
+        colorspace = pymupdf.csGRAY if profile["grayscale"] else pymupdf.csRGB
+        pix = page.get_pixmap(dpi=profile["dpi"], colorspace=colorspace)
+        span["rasterize_seconds"] = time.perf_counter()-before
+        before = time.perf_counter()
+        b64_img = encode_pixmap(pix, profile)
+        span["encode_seconds"] = time.perf_counter()-before
+        span["bytes"] = len(b64_img)
+    return b64_img
+
+def encode_pixmap(pix, profile):
+    if profile["format"] == "png" and not profile["colors"]:
+        img_data = pix.tobytes("png")
+    elif profile["format"] == "jpeg" and not profile["colors"]:
+        img_data = pix.tobytes("jpeg", jpg_quality=profile["quality"])
+    else:
+        # WebP and palette reduction are not supported by pymupdf, so PIL does the encoding
+        from PIL import Image
+        img = Image.frombytes("L" if profile["grayscale"] else "RGB", (pix.width, pix.height), pix.samples)
+        if profile["colors"]:
+            img = img.quantize(colors=profile["colors"])
+            if profile["format"] != "png":
+                img = img.convert("L" if profile["grayscale"] else "RGB") # jpeg and webp cannot store a palette
+        buffer = io.BytesIO()
+        if profile["quality"] is None:
+            img.save(buffer, format=profile["format"])
+        else:
+            img.save(buffer, format=profile["format"], quality=profile["quality"])
+        img_data = buffer.getvalue()
+    return base64.b64encode(img_data).decode('utf-8')
+
+def MimeType(b64_img):
+    """
+    Args:
+        1. b64_img (<class 'str'>): a base 64 image returned by PDF2b64s or IterPDF2b64s
+    Return:
+        of <class 'str'> the mime type of the image, e.g. "image/png", to be put in the data url sent to the AI
+    Process:
+        The pages of different profiles are encoded differently, so the format is read from the signature at the start of the image
+    """
+    header = base64.b64decode(b64_img[:16])
+    if header.startswith(b"\x89PNG"):
+        return "image/png"
+    if header.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if header.startswith(b"RIFF") and header[8:12] == b"WEBP":
+        return "image/webp"
+    return f"image/{configs.img_extension}"
+
+def DataUrl(b64_img):
+    """
+    Args:
+        1. b64_img (<class 'str'>): a base 64 image returned by PDF2b64s or IterPDF2b64s
+    Return:
+        of <class 'str'> the data url of the image, as put in the messages sent to the AI
+    """
+    return f"data:{MimeType(b64_img)};base64,{b64_img}"
+
+def file_hash(path):
+    # sha256 of the content of a file, read in chunks so large scans do not have to fit in memory twice
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024*1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def cache_key(pdf_path, profile):
+    # The render parameters are part of the key, so changing them never returns stale images
+    render_params = json.dumps(profile, sort_keys=True)
+    return hashlib.sha256(f"{file_hash(pdf_path)};{render_params}".encode()).hexdigest()
+
+def cache_path(key):
+    return Path(configs.page_cache_folder) / f"{key}.b64"
+
+def open_cache_entry(key):
+    # Each entry stores one base 64 image per line, so it can be read back a page at a time
+    path = cache_path(key)
+    try:
+        f = open(path, "r")
+    except FileNotFoundError:
+        return None
+    # Touch the entry so that it counts as recently used for the eviction
+    os.utime(path)
+    return f
+
+def read_from_cache(key):
+    f = open_cache_entry(key)
+    if f is None:
+        return None
+    with f:
+        return [line.rstrip("\n") for line in f]
+
+def tee_to_cache(key, b64_imgs):
+    # Yield the pages of b64_imgs while writing them into the cache entry of key
+    folder = Path(configs.page_cache_folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    # Write to a temporary file first so that a reader never sees half an entry
+    tmp_path = folder / f"{key}.{os.getpid()}.{id(b64_imgs)}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            for b64_img in b64_imgs:
+                f.write(b64_img+"\n")
+                yield b64_img
+        os.replace(tmp_path, cache_path(key))
+    finally:
+        # Only left behind if the consumer stopped early or rendering failed
+        tmp_path.unlink(missing_ok=True)
+    evict_from_cache()
+
+def write_to_cache(key, b64_imgs):
+    for _ in tee_to_cache(key, b64_imgs):
+        pass
+
+def evict_from_cache(max_bytes=None):
+    """
+    Args:
+        1. max_bytes (<class 'int'>): the size cap of the page cache, configs.page_cache_max_bytes is used if this is None
+    Return:
+        of <class 'int'> the number of entries evicted
+    Process:
+        Delete the least recently used entries until the page cache is no larger than the cap
+    """
+    max_bytes = configs.page_cache_max_bytes if max_bytes is None else max_bytes
+    entries = []
+    for path in Path(configs.page_cache_folder).glob("*.b64"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    total_bytes = sum(size for mtime, size, path in entries)
+    evicted = 0
+    for mtime, size, path in entries:
+        if total_bytes <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        total_bytes -= size
+        evicted += 1
+    return evicted
+
 # For testing
 if __name__ == "__main__":
     print("Converting")
@@ -36,6 +270,11 @@ if __name__ == "__main__":
     with open("test_folder/ModulePDF2b64s/first_page2.png", "wb") as f:
         f.write(base64.b64decode(b64_imgs[0]))
     print("First page saved\n")
+
+    print("Converting again, this time from the page cache")
+    b64_imgs_cached = PDF2b64s("test_folder/ModulePDF2b64s/original1.pdf")
+    assert b64_imgs_cached == PDF2b64s("test_folder/ModulePDF2b64s/original1.pdf", use_cache=False)
+    print(f"Page cache hits: {cache_stats['hits']}, misses: {cache_stats['misses']}\n")
     
     print("Converting")
     b64_imgs = PDF2b64s("test_folder/ModulePDF2b64s/original2.pdf")
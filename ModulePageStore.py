@@ -0,0 +1,124 @@
+import configs
+import collections
+import contextlib
+import threading
+
+import ModulePDF2b64s
+
+# The pages of every document held, by the hash of the pdf and the name of the profile, least recently used first
+# Each entry is a dict with the keys "urls" (the data url of each page), "bytes", "refs" (the number of users holding it), "ready" (a threading.Event set once the pages are rendered) and "error" (the exception rendering raised, if any)
+documents = collections.OrderedDict()
+documents_lock = threading.Lock()
+# Counters of the page store, only kept for the lifetime of the process
+store_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+@contextlib.contextmanager
+def Document(pdf_path, profile="default"):
+    """
+    Args:
+        1. pdf_path (<class 'str'>): path to a pdf shared by many requests, like a mark scheme or a threshold table
+        2. profile (<class 'str'>): the name of the encoding profile in configs.img_profiles
+    Return:
+        of <class 'list'> the data url of each page (e.g. "data:image/webp;base64,..."), ready to be put in the messages sent to the AI. The list and its strings are shared by every user of the document, so it must not be changed
+    Process:
+        Use as 'with ModulePageStore.Document(path, profile="mark_scheme") as urls:'
+        Every page of a document is held once in this process, however many jobs are marking against it at the same time. The first user renders it with ModulePDF2b64s.PDF2b64s (so the page cache on disk is used), and the others wait for it instead of rendering it again
+        A document is referenced while a user is inside the with block. Once the pages held add up to more than configs.page_store_max_bytes, the least recently used documents nobody references are dropped. Referenced documents are never dropped, so the cap may be exceeded while they are all in use
+    """
+    key = (ModulePDF2b64s.file_hash(pdf_path), profile)
+    with documents_lock:
+        entry = documents.get(key)
+        owner = entry is None
+        if owner:
+            store_stats["misses"] += 1
+            entry = {"urls": None, "bytes": 0, "refs": 0, "ready": threading.Event(), "error": None}
+            documents[key] = entry
+        else:
+            store_stats["hits"] += 1
+            documents.move_to_end(key)
+        entry["refs"] += 1
+    try:
+        if owner:
+            # Rendered outside the lock, so that the documents of other jobs can still be looked up meanwhile
+            try:
+                entry["urls"] = [ModulePDF2b64s.DataUrl(b64_img) for b64_img in ModulePDF2b64s.PDF2b64s(pdf_path, profile=profile)]
+                entry["bytes"] = sum(len(url) for url in entry["urls"])
+            except BaseException as e:
+                entry["error"] = e
+                raise
+            finally:
+                entry["ready"].set()
+        else:
+            entry["ready"].wait()
+            if entry["error"] is not None:
+                raise RuntimeError(f"Rendering {pdf_path} failed in another job: {entry['error']}")
+        yield entry["urls"]
+    finally:
+        with documents_lock:
+            entry["refs"] -= 1
+            if entry["error"] is not None and documents.get(key) is entry:
+                # Failed renders are not kept, the next user tries again
+                del documents[key]
+            evict()
+
+@contextlib.contextmanager
+def SharedDocuments(mark_scheme_path, threshold_table_path):
+    """
+    Args:
+        1. mark_scheme_path (<class 'str'>): the mark scheme shared by a batch of papers
+        2. threshold_table_path (<class 'str'>): the threshold table shared by the batch
+    Return: No return
+    Process:
+        Use as 'with ModulePageStore.SharedDocuments(mark_scheme_path, threshold_table_path):' around the marking of a batch, so that every paper sends the very same pages, and shares the cached prompt of the provider, without them being evicted in between
+        The mark scheme is held with Document, and so is the threshold table unless ModuleFindGrade can read it locally. Whatever was taken is released if a later step raises
+    """
+    # Imported here, since ModuleFindGrade imports this module through ModuleMessages
+    import ModuleFindGrade
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(Document(mark_scheme_path, profile="mark_scheme"))
+        if not ModuleFindGrade.ParseThresholdTable(threshold_table_path):
+            stack.enter_context(Document(threshold_table_path, profile="threshold_table"))
+        yield
+
+def evict(max_bytes=None):
+    # Drop the least recently used documents nobody references until the store is within the cap, documents_lock must be held
+    max_bytes = configs.page_store_max_bytes if max_bytes is None else max_bytes
+    total_bytes = sum(entry["bytes"] for entry in documents.values())
+    for key, entry in list(documents.items()):
+        if total_bytes <= max_bytes:
+            break
+        if entry["refs"] == 0 and entry["ready"].is_set():
+            del documents[key]
+            total_bytes -= entry["bytes"]
+            store_stats["evictions"] += 1
+
+def Stats():
+    """
+    Args: No args
+    Return:
+        of <class 'dict'> the state of the page store, with the keys "documents", "pages", "bytes", "referenced" (the documents in use right now), "hits", "misses" and "evictions"
+    """
+    with documents_lock:
+        return {
+            "documents": len(documents),
+            "pages": sum(len(entry["urls"] or ()) for entry in documents.values()),
+            "bytes": sum(entry["bytes"] for entry in documents.values()),
+            "referenced": sum(1 for entry in documents.values() if entry["refs"]),
+            **store_stats,
+        }
+
+# For testing
+if __name__ == "__main__":
+    import concurrent.futures
+    mark_scheme_path = "test_folder/data/9709_12_2024_MayJune_Mathematics_ms.pdf"
+    def use(idx):
+        with Document(mark_scheme_path, profile="mark_scheme") as urls:
+            return id(urls), len(urls)
+    # Four jobs at once share a single copy of the pages
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        print(f"Shared by every job: \t{len(set(executor.map(use, range(4)))) == 1}")
+    print(f"Stats: \t{Stats()}")
+    # Nobody holds the document any more, so a cap of 0 drops it
+    with documents_lock:
+        evict(0)
+    print(f"Stats after evicting: \t{Stats()}")
@@ -0,0 +1,252 @@
+import configs
+import itertools
+import os
+import queue
+import threading
+import time
+
+import ModuleCreateExcelOfTestingHistory
+import ModuleDropRedundantPages
+import ModuleFindGrade
+import ModuleMessages
+import ModulePageStore
+import ModulePDF2b64s
+import ModuleProduceMarkingReport
+import ModuleSaveMarkingResultToExcel
+import ModuleTracing
+
+# The stage stats of every pipeline running now, by the id of its run, read by the gauges of ModuleTracing. A run is dropped once it is done
+active_runs = {}
+run_ids = itertools.count(1)
+stage_stats_lock = threading.Lock()
+# Put on the queue of a stage once per worker, after the last item, to tell the workers to stop
+end = object()
+
+def RunPipeline(items, stages, queue_size=None, on_done=None, run_stats=None):
+    """
+    Args:
+        1. items (<class 'list'>): the items to process, each a <class 'dict'> passed from stage to stage, which the stages fill in
+        2. stages (<class 'list'>): the stages, in order, each a (name, function, workers) tuple. function is called with an item, and workers is the number of threads running it
+        3. queue_size (<class 'int'>): the most items waiting in front of each stage, configs.pipeline_queue_size is used if this is None
+        4. on_done: optional function, called with each item as it leaves the last stage, failed or not. If it raises, the error is recorded in the item like that of a stage
+        5. run_stats (<class 'dict'>): optional, filled in with the stats of each stage of this run by the name of the stage, to be read with Stats while it runs and after
+    Return:
+        of <class 'list'> items, once every item has been through every stage
+    Process:
+        Each stage takes the items from its own queue and puts them on the queue of the next, so the stages work on different items at the same time, e.g. the next paper is rendered while the AI marks the last one
+        The queues are bounded, so a stage faster than the next one waits for room instead of piling up items (and the pages they hold), and the items are only fed in as fast as the first stage takes them
+        A stage raising records "error" in the item, which then goes past the later stages untouched, so one failing item does not stop the others
+        Each call is recorded as a "pipeline_<name>" span of ModuleTracing. Every run keeps stats of its own, so several pipelines can run at once in a process, each shown by the gauges of ModuleTracing while it runs
+    """
+    queue_size = max(1, configs.pipeline_queue_size if queue_size is None else queue_size)
+    queues = [queue.Queue(maxsize=queue_size) for stage in stages]
+    started = time.time()
+    run_stats = {} if run_stats is None else run_stats
+    for (name, function, workers), stage_queue in zip(stages, queues):
+        run_stats[name] = {"workers": workers, "running": workers, "busy": 0, "processed": 0, "failed": 0, "busy_seconds": 0.0, "blocked_seconds": 0.0, "queue": stage_queue, "started": started, "finished": None}
+    run_id = next(run_ids)
+    with stage_stats_lock:
+        active_runs[run_id] = run_stats
+
+    def work(idx):
+        name, function, workers = stages[idx]
+        stats = run_stats[name]
+        try:
+            while True:
+                item = queues[idx].get()
+                if item is end:
+                    break
+                if not item.get("error"):
+                    with stage_stats_lock:
+                        stats["busy"] += 1
+                    before = time.perf_counter()
+                    try:
+                        with ModuleTracing.Span(f"pipeline_{name}"):
+                            function(item)
+                    except Exception as e:
+                        print(f"The {name} stage failed: {e}")
+                        item["error"] = f"{name}: {e}"
+                        with stage_stats_lock:
+                            stats["failed"] += 1
+                    finally:
+                        with stage_stats_lock:
+                            stats["busy"] -= 1
+                            stats["processed"] += 1
+                            stats["busy_seconds"] += time.perf_counter()-before
+                if idx+1 < len(stages):
+                    # Blocks while the next stage is behind, which is the backpressure
+                    before = time.perf_counter()
+                    queues[idx+1].put(item)
+                    with stage_stats_lock:
+                        stats["blocked_seconds"] += time.perf_counter()-before
+                elif on_done is not None:
+                    try:
+                        on_done(item)
+                    except Exception as e:
+                        print(f"Finishing an item failed: {e}")
+                        item["error"] = item.get("error") or f"on_done: {e}"
+        finally:
+            # The last worker of a stage to stop tells the workers of the next stage to stop, even if this one died, so that the run still ends
+            with stage_stats_lock:
+                stats["running"] -= 1
+                last = stats["running"] == 0
+                if last:
+                    stats["finished"] = time.time()
+            if last and idx+1 < len(stages):
+                for worker in range(stages[idx+1][2]):
+                    queues[idx+1].put(end)
+
+    threads = [
+        threading.Thread(target=work, args=(idx,), name=f"pipeline_{name}_{worker}", daemon=True)
+        for idx, (name, function, workers) in enumerate(stages)
+        for worker in range(workers)
+    ]
+    try:
+        for thread in threads:
+            thread.start()
+        for item in items:
+            queues[0].put(item)
+        for worker in range(stages[0][2]):
+            queues[0].put(end)
+        for thread in threads:
+            thread.join()
+    finally:
+        with stage_stats_lock:
+            del active_runs[run_id]
+    return items
+
+def Stats(run_stats=None):
+    """
+    Args:
+        1. run_stats (<class 'dict'>): the stats of a run filled in by RunPipeline. If None, the stats of every pipeline running now are returned, by the id of the run
+    Return:
+        of <class 'dict'> the state of each stage of the run, by the name of the stage, in order. Each is a <class 'dict'> with the keys "workers", "queue_depth" (the items waiting in front of the stage), "busy" (the workers working on an item right now), "processed", "failed", "utilization" (the fraction of the time its workers have been busy so far, from 0 to 1) and "blocked_seconds" (the time its workers waited for room in the queue of the next stage)
+    """
+    if run_stats is None:
+        with stage_stats_lock:
+            runs = dict(active_runs)
+        return {run_id: Stats(run_stats) for run_id, run_stats in runs.items()}
+    now = time.time()
+    with stage_stats_lock:
+        return {
+            name: {
+                "workers": stats["workers"],
+                "queue_depth": stats["queue"].qsize(),
+                "busy": stats["busy"],
+                "processed": stats["processed"],
+                "failed": stats["failed"],
+                "utilization": stats["busy_seconds"]/(stats["workers"]*max((stats["finished"] or now)-stats["started"], 1e-9)),
+                "blocked_seconds": stats["blocked_seconds"],
+            }
+            for name, stats in run_stats.items()
+        }
+
+def stage_gauge(key):
+    return lambda: {f'run="{run_id}",stage="{name}"': stats[key] for run_id, stages in Stats().items() for name, stats in stages.items()}
+
+ModuleTracing.gauges["marking_pipeline_queue_depth"] = stage_gauge("queue_depth")
+ModuleTracing.gauges["marking_pipeline_busy_workers"] = stage_gauge("busy")
+ModuleTracing.gauges["marking_pipeline_utilization"] = stage_gauge("utilization")
+
+def MarkPapers(student_work_paths, mark_scheme_path, threshold_table_path, workers=None, queue_size=None):
+    """
+    Args:
+        1. student_work_paths, mark_scheme_path, threshold_table_path: the same as ModuleMarkPaper.MarkPapers
+        2. workers (<class 'dict'>): the number of workers of each stage, by the name of the stage ("render", "mark", "grade" and "persist"). The stages left out take theirs from configs.pipeline_workers
+        3. queue_size (<class 'int'>): see RunPipeline
+    Return:
+        1. of <class 'list'> the same as ModuleMarkPaper.MarkPapers
+        2. of <class 'dict'> the same as ModuleMarkPaper.MarkPapers, plus "stages", the Stats of each stage once they are all done
+    Process:
+        Mark the papers like ModuleMarkPaper.MarkPapers, with the steps of ModuleMarkPaper.MarkPaper split into stages run by RunPipeline:
+            1. render: convert the student work to base 64 images and drop its redundant pages, which keeps the CPU busy
+            2. mark: ModuleProduceMarkingReport.ProduceMarkingReport, which mostly waits for the AI, so it has the most workers
+            3. grade: ModuleFindGrade.FindGrade
+            4. persist: ModuleSaveMarkingResultToExcel.SaveMarkingResultToExcel, without updating the summary, which is exported once at the end if configs.excel_exports_enabled
+        The pages of a paper are held from the render stage until it is marked, so the bounded queues also cap how many papers' pages are held at once. The shared documents are held in ModulePageStore for the whole batch
+    """
+    from pathlib import Path
+    if isinstance(student_work_paths, (str, Path)):
+        student_work_paths = sorted(str(path) for path in Path(student_work_paths).glob("*.pdf"))
+    workers = {**configs.pipeline_workers, **(workers or {})}
+    before = time.time()
+
+    # Shared documents, as in ModuleMarkPaper.MarkPapers
+    print("Converting the shared documents to base 64.")
+    with ModulePageStore.SharedDocuments(mark_scheme_path, threshold_table_path):
+
+        jobs = [
+            {"student_work_path": str(path), "mark_scheme_path": mark_scheme_path, "threshold_table_path": threshold_table_path, "error": "", "page_stats": {}}
+            for path in student_work_paths
+        ]
+        def on_done(job):
+            job["seconds"] = time.time()-job.get("started", before)
+            print(f"Done with {os.path.basename(job['student_work_path'])} {job['error']}")
+
+        stages = [(name, function, max(1, workers[name])) for name, function in [("render", render), ("mark", mark), ("grade", grade), ("persist", persist)]]
+        print(f"Marking {len(jobs)} papers with {', '.join(f'{count} {name}' for name, function, count in stages)} workers.")
+        run_stats = {}
+        RunPipeline(jobs, stages, queue_size, on_done, run_stats)
+
+    if configs.excel_exports_enabled:
+        print("Marking done, updating the excel file of testing history.")
+        ModuleCreateExcelOfTestingHistory.CreateExcelOfTestingHistory()
+
+    results = [
+        {key: job[key] for key in ["student_work_path", "seconds", "page_stats", "error", "marks_earned", "marks_there", "grade", "strengths", "weaknesses"] if key in job}
+        for job in jobs
+    ]
+    seconds = time.time()-before
+    succeeded = sum(1 for result in results if not result["error"])
+    stats = {
+        "papers": len(results),
+        "succeeded": succeeded,
+        "failed": len(results)-succeeded,
+        "seconds": seconds,
+        "papers_per_minute": len(results)/seconds*60 if seconds else 0,
+        "stages": Stats(run_stats),
+    }
+    print(f"Marked {succeeded}/{len(results)} papers in {seconds}s.")
+    for name, stage in stats["stages"].items():
+        print(f"{name}: \t{stage['workers']} workers, {stage['utilization']:.0%} busy, {stage['blocked_seconds']:.1f}s waiting for the next stage")
+    cached_token_ratio = ModuleMessages.CachedTokenRatio()
+    if cached_token_ratio is not None:
+        print(f"{cached_token_ratio:.0%} of the prompt tokens sent so far were served from the prompt cache of the provider.")
+    return results, stats
+
+def render(job):
+    job["started"] = time.time()
+    b64_imgs = ModulePDF2b64s.IterPDF2b64s(job["student_work_path"], profile="student_work")
+    if configs.drop_redundant_pages:
+        b64_imgs = ModuleDropRedundantPages.DropRedundantPages(b64_imgs, job["page_stats"])
+    job["pages"] = list(b64_imgs)
+    job["page_count"] = ModulePDF2b64s.PageCount(job["student_work_path"])
+
+def mark(job):
+    # The pages are dropped as soon as the paper is marked, failed or not
+    pages = job.pop("pages")
+    job["syllabus_code"], job["component_number"], job["marking_report"], job["strengths"], job["weaknesses"] = ModuleProduceMarkingReport.ProduceMarkingReport(
+        pages, None,
+        student_work_page_count=job["page_count"],
+        marking_scheme_page_count=ModulePDF2b64s.PageCount(job["mark_scheme_path"]),
+        marking_scheme_path=job["mark_scheme_path"],
+    )
+
+def grade(job):
+    job["marks_earned"], job["marks_there"], job["grade"] = ModuleFindGrade.FindGrade(job["component_number"], job["marking_report"], threshold_table_path=job["threshold_table_path"])
+
+def persist(job):
+    save_path = os.path.splitext(configs.marking_result_folder+os.path.basename(job["student_work_path"]))[0]+".xlsx"
+    ModuleSaveMarkingResultToExcel.SaveMarkingResultToExcel(save_path, job["syllabus_code"], job["component_number"], job["marking_report"], job["strengths"], job["weaknesses"], job["marks_earned"], job["marks_there"], job["grade"], update_summary=False)
+
+# For testing
+if __name__ == "__main__":
+    results, stats = MarkPapers(
+        ["test_folder/data/9709_12_2024_MayJune_Mathematics_qp_first_try.pdf", "test_folder/data/9709_12_2024_MayJune_Mathematics_qp_second_try.pdf"],
+        "test_folder/data/9709_12_2024_MayJune_Mathematics_ms.pdf",
+        "test_folder/data/9709_12_2024_MayJune_Mathematics_tt.pdf",
+    )
+    for result in results:
+        print(f"{result['student_work_path']}: \t{result.get('marks_earned')}/{result.get('marks_there')} {result.get('grade')} {result['error']}")
+    print(f"Throughput: \t{stats['papers_per_minute']} papers per minute")
+    print(ModuleTracing.PrometheusText())
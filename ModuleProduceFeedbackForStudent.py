@@ -1,80 +1,168 @@
 import configs
 import pydantic
-import openpyxl
 import json
 import time
 import ModuleLLMQuery
+import ModuleModelRouter
+import ModuleReadExcel
+import ModuleResultsStore
+import ModuleTracing
 
 class Comment(pydantic.BaseModel):
     detailed_comment_on_student_performance: str
+    rolling_summary: str = pydantic.Field(..., description="a compact summary of the student's performance on every paper seen so far, including the previous summary if one was given, in at most 200 words. It will be given back to you instead of these papers the next time")
     custom_error: str = pydantic.Field(..., description="explanation for any fatal error you want to raise. unless a fatal error is what you want to raise, leave this field empty")
 
 def history_to_json(p2e):
-    # Read history excel file
+    # Read history excel file, all the rows at once
     path_to_history = p2e
-    wb_obj = openpyxl.load_workbook(path_to_history)
-    sheet_obj = wb_obj.active
+    sheet_rows = ModuleReadExcel.ReadRows(path_to_history)
     # Find all the names of the columns
     keys = []
-    right_most_col = 0
-    col = 1
-    while True:
-        val = sheet_obj.cell(row=1, column=col).value
+    for val in (sheet_rows[0] if sheet_rows else ()):
         if val:
             keys.append(val)
         else:
             break
-        right_most_col += 1
-        col += 1
+    right_most_col = len(keys)
     # Find all the values under each column, generating a 'dicts'
     # 'dicts' could look like the following example
     # dicts = [{"col1":11, "col2":21}, {"col1":12, "col2":22}]
+    # Like before, the first empty row is included as the last element
     dicts = []
-    row = 2
-    while True:
-        dicts.append({})
-        all_empty = True
-        for col in range(1, right_most_col+1):
-            value = sheet_obj.cell(row=row, column=col).value
-            if value:
-                all_empty = False
-            dicts[-1][keys[col-1]] = sheet_obj.cell(row=row, column=col).value
-        if all_empty:
+    for values in sheet_rows[1:]+[()]:
+        values = (tuple(values)+(None,)*right_most_col)[:right_most_col]
+        dicts.append(dict(zip(keys, values)))
+        if not any(values):
             break
-        row += 1
     # Return with json's dumps, making it AI-readable
     return json.dumps(dicts, indent=4)
 
-def ProduceFeedbackForStudent(p2e=configs.path_to_excel_of_testing_history):
+def compact_history(papers):
+    # One short row per paper, with the names of the columns given once, instead of an indented dict per paper
+    return json.dumps({"columns": list(ModuleResultsStore.summary_columns.values()), "rows": [compact_row(paper) for paper in papers]}, separators=(",", ":"), ensure_ascii=False)
+
+def compact_row(paper):
+    # The comments on each paper are cut short, the marks and grades carry most of the history
+    return [value[:configs.feedback_comment_max_chars] if isinstance(value, str) else value for value in (paper[key] for key in ModuleResultsStore.summary_columns)]
+
+def estimate_tokens(text):
+    # Around 4 characters a token, close enough to keep a request within the budget without calling a tokenizer
+    return len(text)//4+1
+
+def fit_to_budget(papers, budget):
+    # Split the papers, oldest first, into runs whose compact history fits the budget, each with at least one paper
+    # The size of a run is added up row by row, which is what compact_history joins them into
+    runs = [[]]
+    tokens = header_tokens = estimate_tokens(compact_history([]))
+    for paper in papers:
+        row_tokens = estimate_tokens(json.dumps(compact_row(paper), separators=(",", ":"), ensure_ascii=False))
+        if runs[-1] and tokens+row_tokens > budget:
+            runs.append([])
+            tokens = header_tokens
+        runs[-1].append(paper)
+        tokens += row_tokens
+    return runs
+
+def ProduceFeedbackForStudent(p2e=None, database_path=None, student=None, rebuild=False):
     """
     Args:
-        1. p2e: of <class 'str'>
+        1. p2e: of <class 'str'>, optional path to an excel file of testing history, in which case the whole of it is sent at once and nothing is kept
+        2. database_path: of <class 'str'>, the database of ModuleResultsStore to query, configs.results_database_path is used if this is None
+        3. student: of <class 'str'>, whose papers to comment on, configs.student_name is used if this is None
+        4. rebuild: of <class 'bool'>, whether to forget the rolling summary and go through the whole history of the student again
     Return:
         of <class 'str'>, a summary of a student's performance
     Process:
-        use the information stored in an excel file containing the history of tests that the student has taken to ask an AI to give comment
+        A rolling summary of the papers already commented on is kept per student with ModuleResultsStore.SaveFeedback, so only the summary and the papers saved since the last call are sent to the AI, which gives back the comment and the new summary. If no paper was saved since, the last comment is returned without asking the AI
+        The papers are sent as compact JSON, and if they do not fit configs.feedback_token_budget, the oldest are folded into the summary first over several requests
+        Recorded as a "produce_feedback" span of ModuleTracing, with the number of papers and requests sent
     """
+    with ModuleTracing.Span("produce_feedback", rebuild=rebuild) as span:
+        if p2e:
+            span["requests"] = 1
+            comment, rolling_summary = ask_for_comment(history_to_json(p2e))
+            return comment
+        return produce_feedback_for_student(database_path, student, rebuild, span)
+
+def produce_feedback_for_student(database_path, student, rebuild, span):
     print("Fetching history")
-    history_in_json = history_to_json(p2e)
-    print("Done fetching, now asking AI to give comments")
+    student = configs.student_name if student is None else student
+    feedback = None if rebuild else ModuleResultsStore.GetFeedback(student, database_path)
+    papers = ModuleResultsStore.ListPapers(database_path=database_path, student=student, after_id=feedback["last_paper_id"] if feedback else None)
+    # Sent in the order they were saved, since the next call only picks the papers with a higher id than the last one saved below. Imported papers may have been marked in another order
+    papers = sorted(papers, key=lambda paper: paper["id"])
+    span["papers"] = len(papers)
+    span["requests"] = 0
+    if feedback and not papers:
+        print("No new paper since the last comment")
+        return feedback["comment"]
+    if not papers:
+        raise RuntimeError(f"No marking result of {student} is found in the database")
+    rolling_summary = feedback["rolling_summary"] if feedback else ""
+    print(f"Done fetching, now asking AI to give comments on {len(papers)} new papers")
+    for run in fit_to_budget(papers, configs.feedback_token_budget):
+        span["requests"] += 1
+        comment, rolling_summary = ask_for_comment(compact_history(run), rolling_summary)
+        # Saved after each run, so that a failure part way only has to send the rest again
+        ModuleResultsStore.SaveFeedback(rolling_summary, comment, run[-1]["id"], student, database_path)
+    return comment
+
+def ask_for_comment(history_in_json, rolling_summary=""):
     before = time.time()
+    if rolling_summary:
+        history = f"Provided is your summary of the student's earlier performance:\n{rolling_summary}\nand their performance on the practice exam papers taken since, in the format of json:{history_in_json}"
+    else:
+        history = "Provided is the recent performance of the student on practice exam papers, in the format of json:"+history_in_json
     comment = ModuleLLMQuery.LLMQuery(
         [
             {"role": "system", "content": "You are a responsible and experienced teacher who is giving comments on a student's recent performance on exam papers done for practice, and are here to provide a detailed summary of the student's strengths and areas for improvements."},
-            {"role": "user", "content": "Provided is the recent performance of the student on practice exam papers, in the format of json:"+history_in_json}
+            {"role": "user", "content": history}
         ],
         response_format=Comment,
-        model="gpt-5-mini"
+        model=ModuleModelRouter.Models("feedback")[0],
+        hedge=True,
     )
     print(f"AI responded, took {time.time()-before}s")
     # Allowing the AI to determine edge cases
     if comment.custom_error:
         raise RuntimeError(f"The AI raised an error: {comment.custom_error}")
     print("Comment Produced!")
-    return comment.detailed_comment_on_student_performance
+    return comment.detailed_comment_on_student_performance, comment.rolling_summary
 
 if __name__ == "__main__":
+    # Papers saved in another order than they were marked are each summarized once
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_folder:
+        database_path = tmp_folder+"/results.sqlite3"
+        for name, marked_at in [("first_saved.xlsx", 300), ("second_saved.xlsx", 100), ("third_saved.xlsx", 200)]:
+            ModuleResultsStore.SavePaper(name, "9709", "12", [["1", 5, 4]], "", "", 4, 5, "A", marked_at=marked_at, database_path=database_path)
+        sent = []
+        def fake_ask_for_comment(history_in_json, rolling_summary=""):
+            sent.extend(row[0] for row in json.loads(history_in_json)["rows"])
+            return "comment", "summary"
+        # This block runs at the top level of the module, so assigning the name swaps the function produce_feedback_for_student calls
+        real_ask_for_comment = ask_for_comment
+        ask_for_comment = fake_ask_for_comment
+        try:
+            ProduceFeedbackForStudent(database_path=database_path)
+            ModuleResultsStore.SavePaper("fourth_saved.xlsx", "9709", "12", [["1", 5, 3]], "", "", 3, 5, "B", marked_at=50, database_path=database_path)
+            ProduceFeedbackForStudent(database_path=database_path)
+        finally:
+            ask_for_comment = real_ask_for_comment
+        print(f"Every paper sent once: \t{sorted(sent) == sorted(set(sent)) and len(sent) == 4} {sent}")
     with open("test_folder/ModuleProduceFeedbackForStudent/comment1.txt", 'w') as f:
         f.write(ProduceFeedbackForStudent(p2e="test_folder/ModuleProduceFeedbackForStudent/excel_of_testing_history1.xlsx"))
     with open("test_folder/ModuleProduceFeedbackForStudent/comment2.txt", 'w') as f:
         f.write(ProduceFeedbackForStudent(p2e="test_folder/ModuleProduceFeedbackForStudent/excel_of_testing_history2.xlsx"))
+    # Incremental feedback from a database: the second call only sends the paper saved since the first, the third sends nothing
+    from pathlib import Path
+    database_path = "test_folder/ModuleProduceFeedbackForStudent/results.sqlite3"
+    for path in Path(database_path).parent.glob("results.sqlite3*"):
+        path.unlink()
+    ModuleResultsStore.ImportMarkingResults("test_folder/ModuleCreateExcelOfTestingHistory/history2/", database_path)
+    print(ProduceFeedbackForStudent(database_path=database_path))
+    ModuleResultsStore.SavePaper("marking_result_24.xlsx", "0917", "24", [["1", 5, 4], ["2", 10, 6]], "Good at algebra", "Not good at geometry", 10, 15, "B", database_path=database_path)
+    print(ProduceFeedbackForStudent(database_path=database_path))
+    print(ProduceFeedbackForStudent(database_path=database_path))
+    print(ProduceFeedbackForStudent(database_path=database_path, rebuild=True))
@@ -1,11 +1,15 @@
 import configs
 import pydantic
 import base64
+import concurrent.futures
+import contextlib
 import io
-from PIL import Image
 from time import time
 
 import ModuleLLMQuery
+import ModuleMessages
+import ModuleModelRouter
+import ModulePDF2b64s
 
 # This class is only for prompt engineering purpose,
 # and the data stored in an instance of this class
@@ -32,7 +36,7 @@ class MarkingReport(pydantic.BaseModel):
     weaknesses: str = pydantic.Field(..., description="skills that the candidate seems to lack")
     custom_error: str = pydantic.Field(..., description="leave empty unless you want to raise a fatal error, the details of which you shall specify here")
 
-def ProduceMarkingReport(student_work_b64imgs, marking_scheme_b64imgs, print_marking_report=False):
+def ProduceMarkingReport(student_work_b64imgs, marking_scheme_b64imgs, print_marking_report=False, student_work_page_count=None, marking_scheme_page_count=None, on_question=None, question_count=None, marking_scheme_path=None):
     # Only for debugging
     """
     import random
@@ -47,6 +51,11 @@ def ProduceMarkingReport(student_work_b64imgs, marking_scheme_b64imgs, print_mar
         1. student_work_b64imgs: A list of strings(each string being a base 64 image)
         2. marking_scheme_b64imgs: A list of strings(each string being a base 64 image)
         3. print_marking_report: whether to print the marking report given by the AI
+        4. student_work_page_count: the number of pages of the student work, only needed if student_work_b64imgs is a generator like ModulePDF2b64s.IterPDF2b64s
+        5. marking_scheme_page_count: the number of pages of the marking scheme, only needed if marking_scheme_b64imgs is a generator
+        6. on_question: optional function, called as each question is marked with the row of the question in the marking report (e.g. ["3(a)", 10, 9]) and question_count, so that the marks can be shown before the whole paper is marked
+        7. question_count: the number of questions expected, if known, only passed on to on_question
+        8. marking_scheme_path: path to the marking scheme pdf, if given the pages are taken from ModuleMessages.DocumentConversation instead of marking_scheme_b64imgs, so that they are only rendered and held once however many papers are marked against it
     Return:
         1. Syllabus code (<class 'str'>)
         2. Component number (<class 'str'>
@@ -54,35 +63,73 @@ def ProduceMarkingReport(student_work_b64imgs, marking_scheme_b64imgs, print_mar
         4. A comment on strengths of the student
         5. A comment on weaknesses of the student
     Process:
-        Call ModuleLLMQuery.LLMQuery to let the AI mark the student's paper
+        The stable content comes first (the system prompt, then the marking scheme) and the student's pages after it, so that requests marking against the same marking scheme share a long common prefix which the provider can serve from its prompt cache
+        Call ModuleLLMQuery.LLMQuery to let the cheapest model of configs.llm_models["marking"] mark the student's paper
+        Check every marked question with ModuleModelRouter.CheckMarkedQuestion, and only mark the questions failing the checks again, with the stronger models, at the same time
+        If on_question is given, the response is streamed, and each question is passed to on_question once the AI has moved on to the next one
     """
+    with contextlib.ExitStack() as stack:
+        if marking_scheme_path is not None:
+            # Held until the paper is marked, questions marked again included, so that the pages stay in ModulePageStore
+            marking_scheme_conversation = stack.enter_context(ModuleMessages.DocumentConversation(marking_scheme_path, "the marking scheme", profile="mark_scheme"))
+        else:
+            marking_scheme_conversation = ModuleMessages.IterImageConversation(marking_scheme_b64imgs, "the marking scheme", marking_scheme_page_count)
+        return produce_marking_report(student_work_b64imgs, marking_scheme_conversation, print_marking_report, student_work_page_count, on_question, question_count)
+
+def produce_marking_report(student_work_b64imgs, marking_scheme_conversation, print_marking_report, student_work_page_count, on_question, question_count):
     a=time()
     #with open("test_folder/tmp.png", "wb") as f:
     #    f.write(base64.b64decode(marking_scheme_b64imgs[-1]))
     #exit()
     print("Sending request to AI for marking, THIS MAY TAKE A WHILE(~5 to 10 minutes), timestamp:", time())
+    checked = [] # the question numbers already checked while streaming
+    def on_partial(partial_report):
+        # Every question but the last one is complete, the last one may still be being written
+        for question in (partial_report.get("questions") or [])[len(checked):-1]:
+            checked.append(question["question_number"])
+            question = Question.model_validate(question)
+            # The questions failing the checks are only passed on once marked again
+            if not ModuleModelRouter.CheckMarkedQuestion(question):
+                on_question([question.question_number, question.max_marks, question.awarded_marks], question_count)
+    # Kept, so that the questions failing the checks can be sent again with the same pages
+    messages = [
+        {
+            "role": "system",
+            "content": (
+                "You are an experienced A-Level examiner.\n"
+                "You are marking the exam paper of a candidate.\n"
+                "You will follow the instructions of the marking scheme when marking the exam paper.\n"
+                "The user is your co-worker, and will provide you with the marking scheme and the exam paper.\n"
+            )
+        },
+        *marking_scheme_conversation,
+        *ModuleMessages.IterImageConversation(student_work_b64imgs, "the exam paper that the candidate has written", student_work_page_count),
+    ]
     marking_report = ModuleLLMQuery.LLMQuery(
         [
-            {
-                "role": "system",
-                "content": (
-                    "You are an experienced A-Level examiner.\n"
-                    "You are marking the exam paper of a candidate.\n"
-                    "You will follow the instructions of the marking scheme when marking the exam paper.\n"
-                    "The user is your co-worker, and will provide you with the exam paper and the marking scheme.\n"
-                )
-            },
-            *generate_image_conversation(student_work_b64imgs, "the exam paper that the candidate has written"),
-            *generate_image_conversation(marking_scheme_b64imgs, "the marking scheme"),
-            {"role": "user", "content": "I have given you all the pages of the question paper that the candidate has submitted, as well as all the pages of the marking scheme. Remember, always follow the instructions on the marking scheme to give marks. Now, please start marking the candidate's work."},
+            *messages,
+            {"role": "user", "content": "I have given you all the pages of the marking scheme, as well as all the pages of the question paper that the candidate has submitted. Remember, always follow the instructions on the marking scheme to give marks. Now, please start marking the candidate's work."},
         ],
         response_format=MarkingReport,
-        model="o4-mini"
+        model=ModuleModelRouter.Models("marking")[0],
+        on_partial=None if on_question is None else on_partial,
     )
     # Allow the AI to handle edge cases
     if marking_report.custom_error:
         raise RuntimeError("The AI raised a fatal error!\n", marking_report.custom_error)
     print(f"The AI responded, and it took {time()-a}s")
+    failing = [idx for idx, question in enumerate(marking_report.questions) if ModuleModelRouter.CheckMarkedQuestion(question)]
+    if failing and len(ModuleModelRouter.Models("marking")) > 1:
+        print(f"Marking {len(failing)} questions again with a stronger model, as they failed the checks")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(failing)) as executor:
+            remarked = executor.map(lambda idx: remark_question(messages, marking_report.questions[idx]), failing)
+            for idx, question in zip(failing, remarked):
+                marking_report.questions[idx] = question
+    if on_question is not None:
+        # The last question only completes with the response
+        for idx, question in enumerate(marking_report.questions):
+            if idx >= len(checked) or idx in failing:
+                on_question([question.question_number, question.max_marks, question.awarded_marks], question_count)
     #print(marking_report)
     if print_marking_report:
         for marked_question in marking_report.questions:
@@ -99,33 +146,23 @@ def ProduceMarkingReport(student_work_b64imgs, marking_scheme_b64imgs, print_mar
 
     return marking_report.syllabus_code, marking_report.component_number, [[question.question_number, question.max_marks, question.awarded_marks] for question in marking_report.questions], marking_report.strengths, marking_report.weaknesses
 
-def generate_image_conversation(b64_imgs, name_of_pdf):
-    # Generate 'messages' in order to let the AI see all the pages in the right ORDER
-    conversation = []
-    idx = 0
-    for b64_img in b64_imgs:
-        idx += 1
-        conversation.extend([
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": f"This is page {idx}/{len(b64_imgs)} of {name_of_pdf}."},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/{configs.img_extension};base64,{b64_img}"
-                        }
-                    }
-                ]
-            },
-            {
-                "role": "assistant",
-                "content": [
-                    {"type": "text", "text": f"I see, this is page {idx} of {name_of_pdf}."}
-                ]
-            }
-        ])
-    return conversation
+def remark_question(messages, question):
+    # Mark one question again, going up the models of configs.llm_models["marking"] until the marks are consistent
+    def query(model):
+        return ModuleLLMQuery.LLMQuery(
+            [
+                *messages,
+                {"role": "user", "content": "I have given you all the pages of the marking scheme, as well as all the pages of the question paper that the candidate has submitted. Remember, always follow the instructions on the marking scheme to give marks."},
+                {"role": "assistant", "content": question.model_dump_json()},
+                {"role": "user", "content": f"The marks of question {question.question_number} are inconsistent: {'; '.join(ModuleModelRouter.CheckMarkedQuestion(question))}. Now, please mark question {question.question_number} again, carefully."},
+            ],
+            response_format=Question,
+            model=model,
+        )
+    remarked = ModuleModelRouter.Cascade("marking", query, ModuleModelRouter.CheckMarkedQuestion, first_tier=1)
+    # The report keeps the label the question was first marked under
+    remarked.question_number = question.question_number
+    return remarked
 
 if __name__ == "__main__":
     import ModulePDF2b64s
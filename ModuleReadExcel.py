@@ -0,0 +1,40 @@
+import configs
+import concurrent.futures
+
+def ReadRows(path_to_excel, min_row=1, max_row=None, min_col=1, max_col=None):
+    """
+    Args:
+        1. path_to_excel (<class 'str'>): path to an excel file, of which only the active sheet is read
+        2. min_row, max_row, min_col, max_col (<class 'int'>): the 1-based bounds of the cells to read, None means up to the last row/column
+    Return:
+        of <class 'list'>, each element being a <class 'tuple'> of the values of a row
+    Process:
+        Open the workbook in read-only mode and pull the rows in bulk, which is much faster than loading the full workbook and reading the cells one at a time
+    """
+    import openpyxl
+    wb_obj = openpyxl.load_workbook(str(path_to_excel), read_only=True)
+    try:
+        sheet_obj = wb_obj.active
+        return list(sheet_obj.iter_rows(min_row=min_row, max_row=max_row, min_col=min_col, max_col=max_col, values_only=True))
+    finally:
+        # Read-only workbooks keep the file open until closed
+        wb_obj.close()
+
+def MapInParallel(function, paths, workers=None):
+    """
+    Args:
+        1. function: a module-level function taking a path, e.g. ModuleResultsStore.ReadMarkingResult. It must be module-level so that it can be sent to the worker processes
+        2. paths (<class 'list'>): the paths to the excel files
+        3. workers (<class 'int'>): the number of worker processes, configs.excel_read_workers is used if this is None
+    Return:
+        of <class 'list'> the return values of function, in the order of paths
+    Process:
+        Reading excel files is CPU-bound, so many files are spread across a pool of processes. A handful of files is read in this process, since starting the pool would cost more than it saves
+    """
+    paths = list(paths)
+    workers = configs.excel_read_workers if workers is None else workers
+    if workers <= 1 or len(paths) < configs.excel_read_min_files_for_pool:
+        return [function(path) for path in paths]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        # Larger chunks keep the overhead of sending the tasks to the workers low when there are thousands of files
+        return list(executor.map(function, paths, chunksize=max(1, len(paths)//(workers*8))))
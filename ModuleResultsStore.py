@@ -0,0 +1,206 @@
+import configs
+import sqlite3
+import time
+from contextlib import closing
+from pathlib import Path
+import ModuleReadExcel
+
+# The columns of the summary of testing history, by the column of the papers table they are read from, in the order of the excel exported by ModuleCreateExcelOfTestingHistory
+summary_columns = {
+    "name": "Exam Paper Name",
+    "syllabus_code": "Syllabus Code",
+    "component_number": "Component Number",
+    "strengths": "Strengths of the Student",
+    "weaknesses": "Weaknesses of the Student",
+    "marks_earned": "Total Marks Attained",
+    "marks_there": "Maximum Total Marks Available",
+    "grade": "Grade Achieved",
+}
+
+def connect(database_path=None):
+    """
+    Args:
+        1. database_path (<class 'str'>): the sqlite database to open, configs.results_database_path is used if this is None
+    Return:
+        of <class 'sqlite3.Connection'> a new connection, with the tables created if the database is new. Use as 'with closing(connect()) as connection, connection:' so that it is committed and closed
+    """
+    database_path = database_path or configs.results_database_path
+    Path(database_path).parent.mkdir(parents=True, exist_ok=True)
+    # Jobs save their results from several threads at once, each with its own connection
+    connection = sqlite3.connect(database_path, timeout=30)
+    connection.row_factory = sqlite3.Row
+    # Readers do not wait for a writer in WAL mode, so the summary can be read while papers are being saved
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA foreign_keys=ON")
+    connection.executescript("""
+        CREATE TABLE IF NOT EXISTS papers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            student TEXT NOT NULL DEFAULT '',
+            syllabus_code TEXT,
+            component_number TEXT,
+            strengths TEXT,
+            weaknesses TEXT,
+            marks_earned INTEGER,
+            marks_there INTEGER,
+            grade TEXT,
+            marked_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS papers_marked_at ON papers (marked_at);
+        CREATE INDEX IF NOT EXISTS papers_component ON papers (syllabus_code, component_number);
+        CREATE INDEX IF NOT EXISTS papers_grade ON papers (grade);
+        CREATE TABLE IF NOT EXISTS questions (
+            paper_id INTEGER NOT NULL REFERENCES papers (id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            question_number TEXT NOT NULL,
+            max_marks INTEGER,
+            awarded_marks INTEGER,
+            PRIMARY KEY (paper_id, position)
+        );
+        CREATE INDEX IF NOT EXISTS questions_question_number ON questions (question_number);
+        CREATE TABLE IF NOT EXISTS feedback (
+            student TEXT PRIMARY KEY,
+            rolling_summary TEXT NOT NULL,
+            comment TEXT NOT NULL,
+            last_paper_id INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        );
+    """)
+    # Databases made before the papers were kept per student
+    if "student" not in [column["name"] for column in connection.execute("PRAGMA table_info(papers)")]:
+        connection.execute("ALTER TABLE papers ADD COLUMN student TEXT NOT NULL DEFAULT ''")
+        connection.execute("UPDATE papers SET student = ?", (configs.student_name,))
+        connection.commit()
+    connection.execute("CREATE INDEX IF NOT EXISTS papers_student ON papers (student, id)")
+    return connection
+
+def SavePaper(name, syllabus_code, component_number, marking_report, strengths, weaknesses, score, total_score_avail, grade, marked_at=None, database_path=None, student=None):
+    """
+    Args:
+        1. name (<class 'str'>): the name of the marking result, e.g. "9709_12_2024_MayJune_Mathematics_qp_first_try.xlsx". A paper saved again under the same name replaces the old one
+        2. syllabus_code, component_number, marking_report, strengths, weaknesses, score, total_score_avail, grade: the same as ModuleSaveMarkingResultToExcel.SaveMarkingResultToExcel
+        3. marked_at (<class 'float'>): when the paper was marked, as a unix timestamp, now if this is None
+        4. database_path (<class 'str'>): see connect
+        5. student (<class 'str'>): who sat the paper, configs.student_name is used if this is None
+    Return: No return
+    Process:
+        The paper and all of its questions are written in one transaction, so a crash never leaves a paper without its questions
+    """
+    marked_at = time.time() if marked_at is None else marked_at
+    student = configs.student_name if student is None else student
+    with closing(connect(database_path)) as connection, connection:
+        # Deleting the old paper drops its questions as well
+        connection.execute("DELETE FROM papers WHERE name = ?", (name,))
+        paper_id = connection.execute(
+            "INSERT INTO papers (name, student, syllabus_code, component_number, strengths, weaknesses, marks_earned, marks_there, grade, marked_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (name, student, syllabus_code, component_number, strengths, weaknesses, score, total_score_avail, grade, marked_at),
+        ).lastrowid
+        connection.executemany(
+            "INSERT INTO questions VALUES (?, ?, ?, ?, ?)",
+            [(paper_id, position, question_number, max_mark, mark) for position, (question_number, max_mark, mark) in enumerate(marking_report)],
+        )
+
+def ListPapers(limit=None, database_path=None, student=None, after_id=None):
+    """
+    Args:
+        1. limit (<class 'int'>): only return the most recently marked papers, all of them if this is None
+        2. database_path (<class 'str'>): see connect
+        3. student (<class 'str'>): only return the papers of this student, those of every student if this is None
+        4. after_id (<class 'int'>): only return the papers saved after the one with this id, e.g. the last one already summarized by ModuleProduceFeedbackForStudent
+    Return:
+        of <class 'list'> one <class 'dict'> per paper with the keys of summary_columns, "marked_at" and "id", oldest first. The ids grow with every paper saved
+    """
+    conditions = ["id > ?"]
+    parameters = [-1 if after_id is None else after_id]
+    if student is not None:
+        conditions.append("student = ?")
+        parameters.append(student)
+    with closing(connect(database_path)) as connection, connection:
+        rows = connection.execute(
+            f"SELECT * FROM (SELECT {', '.join(summary_columns)}, marked_at, id FROM papers WHERE {' AND '.join(conditions)} ORDER BY marked_at DESC, id DESC LIMIT ?) ORDER BY marked_at, id",
+            (*parameters, -1 if limit is None else limit),
+        ).fetchall()
+    return [{key: row[key] for key in [*summary_columns, "marked_at", "id"]} for row in rows]
+
+def GetPaper(name, database_path=None):
+    """
+    Args:
+        1. name (<class 'str'>): the name the paper was saved under
+        2. database_path (<class 'str'>): see connect
+    Return:
+        of <class 'dict'> the same as an element of ListPapers, plus "marking_report", the marking report of the paper like [["3(a)", 10, 9], ["3(b)", 7, 6]]. None if no paper has the name
+    """
+    with closing(connect(database_path)) as connection, connection:
+        row = connection.execute("SELECT * FROM papers WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        questions = connection.execute("SELECT question_number, max_marks, awarded_marks FROM questions WHERE paper_id = ? ORDER BY position", (row["id"],)).fetchall()
+    paper = {key: row[key] for key in [*summary_columns, "marked_at", "id"]}
+    paper["marking_report"] = [list(question) for question in questions]
+    return paper
+
+def GetFeedback(student=None, database_path=None):
+    """
+    Args:
+        1. student (<class 'str'>): configs.student_name is used if this is None
+        2. database_path (<class 'str'>): see connect
+    Return:
+        of <class 'dict'> the feedback last produced for the student by ModuleProduceFeedbackForStudent, with the keys "rolling_summary", "comment", "last_paper_id" (the id of the newest paper it covers) and "updated_at". None if there is none yet
+    """
+    student = configs.student_name if student is None else student
+    with closing(connect(database_path)) as connection, connection:
+        row = connection.execute("SELECT rolling_summary, comment, last_paper_id, updated_at FROM feedback WHERE student = ?", (student,)).fetchone()
+    return None if row is None else dict(row)
+
+def SaveFeedback(rolling_summary, comment, last_paper_id, student=None, database_path=None):
+    """
+    Args:
+        1. rolling_summary (<class 'str'>): the compact summary of every paper up to last_paper_id, sent with the next papers instead of the papers themselves
+        2. comment (<class 'str'>): the feedback shown to the student
+        3. last_paper_id (<class 'int'>): the id of the newest paper covered
+        4. student, database_path: see GetFeedback
+    Return: No return
+    """
+    student = configs.student_name if student is None else student
+    with closing(connect(database_path)) as connection, connection:
+        connection.execute("INSERT OR REPLACE INTO feedback VALUES (?, ?, ?, ?, ?)", (student, rolling_summary, comment, last_paper_id, time.time()))
+
+def ImportMarkingResults(marking_result_folder=None, database_path=None):
+    """
+    Args:
+        1. marking_result_folder (<class 'str'>): the folder of the marking results saved as excel files before the results were kept in the database, configs.marking_result_folder is used if this is None
+        2. database_path (<class 'str'>): see connect
+    Return:
+        of <class 'int'> the number of marking results imported
+    Process:
+        Only the excel files whose name is not in the database yet are read, in parallel with ModuleReadExcel.MapInParallel if there are many, so running this again costs no more than listing the folder
+        The time the excel file was last modified is taken as the time it was marked
+    """
+    marking_result_folder = marking_result_folder or configs.marking_result_folder
+    with closing(connect(database_path)) as connection, connection:
+        known = {row[0] for row in connection.execute("SELECT name FROM papers")}
+    paths = sorted(path for path in Path(marking_result_folder).glob("*.xlsx") if path.name not in known)
+    for path, paper in zip(paths, ModuleReadExcel.MapInParallel(ReadMarkingResult, paths)):
+        print(f"Importing: {path}")
+        SavePaper(path.name, *paper, marked_at=path.stat().st_mtime, database_path=database_path)
+    return len(paths)
+
+def ReadMarkingResult(path_to_excel):
+    # Read a marking result saved by ModuleSaveMarkingResultToExcel, in the order of the arguments of SavePaper after the name
+    rows = ModuleReadExcel.ReadRows(path_to_excel, max_col=15)
+    rows = [(tuple(row)+(None,)*15)[:15] for row in rows]+[(None,)*15]*2
+    syllabus_code, component_number, strengths, weaknesses, score, total_score_avail, grade = rows[1][8:15]
+    marking_report = [list(row[:3]) for row in rows[1:] if row[0] is not None]
+    return syllabus_code, component_number, marking_report, strengths, weaknesses, score, total_score_avail, grade
+
+# For testing
+if __name__ == "__main__":
+    database_path = "test_folder/ModuleResultsStore/results.sqlite3"
+    for path in Path(database_path).parent.glob("results.sqlite3*"):
+        path.unlink()
+    print(f"Imported {ImportMarkingResults('test_folder/ModuleCreateExcelOfTestingHistory/history2/', database_path)} marking results")
+    print(f"Imported {ImportMarkingResults('test_folder/ModuleCreateExcelOfTestingHistory/history2/', database_path)} marking results again")
+    SavePaper("marking_result_24.xlsx", "0917", "24", [["1", 5, 4], ["2", 10, 6]], "Good at algebra", "Not good at geometry", 10, 15, "B", database_path=database_path)
+    for paper in ListPapers(database_path=database_path):
+        print(paper)
+    print(GetPaper("marking_result_24.xlsx", database_path))
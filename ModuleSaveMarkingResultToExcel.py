@@ -1,11 +1,13 @@
 import configs
 import ModuleCreateExcelOfTestingHistory
-import openpyxl
+import ModuleResultsStore
+import ModuleTracing
+import os
 
-def SaveMarkingResultToExcel(save_path:str, syllabus_code:str, component_number:str, marking_report:list, strengths:str, weaknesses:str, score:int, total_score_avail, grade:str, update_summary=True):
+def SaveMarkingResultToExcel(save_path:str, syllabus_code:str, component_number:str, marking_report:list, strengths:str, weaknesses:str, score:int, total_score_avail, grade:str, update_summary=True, database_path=None):
     """
     Args:
-        1. save_path (<class 'str'>): the path of the excel file to save to
+        1. save_path (<class 'str'>): the path of the excel file to save to. Its file name is also the name the marking result is kept under in the database
         2. syllabus_code (<class 'str'>)
         3. component_number (<class 'str'>)
         4. marking_report (<class 'list'>): the marking report
@@ -14,11 +16,47 @@ def SaveMarkingResultToExcel(save_path:str, syllabus_code:str, component_number:
         7. score (<class 'int'>)
         8. total_score_avail (<class 'int'>)
         9. grade (<class 'str'>): the grade received, e.g. A, B, C, D, E, U
-        10. update_summary (<class 'bool'>): whether to update the excel of testing history
+        10. update_summary (<class 'bool'>): whether to update the excel of testing history, only done if configs.excel_exports_enabled
+        11. database_path (<class 'str'>): the database to save to, configs.results_database_path is used if this is None
     Return: No return
     Process:
-        Save the marking result into an excel file, and call ModuleCreateExcelOfTestingHistory.CreateExcelOfTestingHistory
+        Save the marking result into the database with ModuleResultsStore.SavePaper, which is where the history is read from
+        The excel file is only written if configs.excel_exports_enabled, otherwise it can be exported when needed with ExportMarkingResultToExcel, and so can the excel of testing history with ModuleCreateExcelOfTestingHistory.CreateExcelOfTestingHistory
+        Recorded as a "save_marking_result" span of ModuleTracing
     """
+    with ModuleTracing.Span("save_marking_result", questions=len(marking_report)):
+        save_marking_result_to_excel(save_path, syllabus_code, component_number, marking_report, strengths, weaknesses, score, total_score_avail, grade, update_summary, database_path)
+
+def save_marking_result_to_excel(save_path, syllabus_code, component_number, marking_report, strengths, weaknesses, score, total_score_avail, grade, update_summary, database_path):
+    ModuleResultsStore.SavePaper(os.path.basename(save_path), syllabus_code, component_number, marking_report, strengths, weaknesses, score, total_score_avail, grade, database_path=database_path)
+    print(f"Marking result saved to the database as {os.path.basename(save_path)}.")
+    if not configs.excel_exports_enabled:
+        return
+    write_marking_result(save_path, syllabus_code, component_number, marking_report, strengths, weaknesses, score, total_score_avail, grade)
+
+    # Update excel of testing history
+    if update_summary:
+        print("Updating the excel file of testing history")
+        ModuleCreateExcelOfTestingHistory.CreateExcelOfTestingHistory(database_override=database_path)
+
+def ExportMarkingResultToExcel(name, save_path=None, database_path=None):
+    """
+    Args:
+        1. name (<class 'str'>): the name the marking result was saved under, i.e. the file name of the save_path given to SaveMarkingResultToExcel
+        2. save_path (<class 'str'>): the path of the excel file to export to, the file named name under configs.marking_result_folder if this is None
+        3. database_path (<class 'str'>): the database to read from, configs.results_database_path is used if this is None
+    Return:
+        of <class 'str'> the path of the excel file, which has the same layout as the ones SaveMarkingResultToExcel used to write
+    """
+    paper = ModuleResultsStore.GetPaper(name, database_path)
+    if paper is None:
+        raise RuntimeError(f"No marking result named {name} is found in the database")
+    save_path = save_path or os.path.join(configs.marking_result_folder, name)
+    write_marking_result(save_path, paper["syllabus_code"], paper["component_number"], paper["marking_report"], paper["strengths"], paper["weaknesses"], paper["marks_earned"], paper["marks_there"], paper["grade"])
+    return save_path
+
+def write_marking_result(save_path, syllabus_code, component_number, marking_report, strengths, weaknesses, score, total_score_avail, grade):
+    import openpyxl
     wb = openpyxl.Workbook()
     ws = wb.active
 
@@ -54,12 +92,8 @@ def SaveMarkingResultToExcel(save_path:str, syllabus_code:str, component_number:
     wb.save(save_path)
     print("Marking result saved to " + save_path, ".")
 
-    # Update excel of testing history
-    print("Updating the excel file of testing history")
-    ModuleCreateExcelOfTestingHistory.CreateExcelOfTestingHistory()
-
-
 if __name__ == "__main__":
+    database_path = "test_folder/ModuleSaveMarkingResultToExcel/results.sqlite3"
     SaveMarkingResultToExcel(
         'test_folder/ModuleSaveMarkingResultToExcel/marking_result_21.xlsx','0917',
         '21' ,
@@ -75,6 +109,7 @@ if __name__ == "__main__":
         25,
         'B',
         update_summary=False,
+        database_path=database_path,
     )
     SaveMarkingResultToExcel(
         'test_folder/ModuleSaveMarkingResultToExcel/marking_result_22.xlsx','0917',
@@ -91,6 +126,7 @@ if __name__ == "__main__":
         21,
         'C',
         update_summary=False,
+        database_path=database_path,
     )
     SaveMarkingResultToExcel(
         'test_folder/ModuleSaveMarkingResultToExcel/marking_result_23.xlsx','0917',
@@ -107,4 +143,8 @@ if __name__ == "__main__":
         17,
         'B',
         update_summary=False,
+        database_path=database_path,
     )
+    # The excel files are only written when exported, unless configs.excel_exports_enabled
+    for idx in (21, 22, 23):
+        print(ExportMarkingResultToExcel(f"marking_result_{idx}.xlsx", f"test_folder/ModuleSaveMarkingResultToExcel/marking_result_{idx}.xlsx", database_path))
@@ -0,0 +1,159 @@
+import configs
+import contextlib
+import contextvars
+import http.server
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from pathlib import Path
+
+# The span the code is currently running in, kept per thread and per asyncio task so that concurrent marking jobs do not mix up their parents
+current_span = contextvars.ContextVar("current_span", default=None)
+# Totals of every finished span by name, only kept for the lifetime of the process, and exposed by PrometheusText
+metrics = {}
+metrics_lock = threading.Lock()
+# Functions returning the current value of something that goes up and down, like the depth of a queue, by the name of the metric, added by the modules that have such values. Each returns a <class 'dict'> of the value by its labels, e.g. {'stage="mark"': 2}
+gauges = {}
+trace_lock = threading.Lock()
+
+@contextlib.contextmanager
+def Span(name, **attributes):
+    """
+    Args:
+        1. name (<class 'str'>): the name of the stage, e.g. "llm_query" or "pdf2b64s"
+        2. attributes: anything worth recording about the stage, e.g. model="gpt-5"
+    Return:
+        of <class 'dict'> the attributes of the span, so that more can be added while it runs, e.g. span["prompt_tokens"] = 1000
+    Process:
+        Use as 'with ModuleTracing.Span("pdf2b64s", profile=profile) as span:'
+        Measure the wall time and the CPU time of the thread, then append the span as one line of JSON to configs.trace_path and add it to the totals shown by PrometheusText
+        The numeric attributes (e.g. token counts, bytes, pages) are added to the totals too, while the others are only written to the trace
+        Spans nest: a span started inside another records the id of the outer one as its parent, and shares its trace id
+    """
+    if not configs.tracing_enabled:
+        yield dict(attributes)
+        return
+    parent = current_span.get()
+    span = {
+        "trace_id": parent["trace_id"] if parent else uuid.uuid4().hex[:16],
+        "span_id": uuid.uuid4().hex[:16],
+        "parent_id": parent["span_id"] if parent else None,
+        "name": name,
+    }
+    token = current_span.set(span)
+    attributes = dict(attributes)
+    error = ""
+    start = time.time()
+    wall_before = time.perf_counter()
+    # The CPU time of this thread only, so that the other jobs running at the same time are not counted
+    cpu_before = time.thread_time()
+    try:
+        yield attributes
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        span.update({
+            "start": start,
+            "wall_seconds": time.perf_counter()-wall_before,
+            "cpu_seconds": time.thread_time()-cpu_before,
+            "error": error,
+            "pid": os.getpid(),
+            "thread": threading.current_thread().name,
+            "attributes": attributes,
+        })
+        current_span.reset(token)
+        record(span)
+
+def record(span):
+    with metrics_lock:
+        totals = metrics.setdefault(span["name"], {"count": 0, "errors": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0})
+        totals["count"] += 1
+        totals["errors"] += 1 if span["error"] else 0
+        totals["wall_seconds"] += span["wall_seconds"]
+        totals["cpu_seconds"] += span["cpu_seconds"]
+        for key, value in span["attributes"].items():
+            # bool is a subclass of int, but a flag like cache_hit is not something to add up
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                totals[key] = totals.get(key, 0)+value
+    if configs.trace_path:
+        line = json.dumps(span, default=str)
+        with trace_lock:
+            Path(configs.trace_path).parent.mkdir(parents=True, exist_ok=True)
+            # Appending a single line keeps the file readable even when the rendering processes write to it as well
+            with open(configs.trace_path, "a") as f:
+                f.write(line+"\n")
+
+def PrometheusText():
+    """
+    Args: No args
+    Return:
+        of <class 'str'> the totals of the spans finished in this process, in the Prometheus text exposition format, e.g.
+        marking_span_wall_seconds_total{span="llm_query"} 312.5
+        marking_span_prompt_tokens_total{span="llm_query"} 48211
+    Process:
+        Every total is a counter labelled by the name of the span, followed by the current value of every gauge, e.g. marking_pipeline_queue_depth{stage="mark"} 2. Spans run in other processes (e.g. the rendering workers when configs.render_workers > 1) are only in the trace file
+    """
+    with metrics_lock:
+        snapshot = {name: dict(totals) for name, totals in metrics.items()}
+    series = {}
+    for name, totals in sorted(snapshot.items()):
+        for key, value in totals.items():
+            series.setdefault(re.sub(r"[^a-zA-Z0-9_]", "_", key), []).append((name, value))
+    lines = []
+    for key, values in sorted(series.items()):
+        metric = f"marking_span_{key}_total"
+        lines.append(f"# TYPE {metric} counter")
+        for name, value in values:
+            lines.append(f'{metric}{{span="{name}"}} {value}')
+    for metric, gauge in sorted(gauges.items()):
+        lines.append(f"# TYPE {metric} gauge")
+        for label, value in gauge().items():
+            lines.append(f'{metric}{{{label}}} {value}')
+    return "\n".join(lines)+"\n"
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = PrometheusText().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scraped every few seconds, which would flood the console
+        pass
+
+def StartMetricsServer(port=None, host=None):
+    """
+    Args:
+        1. port (<class 'int'>): the port to serve on, configs.metrics_port is used if this is None
+        2. host (<class 'str'>): the address to serve on, configs.metrics_host is used if this is None
+    Return:
+        of <class 'http.server.ThreadingHTTPServer'> the server, already serving /metrics from a background thread
+    """
+    port = configs.metrics_port if port is None else port
+    host = configs.metrics_host if host is None else host
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"Serving the metrics at http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+# For testing
+if __name__ == "__main__":
+    import urllib.request
+    with Span("outer", papers=1) as span:
+        with Span("inner", model="gpt-5") as inner:
+            sum(range(1000000))
+            inner["prompt_tokens"] = 1000
+        span["pages"] = 20
+    server = StartMetricsServer(0)
+    print(urllib.request.urlopen(f"http://localhost:{server.server_address[1]}/metrics").read().decode())
+    server.shutdown()
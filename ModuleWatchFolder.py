@@ -0,0 +1,186 @@
+import configs
+import concurrent.futures
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+import ModuleMarkPaper
+import ModulePageStore
+import ModulePDF2b64s
+import ModuleResultsStore
+
+def Watch(inbox=None, mark_scheme_path=None, threshold_table_path=None, workers=None, poll_seconds=None, settle_seconds=None, stop_event=None, until_idle=False):
+    """
+    Args:
+        1. inbox (<class 'str'>): the folder the scanners drop the completed question paper pdfs into, configs.watch_inbox_folder is used if this is None
+        2. mark_scheme_path (<class 'str'>): the mark scheme pdf every paper dropped is marked against, configs.watch_mark_scheme_path is used if this is None
+        3. threshold_table_path (<class 'str'>): the threshold table pdf every paper dropped is graded with, configs.watch_threshold_table_path is used if this is None
+        4. workers (<class 'int'>): the maximum number of papers marked at the same time, configs.watch_workers is used if this is None
+        5. poll_seconds (<class 'float'>): how often the inbox is listed, configs.watch_poll_seconds is used if this is None
+        6. settle_seconds (<class 'float'>): how long the size and modification time of a pdf must stay the same before it is taken as fully written, configs.watch_settle_seconds is used if this is None
+        7. stop_event (<class 'threading.Event'>): optional, the watcher stops once this is set, after the papers being marked are finished
+        8. until_idle (<class 'bool'>): whether to stop once the inbox is empty and no paper is being marked, instead of watching forever
+    Return:
+        of <class 'dict'> the counts of the papers handled with the keys "done", "failed" and "already_marked"
+    Process:
+        Poll the inbox for pdfs, and mark each with ModuleMarkPaper.MarkPaper once it has settled. Papers still being written by the scanner are left alone until they stop changing
+        At most workers papers are marked at once, the others wait in the inbox. The mark scheme (and the threshold table, if it cannot be read locally) are held in ModulePageStore for as long as the watcher runs
+        A marked paper is moved to the "done" folder of the inbox, and a paper failing to be marked is moved to the "failed" folder together with a .error.txt file saying why
+        The hash of every paper handled is written to the ledger of the inbox before the paper is moved, so after a restart a paper marked already (or dropped again) is only moved, never marked twice. A paper that failed, or was being marked when the watcher stopped, is marked again
+        A paper named like one marked before (e.g. scan0001.pdf from another batch) is renamed with the start of its hash first, so that its marking result does not replace the earlier one
+        Stop with Ctrl+C or stop_event
+    """
+    inbox = Path(inbox or configs.watch_inbox_folder)
+    mark_scheme_path = mark_scheme_path or configs.watch_mark_scheme_path
+    threshold_table_path = threshold_table_path or configs.watch_threshold_table_path
+    workers = max(1, configs.watch_workers if workers is None else workers)
+    poll_seconds = configs.watch_poll_seconds if poll_seconds is None else poll_seconds
+    settle_seconds = configs.watch_settle_seconds if settle_seconds is None else settle_seconds
+    stop_event = threading.Event() if stop_event is None else stop_event
+    if not mark_scheme_path or not threshold_table_path:
+        raise RuntimeError("The watcher needs a mark scheme and a threshold table, set configs.watch_mark_scheme_path and configs.watch_threshold_table_path")
+    for folder in (inbox, inbox / "done", inbox / "failed"):
+        folder.mkdir(parents=True, exist_ok=True)
+    ledger = load_ledger(inbox)
+    stats = {"done": 0, "failed": 0, "already_marked": 0}
+    # The size and modification time last seen of each pdf in the inbox, and since when they have not changed
+    seen = {}
+    # The futures of the papers being marked, by path
+    marking = {}
+
+    # Shared documents, as in ModuleMarkPaper.MarkPapers
+    with ModulePageStore.SharedDocuments(mark_scheme_path, threshold_table_path):
+
+        print(f"Watching {inbox} with {workers} workers, marking against {os.path.basename(mark_scheme_path)}.")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="watch") as executor:
+            try:
+                while not stop_event.is_set():
+                    # Record the papers finished since the last poll
+                    for path, future in list(marking.items()):
+                        if future.done():
+                            del marking[path]
+                            file_hash, error = future.result()
+                            finish(inbox, ledger, path, file_hash, error)
+                            stats["failed" if error else "done"] += 1
+                    pending = settled_papers(inbox, seen, settle_seconds, exclude=marking)
+                    for path in pending:
+                        if len(marking) >= workers:
+                            # The rest stay in the inbox until a worker is free
+                            break
+                        file_hash = ModulePDF2b64s.file_hash(path)
+                        # Only the papers marked are skipped, a paper that failed is marked again when dropped back in, e.g. after the API was down
+                        if ledger.get(file_hash, {}).get("status") == "done":
+                            print(f"{path.name} was marked already, moving it to done.")
+                            move(path, inbox / "done")
+                            seen.pop(path, None)
+                            stats["already_marked"] += 1
+                            continue
+                        path = unique_name(path, file_hash)
+                        print(f"Marking {path.name}.")
+                        marking[path] = executor.submit(mark, path, file_hash, mark_scheme_path, threshold_table_path)
+                    if until_idle and not marking and not any(inbox.glob("*.pdf")):
+                        break
+                    stop_event.wait(poll_seconds)
+            except KeyboardInterrupt:
+                print("Stopping, waiting for the papers being marked.")
+            # The papers being marked are finished before stopping, so their results are not lost
+            for path, future in marking.items():
+                file_hash, error = future.result()
+                finish(inbox, ledger, path, file_hash, error)
+                stats["failed" if error else "done"] += 1
+    print(f"Stopped watching {inbox}: {stats['done']} marked, {stats['failed']} failed, {stats['already_marked']} marked already.")
+    return stats
+
+def settled_papers(inbox, seen, settle_seconds, exclude=()):
+    # The pdfs of the inbox that have not changed for settle_seconds, oldest first. seen is updated with what this poll found
+    now = time.time()
+    papers = []
+    present = set()
+    for path in inbox.glob("*.pdf"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            # Moved away while listing
+            continue
+        present.add(path)
+        signature = (stat.st_size, stat.st_mtime)
+        if path not in seen or seen[path][0] != signature:
+            # New or still being written, wait for it to stop changing
+            seen[path] = (signature, now)
+            continue
+        if path not in exclude and stat.st_size and now-seen[path][1] >= settle_seconds:
+            papers.append((stat.st_mtime, path))
+    for path in list(seen):
+        if path not in present:
+            del seen[path]
+    return [path for mtime, path in sorted(papers)]
+
+def unique_name(path, file_hash):
+    # Scanners reuse names like scan0001.pdf, and the marking result is saved under the name of the paper, so a paper whose name is taken by an earlier result is renamed after its content first
+    suffix = f"_{file_hash[:8]}"
+    if path.stem.endswith(suffix) or ModuleResultsStore.GetPaper(path.stem+".xlsx") is None:
+        return path
+    renamed = path.with_name(path.stem+suffix+path.suffix)
+    print(f"A marking result named {path.stem} exists already, marking {path.name} as {renamed.name}.")
+    os.replace(path, renamed)
+    return renamed
+
+def mark(path, file_hash, mark_scheme_path, threshold_table_path):
+    # Run on a worker, returns the hash of the paper and the error, "" if it was marked
+    try:
+        ModuleMarkPaper.MarkPaper(str(path), mark_scheme_path, threshold_table_path)
+        return file_hash, ""
+    except Exception as e:
+        print(f"Marking {path} failed: {e}")
+        return file_hash, str(e) or type(e).__name__
+
+def finish(inbox, ledger, path, file_hash, error):
+    # Write the paper to the ledger before moving it, so that a restart in between only moves it
+    status = "failed" if error else "done"
+    ledger[file_hash] = {"name": path.name, "status": status, "error": error, "finished": time.time()}
+    save_ledger(inbox, ledger)
+    moved_to = move(path, inbox / status)
+    if error:
+        with open(moved_to.with_suffix(".error.txt"), "w") as f:
+            f.write(error)
+
+def move(path, folder):
+    # Move a paper into folder, without overwriting a paper of the same name dropped before
+    target = folder / path.name
+    if target.exists():
+        target = folder / f"{path.stem}_{time.strftime('%Y%m%d-%H%M%S')}{path.suffix}"
+    shutil.move(str(path), str(target))
+    return target
+
+def load_ledger(inbox):
+    # The papers handled so far, by the sha256 of their content
+    path = Path(inbox) / "watch_ledger.json"
+    if not path.exists():
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+def save_ledger(inbox, ledger):
+    path = Path(inbox) / "watch_ledger.json"
+    # Write to a temporary file first so that a restart never finds half a ledger
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(ledger, f, indent=4)
+    os.replace(tmp_path, path)
+
+# For testing
+if __name__ == "__main__":
+    inbox = "test_folder/ModuleWatchFolder/inbox/"
+    shutil.rmtree(inbox, ignore_errors=True)
+    Path(inbox).mkdir(parents=True)
+    for name in ["9709_12_2024_MayJune_Mathematics_qp_first_try.pdf", "9709_12_2024_MayJune_Mathematics_qp_second_try.pdf"]:
+        shutil.copyfile(f"test_folder/data/{name}", inbox+name)
+    stats = Watch(inbox, "test_folder/data/9709_12_2024_MayJune_Mathematics_ms.pdf", "test_folder/data/9709_12_2024_MayJune_Mathematics_tt.pdf", poll_seconds=1, settle_seconds=1, until_idle=True)
+    print(f"Stats: \t{stats}")
+    # Dropping the same paper again only moves it
+    shutil.copyfile("test_folder/data/9709_12_2024_MayJune_Mathematics_qp_first_try.pdf", inbox+"rescanned.pdf")
+    stats = Watch(inbox, "test_folder/data/9709_12_2024_MayJune_Mathematics_ms.pdf", "test_folder/data/9709_12_2024_MayJune_Mathematics_tt.pdf", poll_seconds=1, settle_seconds=1, until_idle=True)
+    print(f"Stats again: \t{stats}")
@@ -2,11 +2,15 @@ import configs
 import pydantic
 import base64
 import io
-from PIL import Image
 from time import time
 import json
+import asyncio
 
 import ModuleLLMQuery
+import ModuleMessages
+import ModuleModelRouter
+import ModulePDF2b64s
+import ModuleIndexQuestions
 
 # This class is only for prompt engineering purpose,
 # and the data stored in an instance of this class
@@ -43,7 +47,7 @@ class Feedback(pydantic.BaseModel):
     areas_for_improvement: str = pydantic.Field(..., description="a detailed comment on the areas where the student performed well")
     custom_error: str = pydantic.Field(..., description="leave empty unless you want to raise a fatal error, the details of which you shall specify here")
 
-def ProduceMarkingReport(student_work_b64imgs, marking_scheme_b64imgs, print_marking_report=False):
+def ProduceMarkingReport(student_work_b64imgs, marking_scheme_b64imgs, print_marking_report=False, question_paper_path=None, mark_scheme_path=None, on_question=None):
     # Only for debugging
     """
     import random
@@ -58,6 +62,9 @@ def ProduceMarkingReport(student_work_b64imgs, marking_scheme_b64imgs, print_mar
         1. student_work_b64imgs: A list of strings(each string being a base 64 image)
         2. marking_scheme_b64imgs: A list of strings(each string being a base 64 image)
         3. print_marking_report: whether to print the marking report given by the AI
+        4. question_paper_path: path to the question paper pdf, blank or the one the student has written, which together with mark_scheme_path lets the pages of each question be found locally
+        5. mark_scheme_path: path to the mark scheme pdf
+        6. on_question: optional function, called as each question is marked with the row of the question in the marking report (e.g. ["3(a)", 10, 9]) and the number of questions, in the order the questions finish
     Return:
         1. Syllabus code (<class 'str'>)
         2. Component number (<class 'str'>
@@ -66,72 +73,37 @@ def ProduceMarkingReport(student_work_b64imgs, marking_scheme_b64imgs, print_mar
         5. A comment on weaknesses of the student
     Process:
         Call ModuleLLMQuery.LLMQuery to let the AI mark the student's paper
+        The basic information (which pages belong to which question) is read from the text layers with ModuleIndexQuestions.IndexQuestions if the paths are given, and only asked from the AI if that fails
     """
     #with open("test_folder/tmp.png", "wb") as f:
     #    f.write(base64.b64decode(marking_scheme_b64imgs[-1]))
     #exit()
-    print("Sending request to AI to fill the basic information, THIS MAY TAKE A WHILE")
-    before=time()
-    basic_information = ModuleLLMQuery.LLMQuery(
-        [
-            {
-                "role": "system",
-                "content": (
-                    "You are an experienced A-Level examiner.\n"
-                    "You are marking the exam paper of a candidate.\n"
-                    "You will follow the instructions of the marking scheme when marking the exam paper.\n"
-                    "The user is your co-worker, and will provide you with the exam paper and the marking scheme.\n"
-                )
-            },
-            *generate_image_conversation(student_work_b64imgs, "the exam paper that the candidate has written"),
-            *generate_image_conversation(marking_scheme_b64imgs, "the marking scheme"),
-            {"role": "user", "content": "Now, please fill in some general information that you see in the exam paper and the marking scheme."},
-        ],
-        response_format=BasicInformation,
-        model="gpt-5"
-    )
-    print(f"The AI responded, and it took {time()-before}s") # 
-    # Allow the AI to handle edge cases
-    if basic_information.custom_error:
-        raise RuntimeError("The AI raised a fatal error!\n", basic_information.custom_error)
+    basic_information = None
+    if question_paper_path and mark_scheme_path:
+        index = ModuleIndexQuestions.IndexQuestions(question_paper_path, mark_scheme_path)
+        if index is not None:
+            print("The basic information is found from the text layers of the pdfs")
+            basic_information = BasicInformation.model_validate(index)
+    if basic_information is None:
+        basic_information = ask_for_basic_information(student_work_b64imgs, marking_scheme_b64imgs)
     print(basic_information)
     print("Now marking the questions, THIS MAY TAKE A WHILE")
     before=time()
-    marked_questions = []
-    for question in basic_information.questions:
-        range_of_pgs_in_qp = range(min(question.page_nums_of_statement_of_the_problem_in_qp)-1, max(question.page_nums_of_answer_space_in_qp))
-        range_of_pgs_in_ms = range(min(question.page_nums_in_ms)-1, max(question.page_nums_in_ms))
-        marked_questions.append(ModuleLLMQuery.LLMQuery(
-            [
-                {
-                    "role": "system",
-                    "content": (
-                        "You are an experienced A-Level examiner.\n"
-                        "You are marking the exam paper of a candidate.\n"
-                        "You will follow the instructions of the marking scheme when marking the exam paper.\n"
-                        "The user is your co-worker, and will provide you with the exam paper and the marking scheme.\n"
-                    )
-                },
-                *generate_image_conversation(student_work_b64imgs, "the exam paper that the candidate has written", range_of_pages=range_of_pgs_in_qp),
-                *generate_image_conversation(marking_scheme_b64imgs, "the marking scheme", range_of_pages=range_of_pgs_in_ms),
-                {"role": "user", "content": f"Now, please mark question {question}. Remember to follow the guidance on the marking scheme"},
-            ],
-            response_format=MarkedQuestion,
-            model="gpt-5-mini"
-        ))
+    marked_questions = asyncio.run(mark_questions(basic_information.questions, student_work_b64imgs, marking_scheme_b64imgs, on_question))
+    for marked_question in marked_questions:
         # Allow the AI to handle edge cases
-        if marked_questions[-1].custom_error:
-            raise RuntimeError("The AI raised a fatal error!\n", marked_questions[-1].custom_error)
+        if marked_question.custom_error:
+            raise RuntimeError("The AI raised a fatal error!\n", marked_question.custom_error)
         if print_marking_report:
             print(
-                f"question_number:\t{marked_questions[-1].question_number}\n"
-                f"student_answer:\t{marked_questions[-1].student_answer}\n"
-                f"guidance:\t{marked_questions[-1].guidance}\n"
-                f"max_marks:\t{marked_questions[-1].max_marks}\n"
-                f"awarded_marks:\t{marked_questions[-1].awarded_marks}\n"
+                f"question_number:\t{marked_question.question_number}\n"
+                f"student_answer:\t{marked_question.student_answer}\n"
+                f"guidance:\t{marked_question.guidance}\n"
+                f"max_marks:\t{marked_question.max_marks}\n"
+                f"awarded_marks:\t{marked_question.awarded_marks}\n"
                 f"grading_points:"
             )
-            print("\t", " ".join([f"{marks_earned}/{grading_point.grading_point_type+str(marks_worth)}" for grading_point in marked_questions[-1].grading_points]))
+            print("\t", " ".join([f"{grading_point.marks_earned}/{grading_point.grading_point_type+str(grading_point.marks_worth)}" for grading_point in marked_question.grading_points]))
             print()
     print(f"Done marking the questions, and it took {time()-before}s")
     print("Now requesting the AI to write feedback")
@@ -165,35 +137,75 @@ def ProduceMarkingReport(student_work_b64imgs, marking_scheme_b64imgs, print_mar
            feedback.areas_of_strengths,\
            feedback.areas_for_improvement
 
-def generate_image_conversation(b64_imgs, name_of_pdf, range_of_pages=None):
-    # Generate 'messages' in order to let the AI see all the pages in the right ORDER
-    conversation = []
-    if not range_of_pages:
-        range_of_pages = range(len(name_of_pdf))
-    idx = range_of_pages.start
-    for b64_img in b64_imgs[range_of_pages.start : range_of_pages.stop]:
-        idx += 1
-        conversation.extend([
+def ask_for_basic_information(student_work_b64imgs, marking_scheme_b64imgs):
+    # Let the AI find which pages belong to which question, when the text layers cannot tell
+    print("Sending request to AI to fill the basic information, THIS MAY TAKE A WHILE")
+    before=time()
+    basic_information = ModuleLLMQuery.LLMQuery(
+        [
             {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": f"This is page {idx}/{len(b64_imgs)} of {name_of_pdf}."},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/{configs.img_extension};base64,{b64_img}"
-                        }
-                    }
-                ]
+                "role": "system",
+                "content": (
+                    "You are an experienced A-Level examiner.\n"
+                    "You are marking the exam paper of a candidate.\n"
+                    "You will follow the instructions of the marking scheme when marking the exam paper.\n"
+                    "The user is your co-worker, and will provide you with the marking scheme and the exam paper.\n"
+                )
             },
-            {
-                "role": "assistant",
-                "content": [
-                    {"type": "text", "text": f"I see, this is page {idx} of {name_of_pdf}."}
-                ]
-            }
-        ])
-    return conversation
+            *ModuleMessages.ImageConversation(marking_scheme_b64imgs, "the marking scheme"),
+            *ModuleMessages.ImageConversation(student_work_b64imgs, "the exam paper that the candidate has written"),
+            {"role": "user", "content": "Now, please fill in some general information that you see in the marking scheme and the exam paper."},
+        ],
+        response_format=BasicInformation,
+        model=ModuleModelRouter.Models("basic_information")[0]
+    )
+    print(f"The AI responded, and it took {time()-before}s") # 
+    # Allow the AI to handle edge cases
+    if basic_information.custom_error:
+        raise RuntimeError("The AI raised a fatal error!\n", basic_information.custom_error)
+    return basic_information
+
+async def mark_questions(questions, student_work_b64imgs, marking_scheme_b64imgs, on_question=None):
+    # Send the marking requests of all the questions at the same time, ModuleLLMQuery.AsyncLLMQuery limits how many are in flight
+    # The marked questions are returned in the same order as the questions, while on_question hears of each as soon as it is marked
+    # Each question is marked by the cheapest model of configs.llm_models["question_marking"] first, and only by the stronger ones if the marks fail the checks of ModuleModelRouter.CheckMarkedQuestion
+    async def report(messages):
+        async def query(model):
+            return await ModuleLLMQuery.AsyncLLMQuery(messages, response_format=MarkedQuestion, model=model)
+        marked_question = await ModuleModelRouter.AsyncCascade("question_marking", query, ModuleModelRouter.CheckMarkedQuestion)
+        if on_question is not None:
+            on_question([marked_question.question_number, marked_question.max_marks, marked_question.awarded_marks], len(questions))
+        return marked_question
+    requests = []
+    for question in questions:
+        range_of_pgs_in_qp = range(min(question.page_nums_of_statement_of_the_problem_in_qp)-1, max(question.page_nums_of_answer_space_in_qp))
+        range_of_pgs_in_ms = range(min(question.page_nums_in_ms)-1, max(question.page_nums_in_ms))
+        requests.append(report(
+            [
+                {
+                    "role": "system",
+                    "content": (
+                        "You are an experienced A-Level examiner.\n"
+                        "You are marking the exam paper of a candidate.\n"
+                        "You will follow the instructions of the marking scheme when marking the exam paper.\n"
+                        "The user is your co-worker, and will provide you with the marking scheme and the exam paper.\n"
+                    )
+                },
+                # The marking scheme first, like ModuleProduceMarkingReport, so that the questions sharing pages of it share a longer prefix
+                *ModuleMessages.ImageConversation(pages_in_range(marking_scheme_b64imgs, range_of_pgs_in_ms), "the marking scheme", len(marking_scheme_b64imgs)),
+                *ModuleMessages.ImageConversation(pages_in_range(student_work_b64imgs, range_of_pgs_in_qp), "the exam paper that the candidate has written", len(student_work_b64imgs)),
+                {"role": "user", "content": f"Now, please mark question {question}. Remember to follow the guidance on the marking scheme"},
+            ],
+        ))
+    try:
+        return await asyncio.gather(*requests)
+    finally:
+        # The loop of asyncio.run ends with this coroutine, so its connections are closed here
+        await ModuleLLMQuery.CloseAsyncClient()
+
+def pages_in_range(b64_imgs, range_of_pages):
+    # (page_number, b64_img) tuples of the pages in range_of_pages, so that ModuleMessages.ImageConversation tells the AI the page numbers in the whole pdf
+    return [(idx+1, b64_imgs[idx]) for idx in range_of_pages if 0 <= idx < len(b64_imgs)]
 
 if __name__ == "__main__":
     import ModulePDF2b64s
@@ -207,5 +219,5 @@ if __name__ == "__main__":
     print("Converting done, marking now.")
 
     # Mark the Paper
-    syllabus_code, component_num, marking_report, strengths, weaknesses = ProduceMarkingReport(completed_question_paper_b64s, mark_scheme_b64s)
+    syllabus_code, component_num, marking_report, strengths, weaknesses = ProduceMarkingReport(completed_question_paper_b64s, mark_scheme_b64s, question_paper_path=student_work_path, mark_scheme_path=mark_scheme_path)
     print("\nAll marking done.")
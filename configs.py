@@ -4,5 +4,69 @@ llm_model = "gpt-5"
 #llm_model = "o4-mini"
 marking_result_folder = "./history/"
 path_to_excel_of_testing_history = "./summary/testing_history.xlsx"
+results_database_path = "./history/results.sqlite3" # where the marking results are kept, the excel files are exported from it
+excel_exports_enabled = False # whether every marking result and the summary are also written as excel files as soon as they are saved, they can always be exported on demand
+student_name = "default" # whom the marking results saved are filed under, the feedback is produced per student
+feedback_token_budget = 4000 # the most tokens of marking results ModuleProduceFeedbackForStudent sends at once, older papers are folded into the rolling summary first
+feedback_comment_max_chars = 300 # the strengths and weaknesses of each paper are cut to this many characters when sent for feedback
 img_extension = "png"
 img_extension_cap = "PNG"
+page_cache_folder = "./cache/pages/"
+page_cache_max_bytes = 512*1024*1024 # 512MB, the least recently used documents are evicted beyond this
+page_store_max_bytes = 256*1024*1024 # 256MB, the pages of the shared documents (mark schemes, threshold tables) ModulePageStore keeps in memory, the least recently used documents nobody is using are dropped beyond this
+render_workers = 1 # number of processes PDF2b64s renders pages with, raise this on machines with spare cores
+llm_max_concurrency = 8 # the maximum number of requests AsyncLLMQuery keeps in flight at once, per event loop (each job marking with [EXPERIMENTAL]ModuleProduceMarkingReport runs its own)
+llm_max_connections = 8 # the size of the connection pool shared by AsyncLLMQuery
+llm_cache_enabled = False # whether LLMQuery reuses the responses to identical requests, handy when re-running the tests
+llm_cache_path = "./cache/llm_responses.sqlite3"
+llm_cache_ttl_seconds = 7*24*3600 # a week
+llm_cache_max_bytes = 64*1024*1024 # 64MB, the least recently used responses are evicted beyond this
+batch_workers = 4 # the number of papers MarkPapers marks at the same time
+# The number of workers of each stage of ModulePipeline.MarkPapers. Rendering keeps the CPU busy while marking mostly waits for the AI, so marking has the most
+pipeline_workers = {"render": 1, "mark": 4, "grade": 2, "persist": 1}
+pipeline_queue_size = 2 # the most papers waiting in front of each stage of ModulePipeline, which also caps how many rendered papers are held at once
+excel_read_workers = 4 # the number of processes reading marking results at the same time
+excel_read_min_files_for_pool = 32 # fewer files than this are read without starting the processes
+# The encoding profiles of ModulePDF2b64s, chosen per type of document so that each upload is no larger than it needs to be
+# dpi: 108 is the 1.5x zoom of a 72 dpi pdf page
+# format: "png", "jpeg" or "webp", quality: 1 to 100 for jpeg and webp, None otherwise
+# grayscale: whether to drop the colors, colors: the size of the palette to reduce to, None to keep every color
+img_profiles = {
+    "default": {"dpi": 108, "format": img_extension, "quality": None, "grayscale": False, "colors": None},
+    "student_work": {"dpi": 108, "format": "webp", "quality": 80, "grayscale": False, "colors": None}, # handwriting, possibly in colored ink, and possibly a noisy scan a palette would not suit
+    "mark_scheme": {"dpi": 108, "format": "png", "quality": None, "grayscale": True, "colors": 16}, # typed black text
+    "threshold_table": {"dpi": 108, "format": "png", "quality": None, "grayscale": True, "colors": 16}, # typed black text
+}
+drop_redundant_pages = True # whether MarkPaper drops the blank and duplicate pages of the student work before sending it
+blank_page_max_variance = 100 # pages whose grayscale pixel variance is below this are blank, a 'BLANK PAGE' sheet is around 25 while a page of questions is above 300
+duplicate_page_max_distance = 2 # pages whose 256-bit perceptual hashes differ in at most this many bits are duplicates
+question_index_folder = "./cache/question_index/"
+job_folder = "./jobs/" # the state and the uploaded pdfs of every job of the gradio front end, kept across restarts
+job_workers = 2 # the number of jobs marked at the same time
+job_watch_max_seconds = 30*60 # how long the gradio front end follows a job before giving up, e.g. when its worker was lost
+watch_inbox_folder = "./inbox/" # the folder ModuleWatchFolder marks the pdfs dropped into, the papers handled are moved to its "done" and "failed" folders
+watch_mark_scheme_path = None # the mark scheme every paper dropped into the inbox is marked against, e.g. "./mark_schemes/9709_12_ms.pdf", kept outside the inbox
+watch_threshold_table_path = None # the threshold table every paper dropped into the inbox is graded with
+watch_workers = 2 # the number of papers ModuleWatchFolder marks at the same time
+watch_poll_seconds = 5 # how often the inbox is listed
+watch_settle_seconds = 10 # how long a pdf must stop changing before it is taken as fully written by the scanner
+tracing_enabled = True # whether ModuleTracing records the time, tokens and bytes of each stage of the marking
+trace_path = "./logs/trace.jsonl" # one line of JSON per span, None to only keep the totals in memory
+metrics_port = 9464 # the port ModuleTracing.StartMetricsServer serves the Prometheus metrics on, None to not serve them
+metrics_host = "127.0.0.1" # the address the metrics are served on, the metrics have no authentication so only set "0.0.0.0" behind a firewall
+llm_timeout_seconds = 15*60 # the longest an LLMQuery may take in total, retries included, marking a whole paper takes 5 to 10 minutes
+llm_max_retries = 4 # how many times a timeout, dropped connection, 429 or 5xx is retried
+llm_retry_base_seconds = 2 # the backoff before the n-th retry is drawn from 0 to base*2**(n-1) seconds
+llm_retry_max_seconds = 60 # the longest backoff
+llm_hedge_percentile = 0.95 # a hedged LLMQuery sends a duplicate request once the first is slower than this fraction of the recent requests
+llm_hedge_min_samples = 20 # fewer recent requests than this are not enough to tell what is slow
+llm_hedge_default_seconds = 30 # when to send the duplicate request until there are enough recent requests
+llm_hedge_window = 200 # how many recent requests per model and response format are remembered
+# The models of each kind of call, cheapest first. A marked question failing the checks of ModuleModelRouter.CheckMarkedQuestion is marked again by the next model
+llm_models = {
+    "marking": ["gpt-5-mini", "o4-mini"], # the whole paper at once, the questions failing the checks are marked again one at a time
+    "question_marking": ["gpt-5-mini", "gpt-5"], # one question at a time, in [EXPERIMENTAL]ModuleProduceMarkingReport
+    "basic_information": ["gpt-5"],
+    "grading": ["gpt-5-mini"],
+    "feedback": ["gpt-5-mini"],
+}